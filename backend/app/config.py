@@ -3,13 +3,183 @@ import os
 # FFmpeg Configuration
 # Use environment variable if set (for Docker/Production), otherwise use local path
 FFMPEG_PATH = os.environ.get("FFMPEG_PATH", r"C:\Users\TECHNIFI\Downloads\ffmpeg-8.0.1\ffmpeg-8.0.1\bin\ffmpeg.exe")
-FFPROBE_PATH = os.environ.get("FFPROBE_PATH", r"C:\Users\TECHNIFI\Downloads\ffmpeg-8.0.1\ffmpeg-8.0.1\bin\ffprobe.exe")
+# ffprobe ships next to ffmpeg, so it follows FFMPEG_PATH unless set explicitly
+_head, _sep, _tail = FFMPEG_PATH.rpartition("ffmpeg")
+FFPROBE_PATH = os.environ.get("FFPROBE_PATH", f"{_head}ffprobe{_tail}" if _sep else "ffprobe")
+
+# Finished FFmpeg progress records stay readable this long, so late subscribers see the outcome
+FFMPEG_PROGRESS_RETENTION_SECONDS = int(os.environ.get("FFMPEG_PROGRESS_RETENTION_SECONDS", 120))
+# How long a progress subscriber waits for a task that has not started yet (upload still running)
+FFMPEG_PROGRESS_WAIT_SECONDS = int(os.environ.get("FFMPEG_PROGRESS_WAIT_SECONDS", 600))
+# Streamed FFmpeg output is buffered up to this much ahead of the client; a client that takes
+# nothing for FFMPEG_STREAM_SEND_TIMEOUT_SECONDS is dropped so it can't pin an encode slot
+FFMPEG_STREAM_BUFFER_MB = int(os.environ.get("FFMPEG_STREAM_BUFFER_MB", 8))
+FFMPEG_STREAM_SEND_TIMEOUT_SECONDS = int(os.environ.get("FFMPEG_STREAM_SEND_TIMEOUT_SECONDS", 30))
 
 # Add FFmpeg to PATH for subprocess calls if needed
 os.environ["PATH"] += os.pathsep + os.path.dirname(FFMPEG_PATH)
 
 UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "outputs"
+# Server-side state (job queue, caches) that must outlive a single request
+DATA_DIR = os.environ.get("DATA_DIR", "data")
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# Worker pools
+# CPU-heavy conversions (PyMuPDF, Pillow, pdf2docx, rembg) run in a process pool,
+# blocking I/O and subprocess waits (FFmpeg, Tesseract, yt-dlp) run in a thread pool.
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", os.cpu_count() or 1))
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 16))
+# "spawn" avoids forking a process that already has running threads
+WORKER_START_METHOD = os.environ.get("WORKER_START_METHOD", "spawn")
+# Background removal has its own pool since each worker holds a loaded model;
+# a few onnxruntime threads per worker scale better than one worker using every core
+REMBG_WORKERS = int(os.environ.get("REMBG_WORKERS", max(1, (os.cpu_count() or 1) // 4)))
+# Long-lived LibreOffice instances for Word/ODT -> PDF (see the Word/ODT section below)
+OFFICE_POOL_SIZE = int(os.environ.get("OFFICE_POOL_SIZE", 2))
+
+# Per-tool concurrency limits, override with e.g. CONCURRENCY_MEDIA=1
+_DEFAULT_CONCURRENCY = {
+    "media": 2,
+    # FFmpeg runs for the segments of parallel compressions, across all requests
+    "media_segments": CPU_WORKERS,
+    # yt-dlp downloads, across all requests
+    "downloads": 2,
+    "documents": 2,
+    # Page shards of parallel pdf-to-word conversions, across all requests
+    "documents_pages": CPU_WORKERS,
+    # Page and image shards of PDF compressions and renderings, across all requests
+    "pdf_pages": CPU_WORKERS,
+    "images": 4,
+    "remove_bg": REMBG_WORKERS,
+    "ocr": 2,
+    "pdf": 4,
+    "image_tools": 4,
+    "archives": 4,
+    # LibreOffice calls: one conversion per pool instance, or one-shot soffice runs without the pool
+    "office": max(1, OFFICE_POOL_SIZE),
+    "qr": 4,
+    "utils": 8,
+    "uploads": 16,
+    "default": 4,
+}
+TOOL_CONCURRENCY = {
+    tool: int(os.environ.get(f"CONCURRENCY_{tool.upper()}", limit))
+    for tool, limit in _DEFAULT_CONCURRENCY.items()
+}
+
+# Background jobs
+# Queue state lives in a local SQLite file so submitted jobs survive a restart
+JOBS_DB = os.environ.get("JOBS_DB", os.path.join(DATA_DIR, "jobs.sqlite3"))
+# Job inputs wait here (outside the janitor's reach) until the job has run
+JOB_UPLOAD_DIR = os.environ.get("JOB_UPLOAD_DIR", os.path.join(DATA_DIR, "job_uploads"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", 5))
+
+# Upload size limits in MB, override with e.g. MAX_UPLOAD_MB_PDF=1024
+_DEFAULT_UPLOAD_LIMITS_MB = {
+    "media": 2048,
+    "documents": 200,
+    "images": 50,
+    # Whole request for /convert/image/remove-bg/batch; each image is still held to "images"
+    "images_batch": 1024,
+    "ocr": 50,
+    "pdf": 500,
+    "image_tools": 50,
+    "archives": 1024,
+    "utils": 2048,
+    "default": 100,
+}
+MAX_UPLOAD_MB = {
+    tool: int(os.environ.get(f"MAX_UPLOAD_MB_{tool.upper()}", limit))
+    for tool, limit in _DEFAULT_UPLOAD_LIMITS_MB.items()
+}
+
+# Storage lifecycle
+# The janitor deletes files older than their TTL, then evicts the oldest outputs
+# until UPLOAD_DIR + OUTPUT_DIR fit in the quota (uploads are only ever expired)
+UPLOAD_TTL_SECONDS = int(os.environ.get("UPLOAD_TTL_SECONDS", 60 * 60))
+OUTPUT_TTL_SECONDS = int(os.environ.get("OUTPUT_TTL_SECONDS", 24 * 60 * 60))
+STORAGE_QUOTA_MB = int(os.environ.get("STORAGE_QUOTA_MB", 10 * 1024))
+JANITOR_INTERVAL_SECONDS = int(os.environ.get("JANITOR_INTERVAL_SECONDS", 10 * 60))
+# Files younger than this are never evicted for quota, so in-flight work is left alone
+JANITOR_MIN_AGE_SECONDS = int(os.environ.get("JANITOR_MIN_AGE_SECONDS", 5 * 60))
+
+# Result cache
+# Artifacts are keyed by input hash + tool + parameters and evicted least-recently-used first
+CACHE_DIR = os.environ.get("CACHE_DIR", os.path.join(DATA_DIR, "cache"))
+CACHE_MAX_MB = int(os.environ.get("CACHE_MAX_MB", 2048))
+# Send "X-Cache-Bypass: 1" to skip the cache for a request
+CACHE_BYPASS_HEADER = os.environ.get("CACHE_BYPASS_HEADER", "X-Cache-Bypass")
+
+# Background removal (rembg)
+# Models are loaded once per dedicated worker process and reused for every request
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+# ONNX Runtime threads per worker; 0 lets onnxruntime decide
+REMBG_INTRA_OP_THREADS = int(os.environ.get("REMBG_INTRA_OP_THREADS", max(1, (os.cpu_count() or 1) // REMBG_WORKERS)))
+REMBG_INTER_OP_THREADS = int(os.environ.get("REMBG_INTER_OP_THREADS", 1))
+# Requests arriving within the window are sent to a worker together, up to the batch size
+REMBG_BATCH_SIZE = int(os.environ.get("REMBG_BATCH_SIZE", 8))
+REMBG_BATCH_WINDOW_MS = int(os.environ.get("REMBG_BATCH_WINDOW_MS", 25))
+# Load the model at startup instead of on the first request
+REMBG_PRELOAD = os.environ.get("REMBG_PRELOAD", "false").lower() in ("1", "true", "yes")
+# Most images accepted by one /convert/image/remove-bg/batch request (files plus ZIP members)
+REMBG_BATCH_MAX_FILES = int(os.environ.get("REMBG_BATCH_MAX_FILES", 500))
+
+# Parallel pdf-to-word
+# Documents with at least PDF2DOCX_PARALLEL_MIN_PAGES pages are parsed in shards of
+# PDF2DOCX_SHARD_PAGES pages across up to PDF2DOCX_WORKERS processes, then assembled once
+PDF2DOCX_WORKERS = int(os.environ.get("PDF2DOCX_WORKERS", CPU_WORKERS))
+PDF2DOCX_SHARD_PAGES = int(os.environ.get("PDF2DOCX_SHARD_PAGES", 10))
+PDF2DOCX_PARALLEL_MIN_PAGES = int(os.environ.get("PDF2DOCX_PARALLEL_MIN_PAGES", 20))
+
+# PDF find-and-replace searches documents with at least this many pages in parallel page shards
+PDF_EDIT_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_EDIT_PARALLEL_MIN_PAGES", 40))
+
+# PDF page rendering (/convert/pdf/to-images, /pdf/thumbnails): pages are rendered in shards of
+# PDF_RENDER_SHARD_PAGES across the "pdf_pages" slots; larger renders than the limits are rejected
+PDF_RENDER_SHARD_PAGES = int(os.environ.get("PDF_RENDER_SHARD_PAGES", 4))
+PDF_RENDER_MAX_DPI = int(os.environ.get("PDF_RENDER_MAX_DPI", 600))
+PDF_RENDER_MAX_MEGAPIXELS = int(os.environ.get("PDF_RENDER_MAX_MEGAPIXELS", 100))
+
+# Word/ODT -> PDF
+# A pool of headless LibreOffice instances, each wrapped by unoserver on its own
+# pair of ports (OFFICE_BASE_PORT + 2 * index for XML-RPC, +1 for UNO)
+UNOSERVER_PATH = os.environ.get("UNOSERVER_PATH", "unoserver")
+SOFFICE_PATH = os.environ.get("SOFFICE_PATH", "soffice")
+OFFICE_BASE_PORT = int(os.environ.get("OFFICE_BASE_PORT", 2003))
+OFFICE_PROFILE_DIR = os.environ.get("OFFICE_PROFILE_DIR", os.path.join(DATA_DIR, "office_profiles"))
+OFFICE_STARTUP_TIMEOUT = int(os.environ.get("OFFICE_STARTUP_TIMEOUT", 60))
+OFFICE_CONVERSION_TIMEOUT = int(os.environ.get("OFFICE_CONVERSION_TIMEOUT", 120))
+# Restart an instance after this many documents to cap LibreOffice's memory growth
+OFFICE_MAX_CONVERSIONS = int(os.environ.get("OFFICE_MAX_CONVERSIONS", 200))
+OFFICE_HEALTH_INTERVAL_SECONDS = int(os.environ.get("OFFICE_HEALTH_INTERVAL_SECONDS", 30))
+
+# Segmented video compression
+# In auto mode, videos at least MEDIA_SEGMENT_MIN_SECONDS long are cut at keyframes into
+# segments of at least MEDIA_SEGMENT_SECONDS, encoded in parallel and joined losslessly
+MEDIA_SEGMENT_MIN_SECONDS = int(os.environ.get("MEDIA_SEGMENT_MIN_SECONDS", 180))
+MEDIA_SEGMENT_SECONDS = int(os.environ.get("MEDIA_SEGMENT_SECONDS", 30))
+# Target-size compression: length of the clip encoded to calibrate the CRF in "sample" mode
+MEDIA_SAMPLE_SECONDS = int(os.environ.get("MEDIA_SAMPLE_SECONDS", 20))
+# /media/probe reads packets (not frames) from this much of the video to measure the keyframe interval
+MEDIA_PROBE_KEYFRAME_SECONDS = int(os.environ.get("MEDIA_PROBE_KEYFRAME_SECONDS", 60))
+
+# Video downloads (yt-dlp)
+# A downloaded URL is served from the result cache for this long before it is fetched again
+DOWNLOAD_CACHE_TTL_SECONDS = int(os.environ.get("DOWNLOAD_CACHE_TTL_SECONDS", 6 * 3600))
+# The connectivity pre-flight result is reused for this long, then refreshed in the background
+DOWNLOAD_CONNECTIVITY_TTL_SECONDS = int(os.environ.get("DOWNLOAD_CONNECTIVITY_TTL_SECONDS", 300))
+DOWNLOAD_CONNECTIVITY_URL = os.environ.get("DOWNLOAD_CONNECTIVITY_URL", "https://www.youtube.com")
+# Fragments of DASH/HLS formats fetched in parallel by each download
+DOWNLOAD_CONCURRENT_FRAGMENTS = int(os.environ.get("DOWNLOAD_CONCURRENT_FRAGMENTS", 4))
+
+# Archive extraction limits against decompression bombs, checked on the sizes the archive declares
+# and again on the bytes actually decompressed
+ARCHIVE_MAX_MEMBERS = int(os.environ.get("ARCHIVE_MAX_MEMBERS", 10000))
+ARCHIVE_MAX_EXTRACT_MB = int(os.environ.get("ARCHIVE_MAX_EXTRACT_MB", 4096))
+# Largest uncompressed/compressed ratio accepted for a member bigger than 1 MB
+ARCHIVE_MAX_RATIO = int(os.environ.get("ARCHIVE_MAX_RATIO", 200))
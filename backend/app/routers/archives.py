@@ -1,55 +1,247 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+import asyncio
+import collections
+import mimetypes
 import os
-import shutil
-import uuid
+import tarfile
 import zipfile
 from typing import List
-from ..config import UPLOAD_DIR, OUTPUT_DIR
+from ..config import CPU_WORKERS
+from ..services import archive_reader, cache, storage, zipstream
+from ..services.executor import run_cpu, run_io, limiter
+from ..services.uploads import save_upload, spooled_upload
 
 router = APIRouter()
 
+
+# compression name -> (ZIP method, default level, min level, max level)
+_COMPRESSION = {
+    "stored": (zipfile.ZIP_STORED, None, None, None),
+    "deflate": (zipfile.ZIP_DEFLATED, 6, 1, 9),
+    # Negative zstd levels are its fast modes; -131072 is ZSTD_minCLevel()
+    "zstd": (zipstream.ZIP_ZSTANDARD, 3, -(1 << 17), 22),
+}
+
+
+
+def _read_listing(input_path):
+    fmt = archive_reader.detect(input_path)
+    return {"format": fmt, "entries": archive_reader.list_entries(input_path, fmt)}
+
+
+def _plan_extraction(input_path, patterns):
+    fmt = archive_reader.detect(input_path)
+    selected = archive_reader.select(archive_reader.list_entries(input_path, fmt), patterns)
+    archive_reader.check_limits(selected)
+    return fmt, [entry["name"] for entry in selected]
+
+
+def _single_member(input_path, fmt, name, work_dir):
+    budget = archive_reader.Budget()
+    for _, src in archive_reader.open_members(input_path, fmt, [name], work_dir):
+        src = budget.wrap(src)
+        while True:
+            chunk = src.read(1024 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _zipped_members(input_path, fmt, names, work_dir):
+    zip_stream = zipstream.ZipStream(zipfile.ZIP_DEFLATED)
+    budget = archive_reader.Budget()
+    for name, src in archive_reader.open_members(input_path, fmt, names, work_dir):
+        compress_type = zipfile.ZIP_STORED if zipstream.already_compressed(name) else None
+        yield from zip_stream.add_fileobj(archive_reader.safe_name(name), budget.wrap(src), compress_type=compress_type)
+    yield zip_stream.close()
+
+
+async def _stream_extracted(members, *cleanup):
+    try:
+        async with limiter("archives"):
+            async for data in iterate_in_threadpool(members):
+                yield data
+    finally:
+        # Also reached when the client disconnects mid-stream
+        storage.remove(*cleanup)
+
+
+def _archive_error(e):
+    if isinstance(e, archive_reader.ArchiveLimitError):
+        return HTTPException(status_code=413, detail=str(e))
+    if isinstance(e, NotImplementedError):
+        return HTTPException(status_code=501, detail=str(e))
+    if isinstance(e, (ValueError, zipfile.BadZipFile, tarfile.TarError)):
+        return HTTPException(status_code=400, detail=f"Could not read archive: {e}")
+    return HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/convert/archive/list")
+async def list_archive(file: UploadFile = File(...)):
+    """List the members of a zip, tar(.gz/.bz2/.xz) or 7z archive without extracting them."""
+    try:
+        async with spooled_upload(file, "archives") as (input_path, digest):
+            cache_key = cache.make_key("archives.list", [digest])
+            listing = await cache.cached_json(cache_key)
+            if listing is None:
+                listing = await run_io("archives", _read_listing, input_path)
+                await cache.store_json(cache_key, listing)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise _archive_error(e)
+
+    files = [entry for entry in listing["entries"] if not entry["is_dir"]]
+    return {
+        "filename": file.filename,
+        "format": listing["format"],
+        "count": len(files),
+        "total_size": sum(entry["size"] for entry in files),
+        "entries": listing["entries"],
+    }
+
+
 @router.post("/convert/archive/extract")
-async def extract_archive(file: UploadFile = File(...)):
-    if not file.filename.endswith(".zip"):
-        raise HTTPException(status_code=400, detail="Only ZIP files are supported for extraction currently.")
-    
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
-    extract_dir = os.path.join(OUTPUT_DIR, f"{file_id}_extracted")
-    os.makedirs(extract_dir, exist_ok=True)
-
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+async def extract_archive(file: UploadFile = File(...), members: str = Form("")):
+    """
+    Extract a zip, tar(.gz/.bz2/.xz) or 7z archive. ``members`` optionally lists the names or glob
+    patterns to extract, one per line. A single selected file is returned as-is; several are
+    streamed back as a ZIP.
+    """
+    patterns = [line.strip() for line in members.splitlines() if line.strip()]
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
+    # Only 7z members are written out, and only the selected ones
+    work_dir = storage.output_path(file_id)
+
+    await save_upload(file, "archives", input_path)
 
     try:
-        with zipfile.ZipFile(input_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
-        
-        # For simplicity, we'll re-zip the extracted folder to download it (in a real app, we'd list files)
-        # But wait, the user wants to "extract". Downloading a zip is redundant. 
-        # Let's just return a list of extracted files for now or zip them individually? 
-        # Actually, let's just support creating archives for now as it's easier to return a single file.
-        pass
+        fmt, names = await run_io("archives", _plan_extraction, input_path, patterns)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
-    return {"message": "Extraction successful (files saved on server - download logic pending)"}
+        storage.remove(input_path)
+        raise _archive_error(e)
+    if not names:
+        storage.remove(input_path)
+        raise HTTPException(status_code=404, detail="No files in the archive match the requested members.")
+
+    print(f"Extracting {len(names)} members from {file.filename} ({fmt})")
+    if len(names) == 1:
+        filename = os.path.basename(archive_reader.safe_name(names[0])) or "file"
+        media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        body = _single_member(input_path, fmt, names[0], work_dir)
+    else:
+        filename = f"{os.path.splitext(file.filename)[0]}_extracted.zip"
+        media_type = "application/zip"
+        body = _zipped_members(input_path, fmt, names, work_dir)
+
+    return StreamingResponse(
+        _stream_extracted(body, input_path, work_dir),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+# Members up to this size are compressed whole in the process pool, several at once, while earlier
+# ones stream; larger ones are compressed chunk by chunk into the stream so they never sit in memory
+_POOL_MAX_MEMBER_BYTES = 32 * 1024 * 1024
+# How far pool compression runs ahead of the member being streamed. Compressed members wait in
+# memory until their turn, so the window is bounded by member count and by source bytes.
+_LOOKAHEAD_MEMBERS = CPU_WORKERS
+_LOOKAHEAD_BYTES = 256 * 1024 * 1024
+
+
+async def _stream_archive(entries, compress_type, level):
+    # Every member passes its own method; zipfile itself rejects zstd before Python 3.14
+    zip_stream = zipstream.ZipStream()
+    pending = collections.deque()
+    position = 0
+    ahead_bytes = 0
+
+    def compressible(arcname):
+        return compress_type != zipfile.ZIP_STORED and not zipstream.already_compressed(arcname)
+
+    def fill():
+        nonlocal position, ahead_bytes
+        while position < len(entries) and len(pending) < _LOOKAHEAD_MEMBERS:
+            arcname, path = entries[position]
+            size = os.path.getsize(path)
+            task, charged = None, 0
+            if compressible(arcname) and size <= _POOL_MAX_MEMBER_BYTES:
+                # Every pool member fits an empty window, so this only ever waits for earlier ones
+                if ahead_bytes + size > _LOOKAHEAD_BYTES:
+                    return
+                task = asyncio.ensure_future(run_cpu("archives", zipstream.compress_file, path, compress_type, level))
+                charged = size
+            pending.append((arcname, path, charged, task))
+            ahead_bytes += charged
+            position += 1
+
+    try:
+        fill()
+        while pending:
+            arcname, path, charged, task = pending.popleft()
+            members = None
+            if task is not None:
+                crc, file_size, data = await task
+                # Data that doesn't shrink is stored as-is
+                if len(data) < file_size:
+                    members = zip_stream.add_compressed(arcname, data, compress_type, crc, file_size)
+            elif compressible(arcname):
+                members = zip_stream.add_file_compressing(arcname, path, compress_type, level)
+            ahead_bytes -= charged
+            fill()
+            if members is None:
+                members = zip_stream.add_file(arcname, path, compress_type=zipfile.ZIP_STORED)
+            async for chunk in iterate_in_threadpool(members):
+                yield chunk
+        yield zip_stream.close()
+    finally:
+        # Also reached when the client disconnects mid-stream
+        for _, _, _, task in pending:
+            if task is not None:
+                task.cancel()
+        storage.remove(*[path for _, path in entries])
+
 
 @router.post("/convert/archive/create")
-async def create_archive(files: List[UploadFile] = File(...)):
-    file_id = str(uuid.uuid4())
+async def create_archive(
+    files: List[UploadFile] = File(...),
+    compression: str = Form("deflate"),
+    level: int = Form(0),
+):
+    """
+    Stream back a ZIP of the uploads. ``compression`` is stored, deflate (level 1-9) or zstd (up to
+    22, negative for its fast modes) at ``level`` (0 = default). Already-compressed formats (JPEG, MP4, ZIP...) are always stored.
+    """
+    compression = compression.lower()
+    if compression not in _COMPRESSION:
+        raise HTTPException(status_code=400, detail=f"Invalid compression. Supported: {', '.join(_COMPRESSION)}")
+    compress_type, default_level, min_level, max_level = _COMPRESSION[compression]
+    if max_level is not None and level != 0 and not min_level <= level <= max_level:
+        raise HTTPException(status_code=400, detail=f"Level for {compression} must be between {min_level} and {max_level} (0 for the default).")
+    if compression == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="zstd compression requires the zstandard package on the server.")
+
+    file_id = storage.new_file_id()
     output_filename = f"archive_{file_id}.zip"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
+    entries = []
 
     try:
-        with zipfile.ZipFile(output_path, 'w') as zipf:
-            for file in files:
-                file_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
-                with open(file_path, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
-                zipf.write(file_path, arcname=file.filename)
-                
-        return FileResponse(output_path, filename=output_filename, media_type="application/zip")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        for file in files:
+            file_path = storage.upload_path(storage.new_file_id(), file.filename)
+            await save_upload(file, "archives", file_path)
+            entries.append((file.filename, file_path))
+    except BaseException:
+        storage.remove(*[file_path for _, file_path in entries])
+        raise
+
+    return StreamingResponse(
+        _stream_archive(entries, compress_type, level or default_level),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={output_filename}"},
+    )
@@ -1,9 +1,7 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from fastapi.responses import FileResponse
+import asyncio
 import os
-import shutil
-import uuid
-from ..config import UPLOAD_DIR, OUTPUT_DIR
 from pdf2docx import Converter
 try:
     from docx2pdf import convert
@@ -15,103 +13,233 @@ except ImportError:
 import pandas as pd
 import markdown
 import pdfkit
+from ..config import PDF2DOCX_WORKERS, PDF2DOCX_SHARD_PAGES, PDF2DOCX_PARALLEL_MIN_PAGES
+from ..services import cache, storage, jobs, office, pdf
+from ..services.executor import run_cpu, run_io
+from ..services.uploads import save_upload
 
 router = APIRouter()
 
+
+def _pdf_to_docx(input_path, output_path, start, end):
+    cv = Converter(input_path)
+    try:
+        cv.convert(output_path, start=start, end=end)
+    finally:
+        cv.close()
+
+
+def _parse_pdf_pages(input_path, pages, json_path):
+    # One shard of a parallel conversion: parse a slice of pages and store the layout as JSON
+    cv = Converter(input_path)
+    try:
+        cv.parse(pages=pages, **cv.default_settings)
+        cv.serialize(json_path)
+    finally:
+        cv.close()
+
+
+def _assemble_docx(input_path, json_paths, output_path):
+    cv = Converter(input_path)
+    try:
+        cv.load_pages()
+        for json_path in json_paths:
+            cv.deserialize(json_path)
+        cv.make_docx(output_path, **cv.default_settings)
+    finally:
+        cv.close()
+
+
+async def _convert_pdf_to_docx(input_path, output_path, start, end, workers):
+    """
+    Convert pages [start, end) of a PDF. Long documents are parsed in page shards
+    across the process pool and assembled into one document, the same
+    parse/serialize/restore steps pdf2docx's own multi-processing mode uses.
+    Under a job, short documents are parsed shard by shard as well so progress
+    is reported after every shard.
+    """
+    page_count = await run_io("documents", pdf.page_count, input_path)
+    end = min(end, page_count) if end else page_count
+    if start < 0 or start >= end:
+        raise HTTPException(status_code=400, detail=f"Invalid page range. The document has {page_count} pages.")
+
+    pages = list(range(start, end))
+    parallel = workers > 1 and len(pages) >= PDF2DOCX_PARALLEL_MIN_PAGES
+    if not parallel and jobs.current_job_id() is None:
+        # Nobody polls a plain request for progress, so one pass is cheapest
+        await run_cpu("documents", _pdf_to_docx, input_path, output_path, start, end)
+        return
+
+    shards = [pages[i:i + PDF2DOCX_SHARD_PAGES] for i in range(0, len(pages), PDF2DOCX_SHARD_PAGES)]
+    json_paths = [f"{output_path}.{i}.json" for i in range(len(shards))]
+    # Bounds this request's share of the pool; "documents_pages" bounds all requests together
+    limit = asyncio.Semaphore(workers if parallel else 1)
+    done_pages = 0
+
+    async def parse_shard(shard, json_path):
+        nonlocal done_pages
+        async with limit:
+            await run_cpu("documents_pages", _parse_pdf_pages, input_path, shard, json_path)
+        done_pages += len(shard)
+        # Assembly takes roughly a tenth of the time, leave room for it
+        jobs.report_progress(0.9 * done_pages / len(pages))
+
+    try:
+        await asyncio.gather(*[parse_shard(shard, json_path) for shard, json_path in zip(shards, json_paths)])
+        await run_cpu("documents", _assemble_docx, input_path, json_paths, output_path)
+    finally:
+        storage.remove(*json_paths)
+
+
+def _docx_to_pdf(input_path, output_path):
+    # COM must be initialized and released on the thread that uses it
+    pythoncom.CoInitialize()
+    try:
+        convert(input_path, output_path)
+    finally:
+        pythoncom.CoUninitialize()
+
+
+def _csv_to_xlsx(input_path, output_path):
+    df = pd.read_csv(input_path)
+    df.to_excel(output_path, index=False)
+
+
+def _markdown_to_html(input_path, output_path):
+    with open(input_path, "r", encoding="utf-8") as f:
+        text = f.read()
+        html = markdown.markdown(text)
+    
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(html)
+
+
 @router.post("/convert/pdf-to-word")
-async def pdf_to_word(file: UploadFile = File(...)):
+async def pdf_to_word(
+    file: UploadFile = File(...),
+    start: int = Form(0),
+    end: int = Form(0),
+    workers: int = Form(PDF2DOCX_WORKERS),
+):
+    """
+    Convert a PDF to DOCX. ``start``/``end`` select pages (0-based, end exclusive, 0 = last page).
+    Long documents are converted in parallel with up to ``workers`` processes.
+    """
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a PDF.")
     
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"{os.path.splitext(file.filename)[0]}.docx"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    digest = await save_upload(file, "documents", input_path)
+    cache_key = cache.make_key("documents.pdf-to-word", [digest], start=start, end=end)
 
     try:
-        cv = Converter(input_path)
-        cv.convert(output_path, start=0, end=None)
-        cv.close()
-        return FileResponse(output_path, filename=output_filename, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+        hit = await cache.cached_response(cache_key, filename=output_filename)
+        if hit is not None:
+            return hit
+
+        workers = max(1, min(workers, PDF2DOCX_WORKERS))
+        await _convert_pdf_to_docx(input_path, output_path, start, end, workers)
+        await cache.store_file(cache_key, output_path, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+        return FileResponse(output_path, filename=output_filename, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document", background=storage.remove_after(output_path))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        storage.remove(input_path)
 
 @router.post("/convert/word-to-pdf")
 async def word_to_pdf(file: UploadFile = File(...)):
-    if not file.filename.endswith((".docx", ".doc")):
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a Word document.")
+    """Convert Word/ODT/RTF to PDF with the LibreOffice pool (Microsoft Word via COM as a Windows fallback)"""
+    if not file.filename.endswith((".docx", ".doc", ".odt", ".rtf")):
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a Word or OpenDocument file.")
     
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"{os.path.splitext(file.filename)[0]}.pdf"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    digest = await save_upload(file, "documents", input_path)
+    cache_key = cache.make_key("documents.word-to-pdf", [digest])
 
     try:
-        if convert is None or pythoncom is None:
-            raise HTTPException(status_code=501, detail="Word to PDF conversion is only available on Windows servers with Microsoft Word installed.")
+        hit = await cache.cached_response(cache_key, filename=output_filename)
+        if hit is not None:
+            return hit
 
-        # Initialize COM library for Windows
-        pythoncom.CoInitialize()
-        convert(input_path, output_path)
-        return FileResponse(output_path, filename=output_filename, media_type="application/pdf")
+        if office.running() or office.cli_available():
+            await office.convert_to_pdf(input_path, output_path)
+        elif convert is not None and pythoncom is not None:
+            await run_io("documents", _docx_to_pdf, input_path, output_path)
+        else:
+            raise HTTPException(status_code=501, detail="Word to PDF conversion needs LibreOffice (or Microsoft Word on Windows) on the server.")
+        await cache.store_file(cache_key, output_path, "application/pdf")
+        return FileResponse(output_path, filename=output_filename, media_type="application/pdf", background=storage.remove_after(output_path))
     except HTTPException:
         raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         error_msg = str(e)
         if "CoInitialize" in error_msg or "class not registered" in error_msg.lower():
              raise HTTPException(status_code=500, detail="Server Error: Microsoft Word is not installed or configured correctly on the server.")
         raise HTTPException(status_code=500, detail=f"Conversion failed: {error_msg}")
     finally:
-        if pythoncom:
-            pythoncom.CoUninitialize()
+        storage.remove(input_path)
 
 @router.post("/convert/csv-to-excel")
 async def csv_to_excel(file: UploadFile = File(...)):
     if not file.filename.endswith(".csv"):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a CSV.")
     
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"{os.path.splitext(file.filename)[0]}.xlsx"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    digest = await save_upload(file, "documents", input_path)
+    cache_key = cache.make_key("documents.csv-to-excel", [digest])
 
     try:
-        df = pd.read_csv(input_path)
-        df.to_excel(output_path, index=False)
-        return FileResponse(output_path, filename=output_filename, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        hit = await cache.cached_response(cache_key, filename=output_filename)
+        if hit is not None:
+            return hit
+
+        await run_cpu("documents", _csv_to_xlsx, input_path, output_path)
+        await cache.store_file(cache_key, output_path, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        return FileResponse(output_path, filename=output_filename, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", background=storage.remove_after(output_path))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        storage.remove(input_path)
 
 @router.post("/convert/markdown-to-html")
 async def markdown_to_html(file: UploadFile = File(...)):
     if not file.filename.endswith(".md"):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a Markdown file.")
     
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"{os.path.splitext(file.filename)[0]}.html"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    digest = await save_upload(file, "documents", input_path)
+    cache_key = cache.make_key("documents.markdown-to-html", [digest])
 
     try:
-        with open(input_path, "r", encoding="utf-8") as f:
-            text = f.read()
-            html = markdown.markdown(text)
-        
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(html)
+        hit = await cache.cached_response(cache_key, filename=output_filename)
+        if hit is not None:
+            return hit
+
+        await run_cpu("documents", _markdown_to_html, input_path, output_path)
             
-        return FileResponse(output_path, filename=output_filename, media_type="text/html")
+        await cache.store_file(cache_key, output_path, "text/html")
+        return FileResponse(output_path, filename=output_filename, media_type="text/html", background=storage.remove_after(output_path))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        storage.remove(input_path)
@@ -4,9 +4,107 @@ from PIL import Image, ImageFilter, ImageEnhance
 import io
 import piexif
 from colorthief import ColorThief
+from ..services import cache
+from ..services.executor import run_cpu
+from ..services.uploads import spooled_upload
 
 router = APIRouter()
 
+
+# Worker functions run in the process pool: they open the spooled upload by path and return PNG bytes (or plain dicts/lists).
+
+def _to_png(img):
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def _apply_filter(input_path, filter_type):
+    img = Image.open(input_path)
+    
+    # Convert to RGB if needed
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    # Apply filters
+    if filter_type == 'grayscale':
+        img = img.convert('L').convert('RGB')
+    elif filter_type == 'sepia':
+        # Sepia tone
+        img = img.convert('L')
+        img = ImageEnhance.Color(img.convert('RGB')).enhance(0.0)
+        r, g, b = img.split()
+        img = Image.merge('RGB', (
+            r.point(lambda i: min(255, int(i * 1.0))),
+            g.point(lambda i: min(255, int(i * 0.95))),
+            b.point(lambda i: min(255, int(i * 0.82)))
+        ))
+    elif filter_type == 'blur':
+        img = img.filter(ImageFilter.BLUR)
+    elif filter_type == 'sharpen':
+        img = img.filter(ImageFilter.SHARPEN)
+    elif filter_type == 'edge':
+        img = img.filter(ImageFilter.FIND_EDGES)
+    elif filter_type == 'emboss':
+        img = img.filter(ImageFilter.EMBOSS)
+    else:
+        raise ValueError("Invalid filter type")
+    
+    return _to_png(img)
+
+
+def _adjust(input_path, brightness, contrast, saturation):
+    img = Image.open(input_path)
+    
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    # Apply adjustments
+    if brightness != 1.0:
+        enhancer = ImageEnhance.Brightness(img)
+        img = enhancer.enhance(brightness)
+    
+    if contrast != 1.0:
+        enhancer = ImageEnhance.Contrast(img)
+        img = enhancer.enhance(contrast)
+    
+    if saturation != 1.0:
+        enhancer = ImageEnhance.Color(img)
+        img = enhancer.enhance(saturation)
+    
+    return _to_png(img)
+
+
+def _read_exif(input_path):
+    img = Image.open(input_path)
+    
+    exif_dict = {}
+    if hasattr(img, '_getexif') and img._getexif():
+        exif_data = img._getexif()
+        for tag_id, value in exif_data.items():
+            tag = piexif.TAGS.get(tag_id, tag_id)
+            exif_dict[str(tag)] = str(value)
+    return exif_dict
+
+
+def _strip_exif(input_path):
+    img = Image.open(input_path)
+    
+    # Remove EXIF by saving without it
+    data = list(img.getdata())
+    image_without_exif = Image.new(img.mode, img.size)
+    image_without_exif.putdata(data)
+    
+    return _to_png(image_without_exif)
+
+
+def _palette(input_path, color_count):
+    color_thief = ColorThief(input_path)
+    
+    # Get palette
+    return color_thief.get_palette(color_count=color_count, quality=1)
+
+
 @router.post("/convert/image/filter")
 async def apply_image_filter(
     file: UploadFile = File(...),
@@ -14,47 +112,24 @@ async def apply_image_filter(
 ):
     """Apply filters to images"""
     try:
-        contents = await file.read()
-        img = Image.open(io.BytesIO(contents))
-        
-        # Convert to RGB if needed
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Apply filters
-        if filter_type == 'grayscale':
-            img = img.convert('L').convert('RGB')
-        elif filter_type == 'sepia':
-            # Sepia tone
-            img = img.convert('L')
-            img = ImageEnhance.Color(img.convert('RGB')).enhance(0.0)
-            r, g, b = img.split()
-            img = Image.merge('RGB', (
-                r.point(lambda i: min(255, int(i * 1.0))),
-                g.point(lambda i: min(255, int(i * 0.95))),
-                b.point(lambda i: min(255, int(i * 0.82)))
-            ))
-        elif filter_type == 'blur':
-            img = img.filter(ImageFilter.BLUR)
-        elif filter_type == 'sharpen':
-            img = img.filter(ImageFilter.SHARPEN)
-        elif filter_type == 'edge':
-            img = img.filter(ImageFilter.FIND_EDGES)
-        elif filter_type == 'emboss':
-            img = img.filter(ImageFilter.EMBOSS)
-        else:
-            raise HTTPException(status_code=400, detail="Invalid filter type")
-        
-        # Save to bytes
-        buf = io.BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
-        
+        headers = {"Content-Disposition": f"attachment; filename=filtered_{file.filename}"}
+        async with spooled_upload(file, "image_tools") as (input_path, digest):
+            cache_key = cache.make_key("image_tools.filter", [digest], filter_type=filter_type)
+            hit = await cache.cached_response(cache_key, headers=headers)
+            if hit is not None:
+                return hit
+            png_bytes = await run_cpu("image_tools", _apply_filter, input_path, filter_type)
+        
+        await cache.store_bytes(cache_key, png_bytes, "image/png")
         return Response(
-            content=buf.getvalue(),
+            content=png_bytes,
             media_type="image/png",
-            headers={"Content-Disposition": f"attachment; filename=filtered_{file.filename}"}
+            headers=headers
         )
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Filter failed: {str(e)}")
 
@@ -68,34 +143,24 @@ async def adjust_image(
 ):
     """Adjust brightness, contrast, saturation"""
     try:
-        contents = await file.read()
-        img = Image.open(io.BytesIO(contents))
-        
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Apply adjustments
-        if brightness != 1.0:
-            enhancer = ImageEnhance.Brightness(img)
-            img = enhancer.enhance(brightness)
-        
-        if contrast != 1.0:
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(contrast)
-        
-        if saturation != 1.0:
-            enhancer = ImageEnhance.Color(img)
-            img = enhancer.enhance(saturation)
-        
-        buf = io.BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
-        
+        headers = {"Content-Disposition": f"attachment; filename=adjusted_{file.filename}"}
+        async with spooled_upload(file, "image_tools") as (input_path, digest):
+            cache_key = cache.make_key(
+                "image_tools.adjust", [digest], brightness=brightness, contrast=contrast, saturation=saturation
+            )
+            hit = await cache.cached_response(cache_key, headers=headers)
+            if hit is not None:
+                return hit
+            png_bytes = await run_cpu("image_tools", _adjust, input_path, brightness, contrast, saturation)
+        
+        await cache.store_bytes(cache_key, png_bytes, "image/png")
         return Response(
-            content=buf.getvalue(),
+            content=png_bytes,
             media_type="image/png",
-            headers={"Content-Disposition": f"attachment; filename=adjusted_{file.filename}"}
+            headers=headers
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Adjustment failed: {str(e)}")
 
@@ -104,21 +169,20 @@ async def adjust_image(
 async def get_exif_data(file: UploadFile = File(...)):
     """Get EXIF metadata from image"""
     try:
-        contents = await file.read()
-        img = Image.open(io.BytesIO(contents))
-        
-        exif_dict = {}
-        if hasattr(img, '_getexif') and img._getexif():
-            exif_data = img._getexif()
-            for tag_id, value in exif_data.items():
-                tag = piexif.TAGS.get(tag_id, tag_id)
-                exif_dict[str(tag)] = str(value)
+        async with spooled_upload(file, "image_tools") as (input_path, digest):
+            cache_key = cache.make_key("image_tools.exif", [digest])
+            exif_dict = await cache.cached_json(cache_key)
+            if exif_dict is None:
+                exif_dict = await run_cpu("image_tools", _read_exif, input_path)
+                await cache.store_json(cache_key, exif_dict)
         
         return JSONResponse(content={
             "filename": file.filename,
             "has_exif": bool(exif_dict),
             "exif_data": exif_dict or {}
         })
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(content={
             "filename": file.filename,
@@ -132,23 +196,22 @@ async def get_exif_data(file: UploadFile = File(...)):
 async def remove_exif(file: UploadFile = File(...)):
     """Remove EXIF data from image"""
     try:
-        contents = await file.read()
-        img = Image.open(io.BytesIO(contents))
-        
-        # Remove EXIF by saving without it
-        data = list(img.getdata())
-        image_without_exif = Image.new(img.mode, img.size)
-        image_without_exif.putdata(data)
-        
-        buf = io.BytesIO()
-        image_without_exif.save(buf, format='PNG')
-        buf.seek(0)
-        
+        headers = {"Content-Disposition": f"attachment; filename=no_exif_{file.filename}"}
+        async with spooled_upload(file, "image_tools") as (input_path, digest):
+            cache_key = cache.make_key("image_tools.strip-exif", [digest])
+            hit = await cache.cached_response(cache_key, headers=headers)
+            if hit is not None:
+                return hit
+            png_bytes = await run_cpu("image_tools", _strip_exif, input_path)
+        
+        await cache.store_bytes(cache_key, png_bytes, "image/png")
         return Response(
-            content=buf.getvalue(),
+            content=png_bytes,
             media_type="image/png",
-            headers={"Content-Disposition": f"attachment; filename=no_exif_{file.filename}"}
+            headers=headers
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"EXIF removal failed: {str(e)}")
 
@@ -160,14 +223,12 @@ async def extract_color_palette(
 ):
     """Extract dominant colors from image"""
     try:
-        contents = await file.read()
-        
-        # Save to temp BytesIO for ColorThief
-        buf = io.BytesIO(contents)
-        color_thief = ColorThief(buf)
-        
-        # Get palette
-        palette = color_thief.get_palette(color_count=color_count, quality=1)
+        async with spooled_upload(file, "image_tools") as (input_path, digest):
+            cache_key = cache.make_key("image_tools.colors", [digest], color_count=color_count)
+            palette = await cache.cached_json(cache_key)
+            if palette is None:
+                palette = await run_cpu("image_tools", _palette, input_path, color_count)
+                await cache.store_json(cache_key, palette)
         
         # Convert to hex
         hex_colors = ['#{:02x}{:02x}{:02x}'.format(r, g, b) for r, g, b in palette]
@@ -183,5 +244,7 @@ async def extract_color_palette(
                 for hex_col, rgb in zip(hex_colors, palette)
             ]
         })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Color extraction failed: {str(e)}")
@@ -1,13 +1,126 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+import asyncio
+import hashlib
+import json
 import os
-import shutil
-import uuid
-from ..config import UPLOAD_DIR, OUTPUT_DIR
+import zipfile
+from typing import List
 from PIL import Image
+from ..config import REMBG_MODEL, REMBG_BATCH_MAX_FILES
+from ..services import cache, storage, background_removal
+from ..services.executor import run_cpu, run_io
+from ..services.uploads import save_upload, max_upload_bytes, read_chunks
+from ..services.zipstream import ZipStream
 
 router = APIRouter()
 
+
+def _convert_image(input_path, output_path, target_format):
+    with Image.open(input_path) as img:
+        print(f"Image opened. Mode: {img.mode}, Size: {img.size}")
+        # Convert to RGB if saving as JPEG (handles transparency)
+        if target_format == "JPEG" and img.mode in ("RGBA", "P"):
+            print("Converting to RGB for JPEG")
+            img = img.convert("RGB")
+        
+        print(f"Saving to {output_path}")
+        img.save(output_path, target_format)
+        print("Save complete")
+
+
+_BATCH_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff", ".gif")
+
+
+def _extract_images(zip_path, limit, max_files):
+    """Unpack the image members of a ZIP into UPLOAD_DIR. Returns [(name, path, sha256)]."""
+    extracted = []
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            for member in zf.infolist():
+                name = os.path.basename(member.filename)
+                if member.is_dir() or name.startswith(".") or not name.lower().endswith(_BATCH_IMAGE_EXTENSIONS):
+                    continue
+                if len(extracted) >= max_files:
+                    raise ValueError(f"Too many images. Maximum is {REMBG_BATCH_MAX_FILES} per batch.")
+                path = storage.upload_path(storage.new_file_id(), name)
+                hasher = hashlib.sha256()
+                with zf.open(member) as src, open(path, "wb") as dst:
+                    # Sizes in the ZIP header can lie, so the limit is enforced on the decompressed bytes
+                    for chunk in read_chunks(src, limit):
+                        hasher.update(chunk)
+                        dst.write(chunk)
+                extracted.append((name, path, hasher.hexdigest()))
+    except BaseException:
+        storage.remove(*[path for _, path, _ in extracted])
+        raise
+    return extracted
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def _remove_one(name, input_path, digest, outputs, use_cache=True):
+    arcname = f"{os.path.splitext(name)[0]}_no_bg.png"
+    cache_key = cache.make_key("images.remove-bg", [digest], model=REMBG_MODEL)
+    cached_path = await cache.cached_path(cache_key) if use_cache else None
+    if cached_path is not None:
+        return arcname, cached_path, None
+
+    output_path = storage.output_path(storage.new_file_id(), arcname)
+    outputs.append(output_path)
+    try:
+        await background_removal.remove_background(input_path, output_path)
+    except Exception as e:
+        return arcname, None, str(e)
+    await cache.store_file(cache_key, output_path, "image/png")
+    return arcname, output_path, None
+
+
+async def _read_removed(item, result, outputs):
+    """The PNG bytes for a finished ``_remove_one``, or ``(arcname, None, error)``."""
+    arcname, path, error = result
+    if error is None:
+        try:
+            return arcname, await run_io("images", _read_file, path), None
+        except FileNotFoundError:
+            # A cached result evicted since the lookup: remove the background again
+            arcname, path, error = await _remove_one(*item, outputs, use_cache=False)
+    if error is not None:
+        return arcname, None, error
+    return arcname, await run_io("images", _read_file, path), None
+
+
+async def _stream_removed(inputs):
+    zip_stream = ZipStream()
+    outputs = []
+    errors = {}
+    # Every image is queued at once; the background removal service batches them across its workers
+    tasks = {asyncio.ensure_future(_remove_one(*item, outputs)): item for item in inputs}
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                # Results are read only when their turn comes, so a slow client doesn't pin them in memory
+                arcname, data, error = await _read_removed(tasks[task], task.result(), outputs)
+                if error is not None:
+                    print(f"Error removing background from {arcname}: {error}")
+                    errors[arcname] = error
+                    continue
+                yield zip_stream.add_bytes(arcname, data)
+        if errors:
+            yield zip_stream.add_bytes("errors.json", json.dumps(errors, indent=2).encode("utf-8"))
+        yield zip_stream.close()
+    finally:
+        # Also reached when the client disconnects mid-stream
+        for task in tasks:
+            task.cancel()
+        storage.remove(*[path for _, path, _ in inputs], *outputs)
+
+
 @router.post("/convert/image")
 async def convert_image(file: UploadFile = File(...), target_format: str = Form(...)):
     valid_formats = ["PNG", "JPEG", "WEBP", "GIF", "BMP", "TIFF", "PDF"]
@@ -16,60 +129,99 @@ async def convert_image(file: UploadFile = File(...), target_format: str = Form(
     if target_format not in valid_formats:
         raise HTTPException(status_code=400, detail=f"Invalid target format. Supported: {', '.join(valid_formats)}")
     
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     
     # Handle JPEG extension
     ext = "jpg" if target_format == "JPEG" else target_format.lower()
     output_filename = f"{os.path.splitext(file.filename)[0]}.{ext}"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    digest = await save_upload(file, "images", input_path)
+    cache_key = cache.make_key("images.convert", [digest], target_format=target_format)
 
     try:
+        hit = await cache.cached_response(cache_key, filename=output_filename)
+        if hit is not None:
+            return hit
+
         print(f"Processing image: {file.filename} -> {target_format}")
-        with Image.open(input_path) as img:
-            print(f"Image opened. Mode: {img.mode}, Size: {img.size}")
-            # Convert to RGB if saving as JPEG (handles transparency)
-            if target_format == "JPEG" and img.mode in ("RGBA", "P"):
-                print("Converting to RGB for JPEG")
-                img = img.convert("RGB")
-            
-            print(f"Saving to {output_path}")
-            img.save(output_path, target_format)
-            print("Save complete")
+        await run_cpu("images", _convert_image, input_path, output_path, target_format)
             
         media_type = f"image/{ext}" if target_format != "PDF" else "application/pdf"
-        return FileResponse(output_path, filename=output_filename, media_type=media_type)
+        await cache.store_file(cache_key, output_path, media_type)
+        return FileResponse(output_path, filename=output_filename, media_type=media_type, background=storage.remove_after(output_path))
     except Exception as e:
         print(f"Error converting image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        storage.remove(input_path)
 
 @router.post("/convert/image/remove-bg")
 async def remove_background(file: UploadFile = File(...)):
-    try:
-        from rembg import remove
-        
-        file_id = str(uuid.uuid4())
-        input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
-        output_filename = f"{os.path.splitext(file.filename)[0]}_no_bg.png"
-        output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
+    output_filename = f"{os.path.splitext(file.filename)[0]}_no_bg.png"
+    output_path = storage.output_path(file_id, output_filename)
+
+    digest = await save_upload(file, "images", input_path)
+    cache_key = cache.make_key("images.remove-bg", [digest], model=REMBG_MODEL)
 
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+    try:
+        hit = await cache.cached_response(cache_key, filename=output_filename)
+        if hit is not None:
+            return hit
 
         print(f"Removing background: {file.filename}")
-        with open(input_path, "rb") as i:
-            with open(output_path, "wb") as o:
-                input_data = i.read()
-                output_data = remove(input_data)
-                o.write(output_data)
+        await background_removal.remove_background(input_path, output_path)
         
         print("Background removed successfully")
-        return FileResponse(output_path, filename=output_filename, media_type="image/png")
+        await cache.store_file(cache_key, output_path, "image/png")
+        return FileResponse(output_path, filename=output_filename, media_type="image/png", background=storage.remove_after(output_path))
     except ImportError:
          raise HTTPException(status_code=500, detail="Server Error: rembg library not installed.")
     except Exception as e:
         print(f"Error removing background: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        storage.remove(input_path)
+
+@router.post("/convert/image/remove-bg/batch")
+async def remove_background_batch(files: List[UploadFile] = File(...)):
+    """
+    Remove the background from many images in one request. Accepts images and/or ZIPs of images.
+    Streams back a ZIP of PNGs in the order they finish; failures are listed in errors.json.
+    """
+    inputs = []
+    try:
+        for file in files:
+            path = storage.upload_path(storage.new_file_id(), file.filename)
+            if file.filename.lower().endswith(".zip"):
+                await save_upload(file, "images_batch", path)
+                try:
+                    inputs.extend(await run_io(
+                        "images", _extract_images, path, max_upload_bytes("images"), REMBG_BATCH_MAX_FILES - len(inputs)
+                    ))
+                finally:
+                    storage.remove(path)
+            else:
+                digest = await save_upload(file, "images", path)
+                inputs.append((file.filename, path, digest))
+                if len(inputs) > REMBG_BATCH_MAX_FILES:
+                    raise ValueError(f"Too many images. Maximum is {REMBG_BATCH_MAX_FILES} per batch.")
+    except HTTPException:
+        storage.remove(*[path for _, path, _ in inputs])
+        raise
+    except (ValueError, zipfile.BadZipFile) as e:
+        storage.remove(*[path for _, path, _ in inputs])
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if not inputs:
+        raise HTTPException(status_code=400, detail="No images found in the upload.")
+
+    print(f"Removing background from {len(inputs)} images")
+    return StreamingResponse(
+        _stream_removed(inputs),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=no_bg_images.zip"},
+    )
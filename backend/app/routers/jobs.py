@@ -0,0 +1,79 @@
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import FileResponse, JSONResponse
+import os
+from ..services import jobs
+from ..services.executor import run_io
+from . import media, documents
+
+router = APIRouter()
+
+# Long-running endpoints that can also be submitted as background jobs.
+# The handler itself is the job body; its form fields are accepted as-is.
+jobs.register("media", media.convert_media)
+jobs.register("media-compress", media.compress_video)
+jobs.register("media-download", media.download_video)
+jobs.register("pdf-to-word", documents.pdf_to_word)
+
+
+def _job_status(job):
+    status = {
+        "id": job["id"],
+        "tool": job["tool"],
+        "state": job["state"],
+        "progress": job["progress"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+    if job["state"] == jobs.FAILED:
+        status["error"] = job["error"]
+    if job["state"] == jobs.DONE:
+        status["result_url"] = f"/jobs/{job['id']}/result"
+    return status
+
+
+@router.post("/jobs/{tool}")
+async def submit_job(tool: str, request: Request):
+    """
+    Queue a long-running conversion and return its job id immediately.
+    Send the same form fields as the synchronous endpoint.
+    """
+    if tool not in jobs.tools():
+        raise HTTPException(status_code=404, detail=f"Unknown tool. Supported: {', '.join(jobs.tools())}")
+
+    form = await request.form()
+    try:
+        params, uploads = jobs.bind_params(tool, form)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job_id = await jobs.submit(tool, params, uploads)
+    return JSONResponse(status_code=202, content={
+        "id": job_id,
+        "state": jobs.QUEUED,
+        "status_url": f"/jobs/{job_id}",
+    })
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Report a job's state and progress"""
+    job = await run_io("default", jobs.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(content=_job_status(job))
+
+
+@router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Stream the finished job's artifact"""
+    job = await run_io("default", jobs.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["state"] == jobs.FAILED:
+        raise HTTPException(status_code=job["status_code"] or 500, detail=job["error"])
+    if job["state"] != jobs.DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['state']}")
+    if not os.path.exists(job["result_path"]):
+        raise HTTPException(status_code=410, detail="Job result has expired")
+
+    return FileResponse(job["result_path"], filename=job["result_filename"], media_type=job["media_type"])
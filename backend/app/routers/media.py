@@ -1,147 +1,590 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+import asyncio
+import csv
+import json
+import math
 import os
-import shutil
-import uuid
 import ffmpeg
-from ..config import UPLOAD_DIR, OUTPUT_DIR
+from ..config import (
+    FFMPEG_PROGRESS_WAIT_SECONDS, CPU_WORKERS, MEDIA_SEGMENT_MIN_SECONDS, MEDIA_SEGMENT_SECONDS, MEDIA_SAMPLE_SECONDS,
+)
+from ..services import cache, storage, probe, ffmpeg_runner, downloader
+from ..services.executor import run_io
+from ..services.uploads import save_upload, spooled_upload
 
 router = APIRouter()
 
+_KEEPALIVE_SECONDS = 15
+
+
+_AUDIO_FORMATS = {"mp3", "wav", "flac", "ogg", "aac"}
+# copy: stream copy everything, audio: copy video and re-encode audio, encode: full re-encode
+_CONVERT_MODES = ["auto", "copy", "audio", "encode"]
+
+
+# Muxer settings for outputs FFmpeg can write to a pipe; MP4 becomes fragmented MP4 so it needs no seeking
+_STREAM_MUXERS = {
+    "mp3": {"f": "mp3"},
+    "ogg": {"f": "ogg"},
+    "aac": {"f": "adts"},
+    "flac": {"f": "flac"},
+    "mp4": {"f": "mp4", "movflags": "frag_keyframe+empty_moov+default_base_moof"},
+}
+
+_MIME_TYPES = {
+    "mp4": "video/mp4", "avi": "video/x-msvideo", "mov": "video/quicktime", "mkv": "video/x-matroska",
+    "m4v": "video/x-m4v", "webm": "video/webm",
+    "mp3": "audio/mpeg", "wav": "audio/wav", "flac": "audio/flac", "ogg": "audio/ogg", "aac": "audio/aac"
+}
+
+
+def _media_type(filename):
+    """MIME type of the container named by ``filename``'s extension."""
+    return _MIME_TYPES.get(os.path.splitext(filename)[1].lower().lstrip("."), "application/octet-stream")
+
+
+def _choose_mode(info, target_format):
+    """Least work that produces a valid ``target_format`` file from the probed input."""
+    audio_ok = not probe.streams(info, "audio") or probe.copyable(info, target_format, "audio")
+    if target_format in _AUDIO_FORMATS or not probe.streams(info, "video"):
+        return "copy" if audio_ok else "encode"
+    if probe.copyable(info, target_format, "video"):
+        return "copy" if audio_ok else "audio"
+    return "encode"
+
+
+# ffprobe's format_name entries for each target container
+_FORMAT_NAMES = {
+    "mp4": "mp4", "mov": "mov", "mkv": "matroska", "avi": "avi",
+    "mp3": "mp3", "wav": "wav", "flac": "flac", "ogg": "ogg", "aac": "aac",
+}
+
+
+def _already_target(info, filename, target_format):
+    """True if the input is already a ``target_format`` file, so converting it would only copy it."""
+    if os.path.splitext(filename)[1].lower().lstrip(".") != target_format:
+        return False
+    if _FORMAT_NAMES[target_format] not in info.get("format", {}).get("format_name", "").split(","):
+        return False
+    return _choose_mode(info, target_format) == "copy"
+
+
+def _convert_args(mode, target_format):
+    if target_format in _AUDIO_FORMATS:
+        return {"vn": None, "acodec": "copy"} if mode == "copy" else {"vn": None}
+    args = {}
+    if mode == "copy":
+        args["c"] = "copy"
+    elif mode == "audio":
+        args["vcodec"] = "copy"
+    if mode != "encode" and target_format != "mkv":
+        # Subtitle codecs rarely carry over between containers as-is
+        args["sn"] = None
+    return args
+
+
+async def _stream_conversion(input_path, output_args, task_id, duration):
+    async with ffmpeg_runner.task(task_id, duration) as progress:
+        output = ffmpeg.output(ffmpeg.input(input_path), "pipe:1", **output_args)
+        async for chunk in ffmpeg_runner.stream_output(output, progress):
+            yield chunk
+
+
+async def _continue_stream(first_chunk, chunks, input_path, filename):
+    # Owns the input from here on: it is removed once the stream ends, fails or the client leaves
+    try:
+        yield first_chunk
+        async for chunk in chunks:
+            yield chunk
+    except Exception as e:
+        if isinstance(e, ffmpeg.Error):
+            detail = e.stderr.decode("utf8", "replace")
+        else:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+        print(f"Streaming conversion of {filename} failed: {detail}")
+        # The status line is long gone; re-raising makes the server drop the connection instead of
+        # ending the chunked body cleanly, so the client can't take a truncated file for a success
+        raise
+    finally:
+        await chunks.aclose()
+        storage.remove(input_path)
+
+
+async def _start_stream(input_path, target_format, chosen_mode, task_id, duration):
+    """Start a streamed conversion and wait for its first bytes, so failures up to then are still real errors."""
+    output_args = {**_convert_args(chosen_mode, target_format), **_STREAM_MUXERS[target_format]}
+    chunks = _stream_conversion(input_path, output_args, task_id, duration)
+    try:
+        first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = b""
+    return first_chunk, chunks
+
+
 @router.post("/convert/media")
-async def convert_media(file: UploadFile = File(...), target_format: str = Form(...)):
+async def convert_media(
+    file: UploadFile = File(...),
+    target_format: str = Form(...),
+    mode: str = Form("auto"),
+    task_id: str = Form(""),
+    stream: bool = Form(False),
+):
+    """
+    Convert audio/video. ``mode`` is auto (probe the input and copy streams where the target
+    container allows it), copy, audio (copy video, re-encode audio) or encode.
+    Progress for ``task_id`` is available from /media/progress/{task_id}.
+
+    With ``stream`` the output is sent while FFmpeg is still encoding (mp3/ogg/aac/flac, and mp4 as
+    fragmented MP4) instead of after the whole file has been written.
+    """
     # Basic validation
     valid_formats = ["mp4", "avi", "mov", "mkv", "mp3", "wav", "flac", "ogg", "aac"]
     target_format = target_format.lower()
+    mode = mode.lower()
     
     if target_format not in valid_formats:
         raise HTTPException(status_code=400, detail=f"Invalid target format. Supported: {', '.join(valid_formats)}")
+    if mode not in _CONVERT_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mode. Supported: {', '.join(_CONVERT_MODES)}")
+    if stream and target_format not in _STREAM_MUXERS:
+        raise HTTPException(status_code=400, detail=f"Streaming is supported for: {', '.join(_STREAM_MUXERS)}")
     
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"{os.path.splitext(file.filename)[0]}.{target_format}"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    digest = await save_upload(file, "media", input_path)
+    cache_key = cache.make_key("media.convert", [digest], target_format=target_format, mode=mode)
+    streaming = False
 
     try:
+        hit = await cache.cached_response(cache_key, filename=output_filename)
+        if hit is not None:
+            return hit
+
+        info = await probe.cached_probe(input_path, digest)
+        if mode == "auto" and _already_target(info, file.filename, target_format):
+            # Nothing to convert: hand the upload back instead of remuxing it
+            os.replace(input_path, output_path)
+            return FileResponse(
+                output_path, filename=file.filename, media_type=_media_type(file.filename),
+                headers={"X-Conversion-Mode": "none"}, background=storage.remove_after(output_path),
+            )
+        chosen_mode = _choose_mode(info, target_format) if mode == "auto" else mode
+        print(f"Converting {file.filename} -> {target_format} ({chosen_mode})")
+        media_type = _MIME_TYPES.get(target_format, "application/octet-stream")
+
+        if stream:
+            try:
+                first_chunk, chunks = await _start_stream(input_path, target_format, chosen_mode, task_id, probe.duration(info))
+            except ffmpeg.Error:
+                if mode != "auto" or chosen_mode == "encode":
+                    raise
+                print(f"Stream copy failed for {file.filename}, re-encoding")
+                chosen_mode = "encode"
+                first_chunk, chunks = await _start_stream(input_path, target_format, chosen_mode, task_id, probe.duration(info))
+            streaming = True
+            # Streamed output never lands on disk, so it isn't added to the result cache
+            return StreamingResponse(
+                _continue_stream(first_chunk, chunks, input_path, file.filename),
+                media_type=media_type,
+                headers={
+                    "Content-Disposition": f'attachment; filename="{output_filename}"',
+                    "X-Conversion-Mode": chosen_mode,
+                },
+            )
+
         # Use ffmpeg-python to handle the conversion
-        stream = ffmpeg.input(input_path)
-        stream = ffmpeg.output(stream, output_path)
-        ffmpeg.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
-        
-        # Determine MIME type
-        mime_types = {
-            "mp4": "video/mp4", "avi": "video/x-msvideo", "mov": "video/quicktime", "mkv": "video/x-matroska",
-            "mp3": "audio/mpeg", "wav": "audio/wav", "flac": "audio/flac", "ogg": "audio/ogg", "aac": "audio/aac"
-        }
-        media_type = mime_types.get(target_format, "application/octet-stream")
+        source = ffmpeg.input(input_path)
+        async with ffmpeg_runner.task(task_id, probe.duration(info)) as progress:
+            try:
+                await ffmpeg_runner.run(ffmpeg.output(source, output_path, **_convert_args(chosen_mode, target_format)), progress)
+            except ffmpeg.Error:
+                if mode != "auto" or chosen_mode == "encode":
+                    raise
+                # Compatible codecs can still fail to remux (e.g. odd timestamps); fall back to a re-encode
+                print(f"Stream copy failed for {file.filename}, re-encoding")
+                chosen_mode = "encode"
+                await ffmpeg_runner.run(ffmpeg.output(source, output_path, **_convert_args(chosen_mode, target_format)), progress)
         
-        return FileResponse(output_path, filename=output_filename, media_type=media_type)
+        await cache.store_file(cache_key, output_path, media_type)
+        return FileResponse(
+            output_path, filename=output_filename, media_type=media_type,
+            headers={"X-Conversion-Mode": chosen_mode}, background=storage.remove_after(output_path),
+        )
+    except HTTPException:
+        raise
     except ffmpeg.Error as e:
         error_message = e.stderr.decode('utf8') if e.stderr else str(e)
         raise HTTPException(status_code=500, detail=f"FFmpeg Error: {error_message}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if not streaming:
+            storage.remove(input_path)
 
 @router.post("/convert/media/download")
 async def download_video(url: str = Form(...), format: str = Form("mp4")):
-    import yt_dlp
-    import socket
-    
-    # Pre-flight DNS and connectivity check
-    import requests
+    """
+    Download a video (mp4) or its audio with yt-dlp. Results are cached per video and format, and
+    concurrent requests for the same one share a single download.
+    """
+    media_type = f"video/{format}" if format == 'mp4' else f"audio/{format}"
     try:
-        # Test DNS resolution first
-        socket.gethostbyname('www.youtube.com')
-        # Test HTTPS connectivity
-        requests.get("https://www.youtube.com", timeout=10)
-    except socket.gaierror as e:
-        raise HTTPException(
-            status_code=500, 
-            detail=f"DNS Resolution Error: Cannot resolve domain names. This usually means:\n"
-                   f"1. Docker container has no internet access\n"
-                   f"2. DNS servers are not configured\n"
-                   f"3. Firewall is blocking connections\n\n"
-                   f"Fix: Run 'docker run --dns 8.8.8.8 --dns 8.8.4.4 ...' or check your network settings.\n"
-                   f"Technical details: {str(e)}"
-        )
+        hit = await downloader.cached(url, format)
+        if hit is not None:
+            return hit
+
+        await downloader.ensure_online()
+        final_path, cleanup = await downloader.download(url, format, media_type)
+        return FileResponse(final_path, filename=os.path.basename(final_path), media_type=media_type, background=cleanup)
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(
-            status_code=500, 
-            detail=f"Network Error: Cannot connect to the internet. Details: {str(e)}"
+        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+
+# Containers the concat demuxer output can be stream-copied into
+_SEGMENTABLE_EXTENSIONS = (".mp4", ".m4v", ".mov", ".mkv")
+_SEGMENTED_MODES = ["auto", "on", "off"]
+
+
+def _use_segments(segmented, info, output_filename):
+    if segmented == "off" or not probe.streams(info, "video"):
+        return False
+    if not output_filename.lower().endswith(_SEGMENTABLE_EXTENSIONS):
+        return False
+    if segmented == "on":
+        return True
+    # Splitting and joining cost a few seconds; only worth it when several cores can share a long encode
+    return CPU_WORKERS > 1 and (probe.duration(info) or 0) >= MEDIA_SEGMENT_MIN_SECONDS
+
+
+def _read_segment_list(list_path, work_dir):
+    """Parse the segment muxer's CSV list into [(path, duration)]."""
+    segments = []
+    with open(list_path, newline="") as f:
+        for row in csv.reader(f):
+            if len(row) >= 3:
+                segments.append((os.path.join(work_dir, os.path.basename(row[0])), float(row[2]) - float(row[1])))
+    return segments
+
+
+def _write_concat_list(list_path, paths):
+    with open(list_path, "w") as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+
+async def _compress_segmented(input_path, output_path, crf, info, progress):
+    """
+    Cut the video at keyframes (stream copy), encode the segments in parallel, encode the audio
+    once alongside them, then join everything with the concat demuxer without re-encoding.
+    Returns the number of segments, or 0 when the split produced none and nothing was encoded.
+    """
+    work_dir = storage.output_path(storage.new_file_id())
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        # At least a few segments per worker so a slow segment doesn't leave the others idle
+        segment_time = max(MEDIA_SEGMENT_SECONDS, (probe.duration(info) or 0) / (4 * CPU_WORKERS))
+        list_path = os.path.join(work_dir, "segments.csv")
+        split = ffmpeg.output(
+            ffmpeg.input(input_path)["v:0"], os.path.join(work_dir, "part%05d.mkv"),
+            c="copy", f="segment", segment_time=segment_time,
+            segment_list=list_path, segment_list_type="csv", reset_timestamps=1,
         )
-    
-    file_id = str(uuid.uuid4())
-    output_template = os.path.join(OUTPUT_DIR, f"{file_id}_%(title)s.%(ext)s")
-    
-    ydl_opts = {
-        'format': 'bestvideo+bestaudio/best' if format == 'mp4' else 'bestaudio/best',
-        'outtmpl': output_template,
-        'postprocessors': [{'key': 'FFmpegVideoConvertor', 'preferedformat': format}] if format == 'mp4' else [{'key': 'FFmpegExtractAudio', 'preferredcodec': format}],
-        'quiet': False,  # Changed to False for better error messages
-        'no_warnings': False,
-        'verbose': True,
-        'force_ipv4': True,
-        'socket_timeout': 30,
-        'retries': 3,
-        'fragment_retries': 3,
-        'source_address': '0.0.0.0',  # Bind to all interfaces
-        'nocheckcertificate': False,
-        'prefer_insecure': False,
-    }
+        await ffmpeg_runner.run(split, progress, offset=0.0, span=0.05)
+        segments = await run_io("media", _read_segment_list, list_path, work_dir)
+        if not segments:
+            # e.g. a video stream without packets; the caller encodes the file in one go instead
+            return 0
+
+        # Spread x264's threads over the segments that run at the same time
+        threads = max(1, CPU_WORKERS // min(len(segments), CPU_WORKERS))
+        encoded_paths = [f"{path}.x264.mkv" for path, _ in segments]
+        runs = [
+            (ffmpeg.output(ffmpeg.input(path), encoded, vcodec="libx264", crf=crf, preset="fast", threads=threads), duration)
+            for (path, duration), encoded in zip(segments, encoded_paths)
+        ]
+
+        audio_path = None
+        audio_task = None
+        if probe.streams(info, "audio"):
+            audio_path = os.path.join(work_dir, "audio.m4a")
+            audio = ffmpeg.output(ffmpeg.input(input_path)["a"], audio_path, acodec="aac")
+            # Audio is quick next to the video; it doesn't count towards progress
+            audio_task = asyncio.ensure_future(
+                ffmpeg_runner.run(audio, progress, "media_segments", on_block=lambda raw: None)
+            )
+        try:
+            await ffmpeg_runner.run_parallel(runs, progress, "media_segments", offset=0.05, span=0.9)
+            if audio_task is not None:
+                await audio_task
+        except BaseException:
+            if audio_task is not None:
+                audio_task.cancel()
+            raise
+
+        concat_list = os.path.join(work_dir, "concat.txt")
+        await run_io("media", _write_concat_list, concat_list, encoded_paths)
+        streams = [ffmpeg.input(concat_list, f="concat", safe=0)["v"]]
+        if audio_path is not None:
+            streams.append(ffmpeg.input(audio_path)["a"])
+        await ffmpeg_runner.run(ffmpeg.output(*streams, output_path, c="copy"), progress, offset=0.95, span=0.05)
+        return len(segments)
+    finally:
+        storage.remove(work_dir)
+
 
+_TARGET_METHODS = ["two-pass", "sample"]
+_MAX_AUDIO_KBPS = 128
+_MIN_VIDEO_KBPS = 50
+# CRF the calibration sample is encoded at; x264's bitrate roughly halves for every +6 CRF
+_SAMPLE_CRF = 23
+
+
+def _target_bitrates(info, target_size_mb, target_bitrate):
+    """Split the size/bitrate budget into (video kbps, audio kbps)."""
+    duration = probe.duration(info)
+    if target_bitrate:
+        total = target_bitrate
+    elif duration:
+        # MB -> kbit, keeping ~2% for container overhead
+        total = target_size_mb * 8388.608 * 0.98 / duration
+    else:
+        raise HTTPException(status_code=400, detail="Could not read the video duration to size the output.")
+
+    audio = min(_MAX_AUDIO_KBPS, max(32, int(total * 0.1))) if probe.streams(info, "audio") else 0
+    video = int(total - audio)
+    if video < _MIN_VIDEO_KBPS:
+        raise HTTPException(status_code=400, detail=f"Target is too small: it leaves {max(video, 0)} kbps for the video.")
+    return video, audio
+
+
+def _within_target(info, input_path, target_size_mb, target_bitrate):
+    if not probe.streams(info, "video"):
+        return False
+    if target_size_mb:
+        return os.path.getsize(input_path) <= target_size_mb * 1024 * 1024
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            
-            # Adjust filename extension if post-processing changed it
-            base, _ = os.path.splitext(filename)
-            final_path = f"{base}.{format}"
-            
-            if not os.path.exists(final_path):
-                # Fallback if filename didn't change as expected or if original was kept
-                if os.path.exists(filename):
-                    final_path = filename
-                else:
-                     # Try to find the file with the expected ID prefix
-                    for f in os.listdir(OUTPUT_DIR):
-                        if f.startswith(file_id) and f.endswith(f".{format}"):
-                            final_path = os.path.join(OUTPUT_DIR, f)
-                            break
-            
-            if not os.path.exists(final_path):
-                 raise HTTPException(status_code=500, detail="Downloaded file not found")
+        return int(info.get("format", {}).get("bit_rate")) <= target_bitrate * 1000
+    except (TypeError, ValueError):
+        return False
 
-            return FileResponse(final_path, filename=os.path.basename(final_path), media_type=f"video/{format}" if format == 'mp4' else f"audio/{format}")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+def _audio_args(audio_kbps):
+    return {"acodec": "aac", "audio_bitrate": f"{audio_kbps}k"} if audio_kbps else {}
+
+
+def _sample_crf(sample_path, sample_seconds, video_kbps):
+    sample_kbps = os.path.getsize(sample_path) * 8 / 1000 / sample_seconds
+    crf = _SAMPLE_CRF + 6 * math.log2(max(sample_kbps, 1) / video_kbps)
+    return int(min(51, max(0, round(crf))))
+
+
+async def _compress_to_target(input_path, output_path, info, video_kbps, audio_kbps, method, progress):
+    """
+    Hit a bitrate in one request. two-pass: an analysis pass then a bitrate-targeted encode.
+    sample: encode a short clip at a reference CRF, derive the CRF for the target from its bitrate,
+    then do one capped-CRF encode, about half the work of two passes.
+    """
+    work_dir = storage.output_path(storage.new_file_id())
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        if method == "two-pass":
+            passlog = os.path.join(work_dir, "x264")
+            video_args = {"vcodec": "libx264", "video_bitrate": f"{video_kbps}k", "preset": "fast", "passlogfile": passlog}
+            first = ffmpeg.output(ffmpeg.input(input_path)["v:0"], os.devnull, f="null", **video_args, **{"pass": 1})
+            await ffmpeg_runner.run(first, progress, offset=0.0, span=0.4)
+            second = ffmpeg.output(ffmpeg.input(input_path), output_path, **video_args, **{"pass": 2}, **_audio_args(audio_kbps))
+            await ffmpeg_runner.run(second, progress, offset=0.4, span=0.6)
+            return None
+
+        duration = probe.duration(info) or MEDIA_SAMPLE_SECONDS
+        sample_seconds = min(MEDIA_SAMPLE_SECONDS, duration)
+        sample_path = os.path.join(work_dir, "sample.mkv")
+        # From the middle of the video, which is more representative than the intro
+        sample = ffmpeg.output(
+            ffmpeg.input(input_path, ss=max(0, duration / 2 - sample_seconds / 2), t=sample_seconds)["v:0"],
+            sample_path, vcodec="libx264", crf=_SAMPLE_CRF, preset="fast",
+        )
+        await ffmpeg_runner.run(sample, progress, on_block=lambda raw: None)
+        crf = await run_io("media", _sample_crf, sample_path, sample_seconds, video_kbps)
+        print(f"Sample encode picked CRF {crf} for {video_kbps} kbps")
+        # maxrate/bufsize keep complex scenes from overshooting the size the sample predicted
+        encode = ffmpeg.output(
+            ffmpeg.input(input_path), output_path, vcodec="libx264", crf=crf, preset="fast",
+            maxrate=f"{video_kbps}k", bufsize=f"{2 * video_kbps}k", **_audio_args(audio_kbps),
+        )
+        await ffmpeg_runner.run(encode, progress, offset=0.1, span=0.9)
+        return crf
+    finally:
+        storage.remove(work_dir)
+
 
 @router.post("/convert/media/compress")
-async def compress_video(file: UploadFile = File(...), crf: int = Form(28)):
+async def compress_video(
+    file: UploadFile = File(...),
+    crf: int = Form(28),
+    task_id: str = Form(""),
+    segmented: str = Form("auto"),
+    target_size_mb: float = Form(0),
+    target_bitrate: int = Form(0),
+    method: str = Form("two-pass"),
+):
+    """
+    Re-encode a video with libx264 at ``crf``. ``segmented`` (auto/on/off) encodes keyframe-aligned
+    segments in parallel; auto uses it for long videos when more than one core is available.
+
+    With ``target_size_mb`` or ``target_bitrate`` (kbps) the output is sized instead, using ``method``
+    two-pass (most accurate) or sample (a short calibration encode picks the CRF).
+    """
+    segmented = segmented.lower()
+    method = method.lower()
+    if segmented not in _SEGMENTED_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid segmented mode. Supported: {', '.join(_SEGMENTED_MODES)}")
+    if method not in _TARGET_METHODS:
+        raise HTTPException(status_code=400, detail=f"Invalid method. Supported: {', '.join(_TARGET_METHODS)}")
+    if target_size_mb < 0 or target_bitrate < 0:
+        raise HTTPException(status_code=400, detail="Target size and bitrate must be positive.")
+
     # CRF 28 is a good default for compression (lower is better quality, higher is smaller size)
     # Range 0-51, 18-28 is sane.
     
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"compressed_{file.filename}"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
+    # FFmpeg picks the muxer from the extension, so the output stays in the upload's container
+    media_type = _media_type(output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    digest = await save_upload(file, "media", input_path)
+    targeted = bool(target_size_mb or target_bitrate)
+    if targeted:
+        cache_key = cache.make_key(
+            "media.compress", [digest], target_size_mb=target_size_mb, target_bitrate=target_bitrate, method=method
+        )
+    else:
+        cache_key = cache.make_key("media.compress", [digest], crf=crf)
 
     try:
-        stream = ffmpeg.input(input_path)
-        # Use libx264 for compatibility and CRF for compression
-        stream = ffmpeg.output(stream, output_path, vcodec='libx264', crf=crf, preset='fast')
-        ffmpeg.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
+        hit = await cache.cached_response(cache_key, filename=output_filename)
+        if hit is not None:
+            return hit
+
+        info = await probe.cached_probe(input_path, digest)
+        if targeted and _within_target(info, input_path, target_size_mb, target_bitrate):
+            # Re-encoding would only lose quality; the upload already fits
+            os.replace(input_path, output_path)
+            return FileResponse(
+                output_path, filename=output_filename, media_type=media_type,
+                headers={"X-Compression": "skipped"}, background=storage.remove_after(output_path),
+            )
+        headers = {}
+        async with ffmpeg_runner.task(task_id, probe.duration(info)) as progress:
+            if targeted:
+                video_kbps, audio_kbps = _target_bitrates(info, target_size_mb, target_bitrate)
+                picked_crf = await _compress_to_target(input_path, output_path, info, video_kbps, audio_kbps, method, progress)
+                headers["X-Target-Video-Bitrate"] = f"{video_kbps}k"
+                if picked_crf is not None:
+                    headers["X-Picked-CRF"] = str(picked_crf)
+            else:
+                segment_count = 0
+                if _use_segments(segmented, info, output_filename):
+                    segment_count = await _compress_segmented(input_path, output_path, crf, info, progress)
+                if segment_count:
+                    print(f"Compressed {file.filename} in {segment_count} parallel segments")
+                    headers["X-Compression-Segments"] = str(segment_count)
+                else:
+                    stream = ffmpeg.input(input_path)
+                    # Use libx264 for compatibility and CRF for compression
+                    stream = ffmpeg.output(stream, output_path, vcodec='libx264', crf=crf, preset='fast')
+                    await ffmpeg_runner.run(stream, progress)
         
-        return FileResponse(output_path, filename=output_filename, media_type="video/mp4")
+        await cache.store_file(cache_key, output_path, media_type)
+        return FileResponse(output_path, filename=output_filename, media_type=media_type, headers=headers, background=storage.remove_after(output_path))
+    except HTTPException:
+        raise
     except ffmpeg.Error as e:
         error_message = e.stderr.decode('utf8') if e.stderr else str(e)
         raise HTTPException(status_code=500, detail=f"Compression Error: {error_message}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        storage.remove(input_path)
+
+
+@router.post("/media/probe")
+async def probe_media(file: UploadFile = File(...)):
+    """Container, streams, codecs, duration, bitrate and keyframe interval of an audio/video file."""
+    try:
+        async with spooled_upload(file, "media") as (input_path, digest):
+            info = await probe.cached_probe(input_path, digest)
+        return JSONResponse(content={"filename": file.filename, **probe.summarize(info)})
+    except HTTPException:
+        raise
+    except ffmpeg.Error as e:
+        error_message = e.stderr.decode('utf8') if e.stderr else str(e)
+        raise HTTPException(status_code=400, detail=f"Could not read media file: {error_message}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _progress_updates(task_id):
+    """Yield progress snapshots for ``task_id`` until it finishes, and None as a keep-alive tick."""
+    progress = ffmpeg_runner.get_or_create(task_id)
+    waited = 0
+    try:
+        yield progress.snapshot()
+        while progress.state not in ffmpeg_runner.FINISHED:
+            if await progress.wait(_KEEPALIVE_SECONDS):
+                yield progress.snapshot()
+                continue
+            if progress.state == ffmpeg_runner.PENDING:
+                # The upload may still be running; give up eventually if the task never starts
+                waited += _KEEPALIVE_SECONDS
+                if waited >= FFMPEG_PROGRESS_WAIT_SECONDS:
+                    return
+            yield None
+    finally:
+        ffmpeg_runner.forget_if_pending(task_id)
+
+
+@router.get("/media/progress/{task_id}")
+async def media_progress(task_id: str):
+    """Server-Sent Events stream of a conversion's progress (frame, time, speed, percent, eta)"""
+    async def events():
+        async for snapshot in _progress_updates(task_id):
+            if snapshot is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"data: {json.dumps(snapshot)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/media/progress/{task_id}/ws")
+async def media_progress_ws(websocket: WebSocket, task_id: str):
+    """WebSocket variant of /media/progress/{task_id}; sends one JSON message per update"""
+    await websocket.accept()
+    try:
+        async for snapshot in _progress_updates(task_id):
+            if snapshot is not None:
+                await websocket.send_json(snapshot)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
+@router.post("/media/tasks/{task_id}/cancel")
+async def cancel_media_task(task_id: str):
+    """Cancel a conversion: kills its FFmpeg process and frees the slot"""
+    if not ffmpeg_runner.cancel(task_id):
+        raise HTTPException(status_code=404, detail="No running conversion with this id")
+    return {"task_id": task_id, "state": "cancelling"}
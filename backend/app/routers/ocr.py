@@ -2,11 +2,35 @@ from fastapi import APIRouter, UploadFile, File, HTTPException
 from fastapi.responses import JSONResponse
 import pytesseract
 from PIL import Image
-import io
 import os
+from ..services.executor import run_io
+from ..services.uploads import spooled_upload
 
 router = APIRouter()
 
+
+def _load_rgb(input_path):
+    image = Image.open(input_path)
+    
+    # Convert to RGB if necessary (for transparency)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
+        image = background
+    return image
+
+
+# Tesseract runs as a subprocess, so OCR goes to the I/O pool (we only wait on it)
+def _image_to_text(input_path):
+    return pytesseract.image_to_string(_load_rgb(input_path), lang='eng')
+
+
+def _image_to_pdf(input_path):
+    return pytesseract.image_to_pdf_or_hocr(_load_rgb(input_path), extension='pdf')
+
+
 @router.post("/convert/ocr/extract")
 async def extract_text_from_image(file: UploadFile = File(...)):
     """
@@ -24,21 +48,10 @@ async def extract_text_from_image(file: UploadFile = File(...)):
                 detail=f"Unsupported file type. Allowed: {', '.join(allowed_extensions)}"
             )
         
-        # Read image file
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Convert to RGB if necessary (for transparency)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
-            image = background
-        
         # Perform OCR
         try:
-            extracted_text = pytesseract.image_to_string(image, lang='eng')
+            async with spooled_upload(file, "ocr") as (input_path, _):
+                extracted_text = await run_io("ocr", _image_to_text, input_path)
         except pytesseract.TesseractNotFoundError:
             raise HTTPException(
                 status_code=500,
@@ -76,20 +89,9 @@ async def create_searchable_pdf(file: UploadFile = File(...)):
                 detail=f"Unsupported file type. Allowed: {', '.join(allowed_extensions)}"
             )
         
-        # Read image file
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Convert to RGB
-        if image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
-            image = background
-        
         # Create searchable PDF using pytesseract
-        pdf_bytes = pytesseract.image_to_pdf_or_hocr(image, extension='pdf')
+        async with spooled_upload(file, "ocr") as (input_path, _):
+            pdf_bytes = await run_io("ocr", _image_to_pdf, input_path)
         
         # Return PDF
         from fastapi.responses import Response
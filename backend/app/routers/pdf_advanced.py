@@ -1,81 +1,219 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import Response, JSONResponse
-from PyPDF2 import PdfReader, PdfWriter, PdfMerger
-import io
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+import asyncio
 import os
-from typing import List
+import zipfile
+from ..config import CPU_WORKERS, PDF_RENDER_SHARD_PAGES, PDF_RENDER_MAX_DPI
+from ..services import cache, pdf, storage, zipstream
+from ..services.executor import run_cpu
+from ..services.uploads import save_upload, spooled_upload
 
 router = APIRouter()
 
-@router.post("/convert/pdf/merge")
-async def merge_pdfs(files: List[UploadFile] = File(...)):
+_THUMBNAIL_MAX_WIDTH = 1024
+
+
+async def _page_indices(input_path, digest, pages):
     """
-    Merge multiple PDF files into one
+    Pages to work on, from a "1-3,5" spec (all if empty), and ``pdf.page_geometry``. The geometry
+    is cached by content hash, so a fully cached request doesn't open the PDF at all.
     """
+    cache_key = cache.make_key("pdf.page_areas", [digest])
+    geometry = await cache.cached_json(cache_key)
+    if geometry is None:
+        geometry = await run_cpu("pdf", pdf.page_geometry, input_path)
+        await cache.store_json(cache_key, geometry)
+    page_count = geometry["page_count"]
+    indices = pdf.parse_pages(pages, page_count) if pages.strip() else list(range(page_count))
+    if not indices:
+        raise ValueError(f"No pages selected. The document has {page_count} pages.")
+    return indices, geometry
+
+
+def _start_rendering(input_path, indices, work_dir, **options):
+    """Render ``indices`` in shards across the process pool; returns {index: task of its shard}."""
+    tasks = {}
+    for start in range(0, len(indices), PDF_RENDER_SHARD_PAGES):
+        shard = indices[start:start + PDF_RENDER_SHARD_PAGES]
+        task = asyncio.ensure_future(run_cpu("pdf_pages", pdf.render_pages, input_path, shard, work_dir=work_dir, **options))
+        tasks.update((index, task) for index in shard)
+    return tasks
+
+
+async def _rendered_path(index, paths, tasks, cache_keys, media_type):
+    if paths.get(index) is None:
+        paths[index] = (await tasks[index])[index]
+        await cache.store_file(cache_keys.get(index), paths[index], media_type)
+    return paths[index]
+
+
+async def _stream_pages(indices, paths, tasks, cache_keys, media_type, name_for, *cleanup):
+    # Images are already compressed, so members are stored; pages go out in order as their shards finish
+    zip_stream = zipstream.ZipStream(zipfile.ZIP_STORED)
     try:
-        if len(files) < 2:
-            raise HTTPException(status_code=400, detail="At least 2 PDF files required")
-        
-        merger = PdfMerger()
-        
-        for file in files:
-            contents = await file.read()
-            pdf_stream = io.BytesIO(contents)
-            merger.append(pdf_stream)
-        
-        output = io.BytesIO()
-        merger.write(output)
-        merger.close()
-        output.seek(0)
-        
-        return Response(
-            content=output.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": "attachment; filename=merged.pdf"}
+        for index in indices:
+            path = await _rendered_path(index, paths, tasks, cache_keys, media_type)
+            async for data in iterate_in_threadpool(zip_stream.add_file(name_for(index), path)):
+                yield data
+        yield zip_stream.close()
+    finally:
+        # Also reached when the client disconnects mid-stream
+        for task in set(tasks.values()):
+            task.cancel()
+        storage.remove(*cleanup)
+
+
+async def _render_response(file, pages, image_format, tool, headers=None, **options):
+    """
+    Render the selected pages of ``file``: one page comes back as an image, several as a streamed
+    ZIP. With a cache ``tool``, every page is cached by content hash, page and ``options``.
+    """
+    if image_format not in pdf.RASTER_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Supported: {', '.join(pdf.RASTER_FORMATS)}")
+    extension, media_type = pdf.RASTER_FORMATS[image_format]
+    if image_format == "png":
+        options.pop("quality", None)
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename or "upload.pdf")
+    work_dir = storage.output_path(file_id)
+    digest = await save_upload(file, "pdf", input_path)
+
+    try:
+        indices, geometry = await _page_indices(input_path, digest, pages)
+        if "dpi" in options:
+            # Fail before streaming starts rather than partway through the ZIP; only the selected
+            # pages count, so a large page elsewhere in the document doesn't block the request
+            largest = max(indices, key=lambda index: geometry["areas"][index])
+            pdf.check_render_size(geometry["areas"][largest], options["dpi"] / 72, f"Page {largest + 1}")
+        cache_keys, paths = {}, {}
+        if tool:
+            cache_keys = {index: cache.make_key(tool, [digest], page=index, format=image_format, **options) for index in indices}
+            for index in indices:
+                paths[index] = await cache.cached_path(cache_keys[index])
+        missing = [index for index in indices if paths.get(index) is None]
+        os.makedirs(work_dir, exist_ok=True)
+        tasks = _start_rendering(input_path, missing, work_dir, image_format=image_format, **options)
+    except BaseException as e:
+        storage.remove(input_path, work_dir)
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+
+    stem = os.path.splitext(file.filename or "document")[0]
+    digits = len(str(geometry["page_count"]))
+    headers = {**(headers or {}), "X-Page-Count": str(len(indices)), "X-Cached-Pages": str(len(indices) - len(missing))}
+    print(f"Rendering {len(missing)} of {len(indices)} pages of {file.filename} ({image_format})")
+
+    if len(indices) == 1:
+        try:
+            path = await _rendered_path(indices[0], paths, tasks, cache_keys, media_type)
+        except BaseException as e:
+            storage.remove(input_path, work_dir)
+            if isinstance(e, ValueError):
+                raise HTTPException(status_code=400, detail=str(e))
+            raise
+        storage.remove(input_path)
+        return FileResponse(
+            path, filename=f"{stem}_page_{indices[0] + 1}.{extension}", media_type=media_type,
+            headers=headers, background=storage.remove_after(work_dir),
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"PDF merge failed: {str(e)}")
+    return StreamingResponse(
+        _stream_pages(
+            indices, paths, tasks, cache_keys, media_type,
+            lambda index: f"{stem}_page_{index + 1:0{digits}}.{extension}", input_path, work_dir,
+        ),
+        media_type="application/zip",
+        headers={**headers, "Content-Disposition": f'attachment; filename="{stem}_images.zip"'},
+    )
+
+
+async def _stream_parts(tasks, *cleanup):
+    zip_stream = zipstream.ZipStream(zipfile.ZIP_STORED)
+    try:
+        # Parts go out in order, each shard as soon as it is written
+        for task in tasks:
+            for filename, path in await task:
+                async for data in iterate_in_threadpool(zip_stream.add_file(filename, path)):
+                    yield data
+        yield zip_stream.close()
+    finally:
+        # Also reached when the client disconnects mid-stream
+        for task in tasks:
+            task.cancel()
+        storage.remove(*cleanup)
 
 
 @router.post("/convert/pdf/split")
 async def split_pdf(
     file: UploadFile = File(...),
-    pages: str = Form(...)  # Format: "1-3,5,7-9"
+    pages: str = Form(""),  # Format: "1-3,5,7-9"
+    mode: str = Form("pages"),  # pages, every, bookmarks, size
+    every: int = Form(1),
+    level: int = Form(1),
+    max_size_mb: float = Form(10)
 ):
     """
-    Split PDF and extract specific pages
-    Format: "1-3,5,7-9" extracts pages 1,2,3,5,7,8,9
+    Split a PDF. ``mode`` "pages" extracts ``pages`` ("1-3,5,7-9") into one PDF. The other modes
+    return a streamed ZIP of parts: "every" ``every`` pages, "bookmarks" at each outline entry of
+    ``level``, or "size" in parts of at most ``max_size_mb`` (a single larger page stays whole).
     """
+    mode = mode.lower()
+    if mode == "pages":
+        if not pages.strip():
+            raise HTTPException(status_code=400, detail="pages is required, e.g. 1-3,5,7-9.")
+        try:
+            output_path = storage.output_path(storage.new_file_id(), "split_pages.pdf")
+            async with spooled_upload(file, "pdf") as (input_path, _):
+                await run_cpu("pdf", pdf.select_pages, input_path, pages, output_path)
+            
+            return FileResponse(
+                output_path, filename="split_pages.pdf", media_type="application/pdf",
+                background=storage.remove_after(output_path),
+            )
+        except HTTPException:
+            raise
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"PDF split failed: {str(e)}")
+
+    if mode not in pdf.SPLIT_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of pages, {', '.join(pdf.SPLIT_MODES)}.")
+    max_bytes = int(max_size_mb * 1024 * 1024) if mode == "size" else None
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename or "upload.pdf")
+    work_dir = storage.output_path(file_id)
+    await save_upload(file, "pdf", input_path)
+
     try:
-        contents = await file.read()
-        pdf = PdfReader(io.BytesIO(contents))
-        
-        # Parse page numbers
-        page_numbers = []
-        for part in pages.split(','):
-            if '-' in part:
-                start, end = map(int, part.split('-'))
-                page_numbers.extend(range(start - 1, end))  # 0-indexed
-            else:
-                page_numbers.append(int(part) - 1)
-        
-        writer = PdfWriter()
-        for page_num in page_numbers:
-            if 0 <= page_num < len(pdf.pages):
-                writer.add_page(pdf.pages[page_num])
-        
-        output = io.BytesIO()
-        writer.write(output)
-        output.seek(0)
-        
-        return Response(
-            content=output.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": f"attachment; filename=split_pages.pdf"}
-        )
+        parts = await run_cpu("pdf", pdf.plan_split, input_path, mode, every=every, level=level, max_bytes=max_bytes)
+        os.makedirs(work_dir, exist_ok=True)
+    except ValueError as e:
+        storage.remove(input_path, work_dir)
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
+        storage.remove(input_path, work_dir)
         raise HTTPException(status_code=500, detail=f"PDF split failed: {str(e)}")
 
+    # Several shards per worker, so the first parts can stream while later ones are written
+    shards = pdf.page_shards(len(parts), CPU_WORKERS * 4)
+    tasks = [
+        asyncio.ensure_future(run_cpu("pdf_pages", pdf.write_parts, input_path, [parts[i] for i in shard], work_dir, max_bytes))
+        for shard in shards
+    ]
+    print(f"Splitting {file.filename} into {len(parts)} parts ({mode})")
+    stem = os.path.splitext(file.filename or "document")[0]
+    return StreamingResponse(
+        _stream_parts(tasks, input_path, work_dir),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{stem}_split.zip"',
+            # Size splits may add parts where the estimate fell short
+            "X-Planned-Parts": str(len(parts)),
+        },
+    )
+
 
 @router.post("/convert/pdf/rotate")
 async def rotate_pdf(
@@ -89,23 +227,16 @@ async def rotate_pdf(
         if angle not in [90, 180, 270, -90]:
             raise HTTPException(status_code=400, detail="Angle must be 90, 180, or 270")
         
-        contents = await file.read()
-        pdf = PdfReader(io.BytesIO(contents))
-        writer = PdfWriter()
-        
-        for page in pdf.pages:
-            page.rotate(angle)
-            writer.add_page(page)
+        output_path = storage.output_path(storage.new_file_id(), "rotated.pdf")
+        async with spooled_upload(file, "pdf") as (input_path, _):
+            await run_cpu("pdf", pdf.rotate, input_path, angle, output_path)
         
-        output = io.BytesIO()
-        writer.write(output)
-        output.seek(0)
-        
-        return Response(
-            content=output.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": f"attachment; filename=rotated.pdf"}
+        return FileResponse(
+            output_path, filename="rotated.pdf", media_type="application/pdf",
+            background=storage.remove_after(output_path),
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PDF rotation failed: {str(e)}")
 
@@ -116,20 +247,59 @@ async def get_pdf_info(file: UploadFile = File(...)):
     Get PDF metadata and information
     """
     try:
-        contents = await file.read()
-        pdf = PdfReader(io.BytesIO(contents))
-        
-        metadata = pdf.metadata if pdf.metadata else {}
+        async with spooled_upload(file, "pdf") as (input_path, _):
+            info = await run_cpu("pdf", pdf.info, input_path)
         
-        return JSONResponse(content={
-            "pages": len(pdf.pages),
-            "title": metadata.get('/Title', 'N/A'),
-            "author": metadata.get('/Author', 'N/A'),
-            "subject": metadata.get('/Subject', 'N/A'),
-            "creator": metadata.get('/Creator', 'N/A'),
-            "producer": metadata.get('/Producer', 'N/A'),
-            "creation_date": str(metadata.get('/CreationDate', 'N/A')),
-            "isEncrypted": pdf.is_encrypted
-        })
+        return JSONResponse(content=info)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to read PDF info: {str(e)}")
+
+
+@router.post("/convert/pdf/to-images")
+async def pdf_to_images(
+    file: UploadFile = File(...),
+    dpi: int = Form(150),
+    pages: str = Form(""),  # e.g. "1-3,5"; all pages if empty
+    format: str = Form("png"),  # png, jpeg
+    quality: int = Form(90)  # jpeg only
+):
+    """
+    Render PDF pages to PNG or JPEG. Pages are rendered in parallel; a single page is returned as
+    an image, several as a ZIP streamed while the remaining pages render.
+    """
+    if not 36 <= dpi <= PDF_RENDER_MAX_DPI:
+        raise HTTPException(status_code=400, detail=f"dpi must be between 36 and {PDF_RENDER_MAX_DPI}.")
+    if not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="quality must be between 1 and 100.")
+    try:
+        return await _render_response(file, pages, format.lower(), None, dpi=dpi, quality=quality)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"PDF rendering failed: {str(e)}")
+
+
+@router.post("/pdf/thumbnails")
+async def pdf_thumbnails(
+    file: UploadFile = File(...),
+    width: int = Form(200),
+    pages: str = Form(""),  # e.g. "1-3,5"; all pages if empty
+    format: str = Form("jpeg"),  # png, jpeg
+    quality: int = Form(75)  # jpeg only
+):
+    """
+    Page thumbnails ``width`` pixels wide. Each thumbnail is cached by the PDF's content hash and
+    page number, so repeat views of the same document skip rendering (X-Cached-Pages says how many).
+    """
+    if not 16 <= width <= _THUMBNAIL_MAX_WIDTH:
+        raise HTTPException(status_code=400, detail=f"width must be between 16 and {_THUMBNAIL_MAX_WIDTH}.")
+    if not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="quality must be between 1 and 100.")
+    try:
+        return await _render_response(file, pages, format.lower(), "pdf.thumbnail", width=width, quality=quality)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Thumbnail rendering failed: {str(e)}")
@@ -1,57 +1,212 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import FileResponse
+from typing import List, Optional
+import asyncio
+import contextlib
+import json
+import os
 import fitz  # PyMuPDF
-import io
+from ..config import CPU_WORKERS, PDF_EDIT_PARALLEL_MIN_PAGES
+from ..services import pdf, storage
+from ..services.executor import run_cpu
+from ..services.uploads import spooled_upload
 
 router = APIRouter()
 
+
+# Worker functions run in the process pool: they open the spooled upload by path and write the edited PDF to an
+# output path, which is sent back as a file rather than as bytes pickled out of the worker.
+# Client errors are raised as ValueError (HTTPException doesn't survive the trip back from a worker).
+# Each edit is a function on an open document, so /pdf/edit/batch can chain them before a single save.
+
+_COLORS = {
+    "black": (0, 0, 0),
+    "red": (1, 0, 0),
+    "blue": (0, 0, 1),
+    "green": (0, 1, 0),
+    "white": (1, 1, 1),
+    "gray": (0.5, 0.5, 0.5)
+}
+
+
+def _page(doc, page_num):
+    if not 0 <= page_num < len(doc):
+        raise ValueError("Invalid page number")
+    return doc[page_num]
+
+
+def _text_op(doc, text, page_num, x, y, font_size, rgb_color):
+    _page(doc, page_num).insert_text((x, y), text, fontsize=font_size, color=rgb_color)
+
+
+def _image_op(doc, image_path, page_num, x, y, width, height):
+    # Define rectangle for image placement
+    rect = fitz.Rect(x, y, x + width, y + height)
+    _page(doc, page_num).insert_image(rect, filename=image_path)
+
+
+def _watermark_op(doc, text, image_path, pages, position, rotation, font_size, rgb_color, opacity, image_width):
+    stamp = pdf.watermark_stamp(text, image_path, font_size, rgb_color, opacity, image_width)
+    try:
+        page_indices = pdf.parse_pages(pages, len(doc)) if pages.strip() else range(len(doc))
+        return pdf.apply_watermark(doc, stamp, page_indices, position, rotation)
+    finally:
+        stamp.close()
+
+
+def _highlight_op(doc, page_num, rect):
+    page = _page(doc, page_num)  # annotations only hold a weak reference to their page
+    highlight = page.add_highlight_annot(fitz.Rect(*rect))
+    highlight.set_colors(stroke=(1, 1, 0))  # Yellow
+    highlight.update()
+
+
+def _find_replace_op(doc, pairs):
+    matches = pdf.find_text_matches(doc, range(len(doc)), pdf.compile_replacements(pairs))
+    return pdf.apply_text_matches(doc, matches)
+
+
+def _edit(input_path, output_path, op, *args):
+    doc = pdf.open_pdf(input_path)
+    try:
+        op(doc, *args)
+    except BaseException:
+        doc.close()
+        raise
+    pdf.save(doc, output_path)
+
+
+_OPERATIONS = ("add_text", "add_image", "add_watermark", "highlight", "find_replace")
+
+
+def _uploaded_image(index, image_paths):
+    index = int(index)
+    if not 0 <= index < len(image_paths):
+        raise ValueError(f"image {index} was not uploaded")
+    return image_paths[index]
+
+
+def _apply_operation(doc, operation, image_paths):
+    """Run one /pdf/edit/batch operation; the fields and defaults match the single-edit endpoints."""
+    kind = operation["op"]
+    if kind == "add_text":
+        _text_op(
+            doc, str(operation["text"]), int(operation.get("page_num", 0)),
+            float(operation.get("x", 100)), float(operation.get("y", 100)), float(operation.get("font_size", 12)),
+            _COLORS.get(operation.get("color", "black"), (0, 0, 0)),
+        )
+    elif kind == "add_image":
+        _image_op(
+            doc, _uploaded_image(operation.get("image", 0), image_paths), int(operation.get("page_num", 0)),
+            float(operation.get("x", 100)), float(operation.get("y", 100)),
+            float(operation.get("width", 100)), float(operation.get("height", 100)),
+        )
+    elif kind == "add_watermark":
+        image = operation.get("image")
+        _watermark_op(
+            doc, str(operation.get("watermark_text", "")), None if image is None else _uploaded_image(image, image_paths),
+            str(operation.get("pages", "")), operation.get("position", "center"), float(operation.get("rotation", 45)),
+            float(operation.get("font_size", 60)), _COLORS.get(operation.get("color", "gray"), (0.5, 0.5, 0.5)),
+            float(operation.get("opacity", 0.3)), float(operation.get("image_width", 200)),
+        )
+    elif kind == "highlight":
+        rect = tuple(float(operation[key]) for key in ("x0", "y0", "x1", "y1"))
+        _highlight_op(doc, int(operation.get("page_num", 0)), rect)
+    elif kind == "find_replace":
+        replacements = json.dumps(operation.get("replacements") or [])
+        pairs = _replacement_pairs(
+            operation.get("find_text", ""), operation.get("replace_text", ""),
+            bool(operation.get("regex", False)), bool(operation.get("match_case", False)), replacements,
+        )
+        _find_replace_op(doc, pairs)
+
+
+def _run_batch(input_path, output_path, operations, image_paths, incremental, garbage):
+    doc = pdf.open_pdf(input_path)
+    try:
+        for number, operation in enumerate(operations, start=1):
+            try:
+                _apply_operation(doc, operation, image_paths)
+            except (KeyError, TypeError, ValueError) as e:
+                message = f"missing field {e}" if isinstance(e, KeyError) else str(e)
+                raise ValueError(f"Operation {number} ({operation.get('op')}): {message}")
+        if incremental and doc.can_save_incrementally():
+            # Appends only the changed objects to the upload itself instead of rewriting the file
+            doc.save(input_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+            doc.close()
+            os.replace(input_path, output_path)
+            return
+    except BaseException:
+        doc.close()
+        raise
+    pdf.save(doc, output_path, garbage=garbage, deflate=garbage > 0)
+
+
+def _pdf_response(output_path, filename, headers=None):
+    return FileResponse(
+        output_path, filename=filename, media_type="application/pdf",
+        headers=headers, background=storage.remove_after(output_path),
+    )
+
+
+def _replacement_pairs(find_text, replace_text, regex, match_case, replacements):
+    pairs = []
+    if find_text:
+        pairs.append({"find": find_text, "replace": replace_text, "regex": regex, "match_case": match_case})
+    if replacements:
+        try:
+            extra = json.loads(replacements)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"replacements must be a JSON list: {e}")
+        if not isinstance(extra, list) or not all(isinstance(pair, dict) for pair in extra):
+            raise ValueError('replacements must be a JSON list of {"find": ..., "replace": ...} objects.')
+        pairs.extend(extra)
+    if not pairs:
+        raise ValueError("Nothing to replace. Send find_text or replacements.")
+    # Fail on a bad pattern here rather than in every worker
+    pdf.compile_replacements(pairs)
+    return pairs
+
+
+async def _find_matches(input_path, pairs):
+    """Search large documents in parallel page shards; None lets the replacing worker search itself."""
+    page_count = await run_cpu("pdf", pdf.page_count, input_path)
+    if CPU_WORKERS <= 1 or page_count < PDF_EDIT_PARALLEL_MIN_PAGES:
+        return None
+    shards = await asyncio.gather(*[
+        run_cpu("pdf_pages", pdf.find_text_matches_in, input_path, shard, pairs)
+        for shard in pdf.page_shards(page_count, CPU_WORKERS)
+    ])
+    return {index: page_matches for shard in shards for index, page_matches in shard.items()}
+
+
 @router.post("/pdf/edit/find-replace")
 async def find_replace_text(
     file: UploadFile = File(...),
-    find_text: str = Form(...),
-    replace_text: str = Form(...)
+    find_text: str = Form(""),
+    replace_text: str = Form(""),
+    regex: bool = Form(False),
+    match_case: bool = Form(False),
+    replacements: str = Form(""),
 ):
-    """Find and replace text in PDF"""
+    """
+    Find and replace text in PDF. Besides ``find_text``/``replace_text``, ``replacements`` takes a JSON
+    list of {"find", "replace", "regex", "match_case"} pairs, applied in one pass. Regex replacements
+    may use group references (\\1). Matches are found within a line of text and ignore case unless
+    ``match_case`` is set. Sending neither ``find_text`` nor ``replacements`` is a 400.
+    """
     try:
-        contents = await file.read()
-        doc = fitz.open(stream=contents, filetype="pdf")
+        pairs = _replacement_pairs(find_text, replace_text, regex, match_case, replacements)
+        output_path = storage.output_path(storage.new_file_id(), "edited.pdf")
+        async with spooled_upload(file, "pdf") as (input_path, _):
+            matches = await _find_matches(input_path, pairs)
+            replacements_made = await run_cpu("pdf", pdf.replace_text, input_path, pairs, output_path, matches)
         
-        replacements_made = 0
-        
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            
-            # Search for text
-            text_instances = page.search_for(find_text)
-            
-            for inst in text_instances:
-                # Redact (remove) old text
-                page.add_redact_annot(inst, fill=(1, 1, 1))  # White fill
-                page.apply_redactions()
-                
-                # Add new text in same position
-                page.insert_text(
-                    inst.top_left,
-                    replace_text,
-                    fontsize=12,
-                    color=(0, 0, 0)
-                )
-                replacements_made += 1
-        
-        # Save to bytes
-        output = io.BytesIO()
-        doc.save(output)
-        doc.close()
-        output.seek(0)
-        
-        return Response(
-            content=output.getvalue(),
-            media_type="application/pdf",
-            headers={
-                "Content-Disposition": "attachment; filename=edited.pdf",
-                "X-Replacements-Made": str(replacements_made)
-            }
-        )
+        return _pdf_response(output_path, "edited.pdf", {"X-Replacements-Made": str(replacements_made)})
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Text replacement failed: {str(e)}")
 
@@ -68,42 +223,18 @@ async def add_text_to_pdf(
 ):
     """Add text overlay to PDF"""
     try:
-        contents = await file.read()
-        doc = fitz.open(stream=contents, filetype="pdf")
-        
-        if page_num >= len(doc):
-            raise HTTPException(status_code=400, detail="Invalid page number")
-        
-        page = doc[page_num]
-        
         # Color mapping
-        color_map = {
-            "black": (0, 0, 0),
-            "red": (1, 0, 0),
-            "blue": (0, 0, 1),
-            "green": (0, 1, 0),
-            "white": (1, 1, 1)
-        }
-        rgb_color = color_map.get(color, (0, 0, 0))
-        
-        # Add text
-        page.insert_text(
-            (x, y),
-            text,
-            fontsize=font_size,
-            color=rgb_color
-        )
+        rgb_color = _COLORS.get(color, (0, 0, 0))
         
-        output = io.BytesIO()
-        doc.save(output)
-        doc.close()
-        output.seek(0)
+        output_path = storage.output_path(storage.new_file_id(), "with_text.pdf")
+        async with spooled_upload(file, "pdf") as (input_path, _):
+            await run_cpu("pdf", _edit, input_path, output_path, _text_op, text, page_num, x, y, font_size, rgb_color)
         
-        return Response(
-            content=output.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": "attachment; filename=with_text.pdf"}
-        )
+        return _pdf_response(output_path, "with_text.pdf")
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Add text failed: {str(e)}")
 
@@ -120,32 +251,15 @@ async def add_image_to_pdf(
 ):
     """Add image to PDF"""
     try:
-        pdf_contents = await pdf_file.read()
-        image_contents = await image_file.read()
-        
-        doc = fitz.open(stream=pdf_contents, filetype="pdf")
-        
-        if page_num >= len(doc):
-            raise HTTPException(status_code=400, detail="Invalid page number")
-        
-        page = doc[page_num]
-        
-        # Define rectangle for image placement
-        rect = fitz.Rect(x, y, x + width, y + height)
-        
-        # Insert image
-        page.insert_image(rect, stream=image_contents)
-        
-        output = io.BytesIO()
-        doc.save(output)
-        doc.close()
-        output.seek(0)
+        output_path = storage.output_path(storage.new_file_id(), "with_image.pdf")
+        async with spooled_upload(pdf_file, "pdf") as (pdf_path, _), spooled_upload(image_file, "images") as (image_path, _):
+            await run_cpu("pdf", _edit, pdf_path, output_path, _image_op, image_path, page_num, x, y, width, height)
         
-        return Response(
-            content=output.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": "attachment; filename=with_image.pdf"}
-        )
+        return _pdf_response(output_path, "with_image.pdf")
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Add image failed: {str(e)}")
 
@@ -153,41 +267,38 @@ async def add_image_to_pdf(
 @router.post("/pdf/edit/add-watermark")
 async def add_watermark(
     file: UploadFile = File(...),
-    watermark_text: str = Form(...),
-    opacity: float = Form(0.3)
+    watermark_text: str = Form(""),
+    image: Optional[UploadFile] = File(None),
+    opacity: float = Form(0.3),
+    position: str = Form("center"),  # center, top-left, top-right, bottom-left, bottom-right, tile
+    rotation: float = Form(45),
+    font_size: float = Form(60),
+    color: str = Form("gray"),
+    image_width: float = Form(200),
+    pages: str = Form("")  # e.g. "1-3,5"; all pages if empty
 ):
-    """Add watermark to all pages"""
+    """
+    Add a text or image watermark. It is drawn once and shared by every page, so large documents stay
+    small; ``position`` "tile" repeats it across the page.
+    """
     try:
-        contents = await file.read()
-        doc = fitz.open(stream=contents, filetype="pdf")
-        
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            
-            # Get page dimensions
-            page_width = page.rect.width
-            page_height = page.rect.height
-            
-            # Add watermark diagonally across page
-            page.insert_text(
-                (page_width / 2, page_height / 2),
-                watermark_text,
-                fontsize=60,
-                color=(0.7, 0.7, 0.7),
-                rotate=45,
-                overlay=True
+        rgb_color = _COLORS.get(color, (0.5, 0.5, 0.5))
+        output_path = storage.output_path(storage.new_file_id(), "watermarked.pdf")
+        async with contextlib.AsyncExitStack() as stack:
+            input_path, _ = await stack.enter_async_context(spooled_upload(file, "pdf"))
+            image_path = None
+            if image is not None and image.filename:
+                image_path, _ = await stack.enter_async_context(spooled_upload(image, "images"))
+            await run_cpu(
+                "pdf", _edit, input_path, output_path, _watermark_op, watermark_text, image_path, pages,
+                position, rotation, font_size, rgb_color, opacity, image_width
             )
         
-        output = io.BytesIO()
-        doc.save(output)
-        doc.close()
-        output.seek(0)
-        
-        return Response(
-            content=output.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": "attachment; filename=watermarked.pdf"}
-        )
+        return _pdf_response(output_path, "watermarked.pdf")
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Watermark failed: {str(e)}")
 
@@ -203,28 +314,66 @@ async def add_highlight(
 ):
     """Add highlight annotation to PDF"""
     try:
-        contents = await file.read()
-        doc = fitz.open(stream=contents, filetype="pdf")
-        
-        if page_num >= len(doc):
-            raise HTTPException(status_code=400, detail="Invalid page number")
-        
-        page = doc[page_num]
-        
-        # Create highlight annotation
-        highlight = page.add_highlight_annot(fitz.Rect(x0, y0, x1, y1))
-        highlight.set_colors(stroke=(1, 1, 0))  # Yellow
-        highlight.update()
-        
-        output = io.BytesIO()
-        doc.save(output)
-        doc.close()
-        output.seek(0)
+        output_path = storage.output_path(storage.new_file_id(), "highlighted.pdf")
+        async with spooled_upload(file, "pdf") as (input_path, _):
+            await run_cpu("pdf", _edit, input_path, output_path, _highlight_op, page_num, (x0, y0, x1, y1))
         
-        return Response(
-            content=output.getvalue(),
-            media_type="application/pdf",
-            headers={"Content-Disposition": "attachment; filename=highlighted.pdf"}
-        )
+        return _pdf_response(output_path, "highlighted.pdf")
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Highlight failed: {str(e)}")
+
+
+@router.post("/pdf/edit/batch")
+async def batch_edit(
+    file: UploadFile = File(...),
+    operations: str = Form(...),
+    images: Optional[List[UploadFile]] = File(None),
+    incremental: bool = Form(False),
+    garbage: int = Form(0)
+):
+    """
+    Apply several edits in one pass: the PDF is parsed once and saved once. ``operations`` is a JSON
+    list of objects with an ``op`` (add_text, add_image, add_watermark, highlight, find_replace) and
+    that endpoint's fields, e.g. {"op": "add_text", "text": "Draft", "page_num": 0}. add_image uses
+    ``image``, an index into the uploaded ``images``. ``incremental`` appends the changes to the
+    original file instead of rewriting it (fastest for small edits to large files); otherwise
+    ``garbage`` (0-4) sets how much unused data the rewrite removes.
+    """
+    try:
+        try:
+            steps = json.loads(operations)
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"operations must be a JSON list: {e}")
+        if not isinstance(steps, list) or not steps or not all(isinstance(step, dict) for step in steps):
+            raise HTTPException(status_code=400, detail="operations must be a non-empty JSON list of objects.")
+        for number, step in enumerate(steps, start=1):
+            if step.get("op") not in _OPERATIONS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Operation {number}: op must be one of {', '.join(_OPERATIONS)}."
+                )
+        if not 0 <= garbage <= 4:
+            raise HTTPException(status_code=400, detail="garbage must be between 0 and 4.")
+        if incremental and garbage:
+            raise HTTPException(status_code=400, detail="An incremental save can't collect garbage; use one or the other.")
+
+        output_path = storage.output_path(storage.new_file_id(), "edited.pdf")
+        async with contextlib.AsyncExitStack() as stack:
+            input_path, _ = await stack.enter_async_context(spooled_upload(file, "pdf"))
+            image_paths = []
+            for image in images or []:
+                image_path, _ = await stack.enter_async_context(spooled_upload(image, "images"))
+                image_paths.append(image_path)
+            await run_cpu("pdf", _run_batch, input_path, output_path, steps, image_paths, incremental, garbage)
+
+        return _pdf_response(output_path, "edited.pdf", {"X-Operations-Applied": str(len(steps))})
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Batch edit failed: {str(e)}")
@@ -1,138 +1,204 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from fastapi.responses import FileResponse
+import asyncio
 import os
-import shutil
-import uuid
 from typing import List, Optional
-from pypdf import PdfReader, PdfWriter
-from ..config import UPLOAD_DIR, OUTPUT_DIR
+from PIL import features
+from ..config import CPU_WORKERS
+from ..services import cache, pdf, storage
+from ..services.executor import run_cpu
+from ..services.uploads import save_upload
 
 router = APIRouter()
 
+
 @router.post("/convert/pdf/merge")
 async def merge_pdfs(files: List[UploadFile] = File(...)):
     if len(files) < 2:
         raise HTTPException(status_code=400, detail="At least two PDF files are required for merging.")
 
-    file_id = str(uuid.uuid4())
+    file_id = storage.new_file_id()
     output_filename = f"merged_{file_id}.pdf"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
+    output_path = storage.output_path(file_id, output_filename)
+    input_paths = []
 
     try:
-        merger = PdfWriter()
-        
+        digests = []
         for file in files:
             if not file.filename.lower().endswith('.pdf'):
                  raise HTTPException(status_code=400, detail=f"File {file.filename} is not a PDF.")
             
             # Save temp file
-            temp_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}_{file.filename}")
-            with open(temp_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            temp_path = storage.upload_path(storage.new_file_id(), file.filename)
+            digests.append(await save_upload(file, "pdf", temp_path))
             
-            merger.append(temp_path)
+            input_paths.append(temp_path)
+
+        # Order matters for a merge, so the digests are kept as a list
+        cache_key = cache.make_key("pdf.merge", digests)
+        hit = await cache.cached_response(cache_key, filename="merged_document.pdf")
+        if hit is not None:
+            return hit
 
-        merger.write(output_path)
-        merger.close()
+        await run_cpu("pdf", pdf.merge, input_paths, output_path)
 
-        return FileResponse(output_path, filename="merged_document.pdf", media_type="application/pdf")
+        await cache.store_file(cache_key, output_path, "application/pdf")
+        return FileResponse(output_path, filename="merged_document.pdf", media_type="application/pdf", background=storage.remove_after(output_path))
 
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Merge failed: {str(e)}")
+    finally:
+        storage.remove(*input_paths)
 
 @router.post("/convert/pdf/protect")
 async def protect_pdf(file: UploadFile = File(...), password: str = Form(...)):
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="File must be a PDF.")
 
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"protected_{file.filename}"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    await save_upload(file, "pdf", input_path)
 
     try:
-        reader = PdfReader(input_path)
-        writer = PdfWriter()
-
-        for page in reader.pages:
-            writer.add_page(page)
-
-        writer.encrypt(password)
+        await run_cpu("pdf", pdf.protect, input_path, password, output_path)
 
-        with open(output_path, "wb") as f:
-            writer.write(f)
-
-        return FileResponse(output_path, filename=output_filename, media_type="application/pdf")
+        return FileResponse(output_path, filename=output_filename, media_type="application/pdf", background=storage.remove_after(output_path))
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Protection failed: {str(e)}")
+    finally:
+        storage.remove(input_path)
 
 @router.post("/convert/pdf/unlock")
 async def unlock_pdf(file: UploadFile = File(...), password: str = Form(...)):
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="File must be a PDF.")
 
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"unlocked_{file.filename}"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    await save_upload(file, "pdf", input_path)
 
     try:
-        reader = PdfReader(input_path)
-        
-        if reader.is_encrypted:
-            reader.decrypt(password)
-        
-        writer = PdfWriter()
-        for page in reader.pages:
-            writer.add_page(page)
-
-        with open(output_path, "wb") as f:
-            writer.write(f)
+        await run_cpu("pdf", pdf.unlock, input_path, password, output_path)
 
-        return FileResponse(output_path, filename=output_filename, media_type="application/pdf")
+        return FileResponse(output_path, filename=output_filename, media_type="application/pdf", background=storage.remove_after(output_path))
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Unlock failed: {str(e)} (Incorrect password?)")
+    finally:
+        storage.remove(input_path)
+
+_IMAGE_FORMATS = ["jpeg", "jpeg2000"]
+_COMPRESSION_PRESETS = ["lossless", *pdf.COMPRESSION_PRESETS]
+
+
+async def _compress_images(input_path, output_path, preset, image_format):
+    page_count = await run_cpu("pdf", pdf.page_count, input_path)
+    # Finding where images are drawn and re-encoding them both run in parallel across the pool;
+    # "pdf_pages" bounds those shards across all requests
+    usages = await asyncio.gather(*[
+        run_cpu("pdf_pages", pdf.image_usage, input_path, shard)
+        for shard in pdf.page_shards(page_count, CPU_WORKERS)
+    ])
+    sizes = {}
+    for usage in usages:
+        for xref, (width, height) in usage.items():
+            known = sizes.get(xref, (0, 0))
+            sizes[xref] = (max(known[0], width), max(known[1], height))
+    targets = [(xref, width, height) for xref, (width, height) in sorted(sizes.items())]
+
+    work_dir = storage.output_path(storage.new_file_id())
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = await asyncio.gather(*[
+            # Interleaved so large and small images spread evenly over the shards
+            run_cpu("pdf_pages", pdf.recompress_images, input_path, targets[i::CPU_WORKERS], preset, image_format, work_dir)
+            for i in range(min(CPU_WORKERS, len(targets)))
+        ])
+        replacements = [replacement for shard in results for replacement in shard]
+        print(f"Re-encoded {len(replacements)} of {len(targets)} images ({preset})")
+        await run_cpu("pdf", pdf.apply_compression, input_path, replacements, output_path)
+    finally:
+        storage.remove(work_dir)
+
+
+def _compression_headers(original_size, compressed_size):
+    return {
+        "X-Original-Size": str(original_size),
+        "X-Compressed-Size": str(compressed_size),
+        "X-Compression-Ratio": f"{original_size / max(compressed_size, 1):.2f}",
+    }
+
 
 @router.post("/convert/pdf/compress")
-async def compress_pdf(file: UploadFile = File(...)):
-    # Basic compression by removing duplication and unused objects
+async def compress_pdf(
+    file: UploadFile = File(...),
+    preset: str = Form("ebook"),
+    image_format: str = Form("jpeg"),
+):
+    """
+    Compress a PDF. ``preset`` screen (72 DPI), ebook (150 DPI) or print (300 DPI) downsamples and
+    re-encodes images as ``image_format`` (jpeg or jpeg2000); lossless only cleans up objects and
+    streams. Fonts are subset and duplicate streams merged either way. The sizes and ratio are
+    reported in the X-Original-Size, X-Compressed-Size and X-Compression-Ratio headers.
+    """
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="File must be a PDF.")
-
-    file_id = str(uuid.uuid4())
-    input_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
+    preset = preset.lower()
+    image_format = image_format.lower()
+    if preset not in _COMPRESSION_PRESETS:
+        raise HTTPException(status_code=400, detail=f"Invalid preset. Supported: {', '.join(_COMPRESSION_PRESETS)}")
+    if image_format not in _IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid image format. Supported: {', '.join(_IMAGE_FORMATS)}")
+    if image_format == "jpeg2000" and not features.check("jpg_2000"):
+        raise HTTPException(status_code=501, detail="JPEG 2000 encoding is not available on this server (Pillow without OpenJPEG).")
+
+    file_id = storage.new_file_id()
+    input_path = storage.upload_path(file_id, file.filename)
     output_filename = f"compressed_{file.filename}"
-    output_path = os.path.join(OUTPUT_DIR, f"{file_id}_{output_filename}")
+    output_path = storage.output_path(file_id, output_filename)
 
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    digest = await save_upload(file, "pdf", input_path)
+    original_size = os.path.getsize(input_path)
+    cache_key = cache.make_key("pdf.compress", [digest], preset=preset, image_format=image_format)
 
     try:
-        reader = PdfReader(input_path)
-        writer = PdfWriter()
-
-        for page in reader.pages:
-            writer.add_page(page)
-            page.compress_content_streams() # Compress page content
-
-        # Set compression level
-        for page in writer.pages:
-            for img in page.images:
-                # This is a placeholder for more advanced image compression if needed
-                pass
-
-        with open(output_path, "wb") as f:
-            writer.write(f)
-            
-        return FileResponse(output_path, filename=output_filename, media_type="application/pdf")
-
+        cached_path = await cache.cached_path(cache_key)
+        if cached_path is not None:
+            headers = {"X-Cache": "HIT", **_compression_headers(original_size, os.path.getsize(cached_path))}
+            return FileResponse(cached_path, filename=output_filename, media_type="application/pdf", headers=headers)
+
+        if preset == "lossless":
+            # No images to swap, but fonts are still subset like the lossy presets
+            await run_cpu("pdf", pdf.apply_compression, input_path, [], output_path)
+        else:
+            await _compress_images(input_path, output_path, preset, image_format)
+        if os.path.getsize(output_path) >= original_size:
+            # Already well compressed: a rewrite would only make it bigger
+            os.replace(input_path, output_path)
+
+        await cache.store_file(cache_key, output_path, "application/pdf")
+        headers = _compression_headers(original_size, os.path.getsize(output_path))
+        print(f"Compressed {file.filename}: {headers['X-Compression-Ratio']}x ({preset})")
+        return FileResponse(output_path, filename=output_filename, media_type="application/pdf", headers=headers, background=storage.remove_after(output_path))
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Compression failed: {str(e)}")
+    finally:
+        storage.remove(input_path)
@@ -4,9 +4,45 @@ import qrcode
 from io import BytesIO
 import barcode
 from barcode.writer import ImageWriter
+from ..services.executor import run_cpu
 
 router = APIRouter()
 
+# Map barcode types
+_BARCODE_CLASSES = {
+    "code128": barcode.Code128,
+    "code39": barcode.Code39,
+    "ean13": barcode.EAN13,
+    "ean8": barcode.EAN8,
+    "upca": barcode.UPCA,
+}
+
+
+def _render_qr(data, size, border, fill_color, back_color):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=size,
+        border=border,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color=fill_color, back_color=back_color)
+    
+    # Save to BytesIO
+    buf = BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def _render_barcode(barcode_type, data):
+    buf = BytesIO()
+    barcode_instance = _BARCODE_CLASSES[barcode_type](data, writer=ImageWriter())
+    barcode_instance.write(buf)
+    return buf.getvalue()
+
+
 @router.post("/generate/qr")
 async def generate_qr_code(
     data: str = Form(...),
@@ -19,24 +55,10 @@ async def generate_qr_code(
     Generate QR code from text/URL
     """
     try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=size,
-            border=border,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill_color=fill_color, back_color=back_color)
-        
-        # Save to BytesIO
-        buf = BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
+        png_bytes = await run_cpu("qr", _render_qr, data, size, border, fill_color, back_color)
         
         return Response(
-            content=buf.getvalue(),
+            content=png_bytes,
             media_type="image/png",
             headers={"Content-Disposition": "attachment; filename=qrcode.png"}
         )
@@ -54,31 +76,17 @@ async def generate_barcode_image(
     Supported types: code128, code39, ean13, ean8, upca
     """
     try:
-        # Map barcode types
-        barcode_classes = {
-            "code128": barcode.Code128,
-            "code39": barcode.Code39,
-            "ean13": barcode.EAN13,
-            "ean8": barcode.EAN8,
-            "upca": barcode.UPCA,
-        }
-        
-        if barcode_type.lower() not in barcode_classes:
+        if barcode_type.lower() not in _BARCODE_CLASSES:
             raise HTTPException(
                 status_code=400,
-                detail=f"Unsupported barcode type. Supported: {', '.join(barcode_classes.keys())}"
+                detail=f"Unsupported barcode type. Supported: {', '.join(_BARCODE_CLASSES.keys())}"
             )
         
-        barcode_class = barcode_classes[barcode_type.lower()]
-        
         # Generate barcode
-        buf = BytesIO()
-        barcode_instance = barcode_class(data, writer=ImageWriter())
-        barcode_instance.write(buf)
-        buf.seek(0)
+        png_bytes = await run_cpu("qr", _render_barcode, barcode_type.lower(), data)
         
         return Response(
-            content=buf.getvalue(),
+            content=png_bytes,
             media_type="image/png",
             headers={"Content-Disposition": f"attachment; filename=barcode_{barcode_type}.png"}
         )
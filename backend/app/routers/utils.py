@@ -3,9 +3,19 @@ from fastapi.responses import PlainTextResponse, JSONResponse
 import base64
 import json
 import yaml
+from ..services.executor import run_io
+from ..services.uploads import read_chunks, max_upload_bytes
 
 router = APIRouter()
 
+
+def _hash_stream(src, hasher, limit):
+    size = 0
+    for chunk in read_chunks(src, limit):
+        hasher.update(chunk)
+        size += len(chunk)
+    return size
+
 @router.post("/convert/utils/base64-encode")
 async def base64_encode(text: str = Form(...)):
     try:
@@ -38,14 +48,14 @@ async def generate_hash(file: UploadFile = File(...), algorithm: str = Form("sha
             )
         
         hasher = algorithms[algorithm.lower()]()
-        contents = await file.read()
-        hasher.update(contents)
+        # Hash the upload in chunks; hashlib releases the GIL on large buffers, so a thread is enough here
+        size = await run_io("utils", _hash_stream, file.file, hasher, max_upload_bytes("utils"))
         
         return JSONResponse(content={
             "filename": file.filename,
             "algorithm": algorithm.lower(),
             "hash": hasher.hexdigest(),
-            "size_bytes": len(contents)
+            "size_bytes": size
         })
     except HTTPException:
         raise
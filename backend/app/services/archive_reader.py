@@ -0,0 +1,182 @@
+"""
+Read-only access to ZIP, tar (plain, gzip, bzip2, xz) and 7z archives.
+
+``list_entries`` reads as little as each format allows: the central
+directory for ZIP, the header block for 7z, and the member headers for tar
+(which, for compressed tars, still means decompressing the stream).
+``open_members`` yields readable file objects for selected members so they
+can be streamed out without extracting the whole tree; only 7z, which
+py7zr cannot stream, extracts the selected members to a work directory.
+
+Decompression bombs are caught twice: ``check_limits`` rejects archives
+whose declared member count, total size or compression ratio is out of
+bounds, and ``Budget`` caps the bytes actually decompressed.
+"""
+import datetime
+import fnmatch
+import os
+import tarfile
+import zipfile
+
+from ..config import ARCHIVE_MAX_MEMBERS, ARCHIVE_MAX_EXTRACT_MB, ARCHIVE_MAX_RATIO
+
+_SEVEN_ZIP_MAGIC = b"7z\xbc\xaf\x27\x1c"
+# Small members may compress extremely well (e.g. blank files); only larger ones get the ratio check
+_RATIO_MIN_BYTES = 1024 * 1024
+
+
+class ArchiveLimitError(ValueError):
+    """The archive exceeds an extraction limit."""
+
+
+def detect(path):
+    """``"zip"``, ``"tar"`` or ``"7z"`` from the file's content; ValueError if it is none of them."""
+    with open(path, "rb") as f:
+        if f.read(len(_SEVEN_ZIP_MAGIC)) == _SEVEN_ZIP_MAGIC:
+            return "7z"
+    if zipfile.is_zipfile(path):
+        return "zip"
+    if tarfile.is_tarfile(path):
+        return "tar"
+    raise ValueError("Unsupported archive. Supported formats: zip, tar, tar.gz, tar.bz2, tar.xz, 7z.")
+
+
+def _open_7z(path):
+    try:
+        import py7zr
+    except ImportError:
+        raise NotImplementedError("7z archives require the py7zr package on the server.")
+    return py7zr.SevenZipFile(path, "r")
+
+
+def _timestamp(value):
+    return value.isoformat() if value else None
+
+
+def list_entries(path, fmt):
+    """Members as dicts with name, size, compressed_size (None if unknown), is_dir and modified."""
+    entries = []
+    if fmt == "zip":
+        with zipfile.ZipFile(path) as zf:
+            infos = zf.infolist()
+            if len(infos) > ARCHIVE_MAX_MEMBERS:
+                raise ArchiveLimitError(f"Too many archive members. Maximum is {ARCHIVE_MAX_MEMBERS}.")
+            for info in infos:
+                entries.append({
+                    "name": info.filename,
+                    "size": info.file_size,
+                    "compressed_size": info.compress_size,
+                    "is_dir": info.is_dir(),
+                    "modified": _timestamp(datetime.datetime(*info.date_time)),
+                })
+    elif fmt == "tar":
+        with tarfile.open(path, "r:*") as tf:
+            for member in tf:
+                if not (member.isfile() or member.isdir()):
+                    # Links and devices can't be streamed as content
+                    continue
+                if len(entries) >= ARCHIVE_MAX_MEMBERS:
+                    raise ArchiveLimitError(f"Too many archive members. Maximum is {ARCHIVE_MAX_MEMBERS}.")
+                entries.append({
+                    "name": member.name,
+                    "size": member.size,
+                    "compressed_size": None,
+                    "is_dir": member.isdir(),
+                    "modified": _timestamp(datetime.datetime.fromtimestamp(member.mtime)),
+                })
+    else:
+        with _open_7z(path) as archive:
+            infos = archive.list()
+            if len(infos) > ARCHIVE_MAX_MEMBERS:
+                raise ArchiveLimitError(f"Too many archive members. Maximum is {ARCHIVE_MAX_MEMBERS}.")
+            for info in infos:
+                entries.append({
+                    "name": info.filename,
+                    "size": info.uncompressed or 0,
+                    # Members of a solid block share their compressed data
+                    "compressed_size": info.compressed,
+                    "is_dir": info.is_directory,
+                    "modified": _timestamp(info.creationtime),
+                })
+    return entries
+
+
+def select(entries, patterns):
+    """Files among ``entries`` whose names match any of ``patterns`` (exact names or globs); all files if none."""
+    files = [entry for entry in entries if not entry["is_dir"]]
+    if not patterns:
+        return files
+    return [
+        entry for entry in files
+        if any(entry["name"] == pattern or fnmatch.fnmatchcase(entry["name"], pattern) for pattern in patterns)
+    ]
+
+
+def check_limits(entries):
+    """Reject a selection whose declared sizes point to a decompression bomb."""
+    if len(entries) > ARCHIVE_MAX_MEMBERS:
+        raise ArchiveLimitError(f"Too many archive members. Maximum is {ARCHIVE_MAX_MEMBERS}.")
+    if sum(entry["size"] for entry in entries) > ARCHIVE_MAX_EXTRACT_MB * 1024 * 1024:
+        raise ArchiveLimitError(f"Extracted size would exceed {ARCHIVE_MAX_EXTRACT_MB} MB.")
+    for entry in entries:
+        compressed = entry["compressed_size"]
+        if entry["size"] > _RATIO_MIN_BYTES and compressed is not None and entry["size"] > compressed * ARCHIVE_MAX_RATIO:
+            raise ArchiveLimitError(f"{entry['name']} exceeds the maximum compression ratio of {ARCHIVE_MAX_RATIO}.")
+
+
+class Budget:
+    """Caps the bytes read through ``wrap``-ped members, whatever sizes the archive declared."""
+
+    def __init__(self, limit_bytes=None):
+        self.remaining = ARCHIVE_MAX_EXTRACT_MB * 1024 * 1024 if limit_bytes is None else limit_bytes
+
+    def wrap(self, src):
+        return _Counted(src, self)
+
+
+class _Counted:
+    def __init__(self, src, budget):
+        self._src = src
+        self._budget = budget
+
+    def read(self, size=-1):
+        data = self._src.read(size)
+        self._budget.remaining -= len(data)
+        if self._budget.remaining < 0:
+            raise ArchiveLimitError(f"Extracted size exceeds {ARCHIVE_MAX_EXTRACT_MB} MB.")
+        return data
+
+
+def safe_name(name):
+    """``name`` as a relative path with no absolute or parent-directory components."""
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return "/".join(parts)
+
+
+def open_members(path, fmt, names, work_dir):
+    """Yield ``(name, readable)`` for each of ``names``; ``work_dir`` holds 7z members while they are read."""
+    if fmt == "zip":
+        with zipfile.ZipFile(path) as zf:
+            for name in names:
+                with zf.open(name) as src:
+                    yield name, src
+    elif fmt == "tar":
+        wanted = set(names)
+        with tarfile.open(path, "r:*") as tf:
+            # One pass in archive order; compressed tars can't seek back
+            for member in tf:
+                if member.name in wanted and member.isfile():
+                    wanted.discard(member.name)
+                    yield member.name, tf.extractfile(member)
+                    if not wanted:
+                        break
+    else:
+        with _open_7z(path) as archive:
+            archive.extract(path=work_dir, targets=list(names))
+        root = os.path.realpath(work_dir)
+        for name in names:
+            member_path = os.path.realpath(os.path.join(work_dir, safe_name(name)))
+            if not member_path.startswith(root + os.sep) or not os.path.isfile(member_path):
+                continue
+            with open(member_path, "rb") as src:
+                yield name, src
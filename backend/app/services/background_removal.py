@@ -0,0 +1,151 @@
+"""
+Background removal with long-lived rembg model sessions.
+
+rembg's ``remove()`` without a session resolves the model and builds a new
+ONNX Runtime session on every call, which costs seconds per image. Here the
+work runs in a dedicated process pool (``REMBG_WORKERS`` processes), and each
+worker loads ``REMBG_MODEL`` once, with the configured onnxruntime thread
+counts, and keeps it for its lifetime.
+
+Requests that arrive within ``REMBG_BATCH_WINDOW_MS`` of each other are
+collected and split evenly over the workers in batches of at most
+``REMBG_BATCH_SIZE``, so a burst of uploads costs one round trip per worker to
+a warm session instead of one per image, without queueing behind one worker.
+"""
+import asyncio
+import math
+from concurrent.futures.process import BrokenProcessPool
+
+from ..config import (
+    REMBG_MODEL, REMBG_WORKERS, REMBG_INTRA_OP_THREADS, REMBG_INTER_OP_THREADS,
+    REMBG_BATCH_SIZE, REMBG_BATCH_WINDOW_MS,
+)
+from . import executor
+
+# Worker-process state, set by _init_worker
+_settings = {}
+_session = None
+
+_pool = None
+_pending = []
+_flush_handle = None
+
+
+def _init_worker(model, intra_op_threads, inter_op_threads):
+    _settings.update(model=model, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+
+def _new_session(model, intra_op_threads, inter_op_threads):
+    import onnxruntime as ort
+    from rembg import new_session, sessions
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    for session_class in getattr(sessions, "sessions_class", []):
+        if session_class.name() == model:
+            return session_class(model, options)
+    # Older rembg releases don't expose the session classes; threads then follow OMP_NUM_THREADS
+    return new_session(model)
+
+
+def _get_session():
+    # Loaded on first use rather than in the initializer so a missing model or
+    # library surfaces as a normal error instead of a broken pool
+    global _session
+    if _session is None:
+        print(f"Loading rembg model {_settings['model']} in worker")
+        _session = _new_session(_settings["model"], _settings["intra_op_threads"], _settings["inter_op_threads"])
+    return _session
+
+
+def _warm_up():
+    _get_session()
+
+
+def _remove_batch(items):
+    """Remove the background for each ``(input_path, output_path)``; returns an error message or None per item."""
+    from rembg import remove
+
+    session = _get_session()
+    errors = []
+    for input_path, output_path in items:
+        try:
+            with open(input_path, "rb") as i:
+                output_data = remove(i.read(), session=session)
+            with open(output_path, "wb") as o:
+                o.write(output_data)
+            errors.append(None)
+        except Exception as e:
+            errors.append(str(e))
+    return errors
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = executor.new_process_pool(
+            REMBG_WORKERS,
+            initializer=_init_worker,
+            initargs=(REMBG_MODEL, REMBG_INTRA_OP_THREADS, REMBG_INTER_OP_THREADS),
+        )
+    return _pool
+
+
+async def _run_batch(batch):
+    global _pool
+    items = [(input_path, output_path) for input_path, output_path, _ in batch]
+    try:
+        errors = await executor.run_in_pool("remove_bg", _get_pool(), _remove_batch, items)
+    except BrokenProcessPool as e:
+        _pool = None
+        errors = [f"Background removal worker crashed: {e}"] * len(batch)
+    except Exception as e:
+        # ImportError for a missing rembg/onnxruntime lands here
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, _, future), error in zip(batch, errors):
+        if future.done():
+            continue
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(RuntimeError(error))
+
+
+def _flush():
+    global _flush_handle
+    _flush_handle = None
+    # A worker handles its batch serially, so spread the burst over every worker
+    batch_size = max(1, min(REMBG_BATCH_SIZE, math.ceil(len(_pending) / REMBG_WORKERS)))
+    while _pending:
+        batch = _pending[:batch_size]
+        del _pending[:batch_size]
+        asyncio.ensure_future(_run_batch(batch))
+
+
+async def remove_background(input_path, output_path):
+    """Write ``input_path`` with its background removed to ``output_path`` as PNG."""
+    global _flush_handle
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _pending.append((input_path, output_path, future))
+    if len(_pending) >= REMBG_BATCH_SIZE:
+        if _flush_handle is not None:
+            _flush_handle.cancel()
+        _flush()
+    elif _flush_handle is None:
+        _flush_handle = loop.call_later(REMBG_BATCH_WINDOW_MS / 1000, _flush)
+    await future
+
+
+async def preload():
+    """Load the model in every worker ahead of the first request."""
+    pool = _get_pool()
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*[loop.run_in_executor(pool, _warm_up) for _ in range(REMBG_WORKERS)])
+    except Exception as e:
+        print(f"Could not preload rembg model: {e}")
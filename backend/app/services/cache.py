@@ -0,0 +1,238 @@
+"""
+Content-addressed result cache.
+
+A key is the SHA-256 of the tool name, the input hashes (computed while the
+upload streams in, see ``uploads.save_upload``) and the form parameters that
+change the output. Artifacts live under ``CACHE_DIR`` with a SQLite index
+that tracks size and last use, and the least recently used entries are
+evicted once the cache grows past ``CACHE_MAX_MB``.
+
+Handlers follow the same three steps::
+
+    cache_key = cache.make_key("images.convert", [digest], target_format=target_format)
+    hit = await cache.cached_response(cache_key, filename=output_filename)
+    if hit is not None:
+        return hit
+    ...
+    await cache.store_file(cache_key, output_path, media_type)
+
+Requests carrying the bypass header get ``None`` from ``make_key`` and are
+neither served from nor stored in the cache.
+"""
+import contextvars
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from fastapi.responses import FileResponse
+
+from ..config import CACHE_DIR, CACHE_MAX_MB, CACHE_BYPASS_HEADER
+from .executor import run_io
+
+_bypass = contextvars.ContextVar("cache_bypass", default=False)
+
+stats = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0, "evicted": 0}
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, "index.sqlite3"), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    media_type TEXT,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used)")
+
+    def _entry_path(self, key):
+        directory = os.path.join(self.directory, key[0:2], key[2:4])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, key)
+
+    def get(self, key, max_age=None):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row["path"]):
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            # Storing an entry links or renames its file, which resets ctime, so ctime is the store time
+            if max_age is not None and time.time() - os.path.getctime(row["path"]) > max_age:
+                return None
+            self._conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return dict(row)
+
+    def _put(self, key, write, media_type):
+        path = self._entry_path(key)
+        tmp_path = f"{path}.tmp{threading.get_ident()}"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, path, media_type, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, path, media_type, size, time.time()),
+            )
+        stats["stored"] += 1
+        self._evict()
+
+    def put_file(self, key, src_path, media_type):
+        def write(tmp_path):
+            # Hard-link when OUTPUT_DIR and the cache share a filesystem, copy otherwise
+            try:
+                os.link(src_path, tmp_path)
+            except OSError:
+                shutil.copyfile(src_path, tmp_path)
+        self._put(key, write, media_type)
+
+    def read_bytes(self, key, max_age=None):
+        entry = self.get(key, max_age)
+        if entry is None:
+            return None
+        with open(entry["path"], "rb") as f:
+            return f.read()
+
+    def put_bytes(self, key, data, media_type):
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+        self._put(key, write, media_type)
+
+    def _evict(self):
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for row in self._conn.execute("SELECT key, path, size FROM entries ORDER BY last_used"):
+                if total <= self.max_bytes:
+                    break
+                victims.append((row["key"], row["path"]))
+                total -= row["size"]
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in victims])
+        for _, path in victims:
+            if os.path.exists(path):
+                os.remove(path)
+        stats["evicted"] += len(victims)
+
+    def summary(self):
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": entries, "size_bytes": size, "max_bytes": self.max_bytes}
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResultCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024)
+    return _cache
+
+
+def contains(path):
+    """Whether ``path`` is a cache entry, which eviction may delete at any time."""
+    directory = os.path.abspath(get_cache().directory)
+    return os.path.abspath(path).startswith(directory + os.sep)
+
+
+class CacheBypassMiddleware:
+    """Flag requests that carry the bypass header so handlers skip the cache."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        header = dict(scope["headers"]).get(CACHE_BYPASS_HEADER.lower().encode("latin-1"), b"")
+        token = _bypass.set(header.strip().lower() in (b"1", b"true", b"yes"))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _bypass.reset(token)
+
+
+def make_key(tool, digests, **params):
+    """Cache key for ``tool`` applied to inputs with ``digests``, or None when the request bypasses the cache."""
+    if _bypass.get():
+        stats["bypassed"] += 1
+        return None
+    material = json.dumps({"tool": tool, "inputs": list(digests), "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+async def cached_response(key, filename=None, headers=None, max_age=None):
+    """A response serving the cached artifact for ``key``, or None on a miss or if older than ``max_age`` seconds."""
+    if key is None:
+        return None
+    entry = await run_io("cache", get_cache().get, key, max_age)
+    if entry is None:
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    response_headers = {"X-Cache": "HIT"}
+    response_headers.update(headers or {})
+    return FileResponse(entry["path"], filename=filename, media_type=entry["media_type"], headers=response_headers)
+
+
+async def cached_path(key):
+    """Path of the cached artifact for ``key``, or None on a miss."""
+    if key is None:
+        return None
+    entry = await run_io("cache", get_cache().get, key)
+    if entry is None:
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    return entry["path"]
+
+
+async def cached_json(key, max_age=None):
+    """The cached JSON value for ``key`` (small metadata results), or None on a miss."""
+    if key is None:
+        return None
+    data = await run_io("cache", get_cache().read_bytes, key, max_age)
+    if data is None:
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    return json.loads(data)
+
+
+async def store_json(key, value):
+    await store_bytes(key, json.dumps(value).encode("utf-8"), "application/json")
+
+
+async def store_file(key, path, media_type):
+    if key is not None:
+        await run_io("cache", get_cache().put_file, key, path, media_type)
+
+
+async def store_bytes(key, data, media_type):
+    if key is not None:
+        await run_io("cache", get_cache().put_bytes, key, data, media_type)
+
+
+def summary():
+    return {**stats, **get_cache().summary()}
@@ -0,0 +1,216 @@
+"""
+yt-dlp downloads with a result cache and shared in-flight work.
+
+- The connectivity pre-flight (DNS + HTTPS to ``DOWNLOAD_CONNECTIVITY_URL``)
+  is cached for ``DOWNLOAD_CONNECTIVITY_TTL_SECONDS``. Nothing runs on a
+  timer: the first request to find the result stale is still answered from
+  it and starts a refresh in the background. A failed check is retried on
+  the next request instead of being cached.
+- Finished downloads are stored in the result cache under the video id (or
+  the normalized URL) and format, and served from there for
+  ``DOWNLOAD_CACHE_TTL_SECONDS``.
+- Concurrent requests for the same video and format share one download.
+- At most ``CONCURRENCY_DOWNLOADS`` yt-dlp runs happen at once.
+"""
+import asyncio
+import os
+import socket
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from fastapi import HTTPException
+from starlette.background import BackgroundTask
+
+from ..config import (
+    DOWNLOAD_CACHE_TTL_SECONDS, DOWNLOAD_CONNECTIVITY_TTL_SECONDS, DOWNLOAD_CONNECTIVITY_URL,
+    DOWNLOAD_CONCURRENT_FRAGMENTS,
+)
+from . import cache, storage
+from .executor import run_io, get_thread_pool
+
+_connectivity = {"error": None, "checked_at": None}
+_connectivity_check = None
+_inflight = {}
+
+
+def video_key(url):
+    """A stable identity for ``url``: the video id for YouTube links, else the URL without its fragment."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if host.startswith("www.") or host.startswith("m."):
+        host = host.split(".", 1)[1]
+    if host == "youtu.be" and parts.path.strip("/"):
+        return f"youtube:{parts.path.strip('/').split('/')[0]}"
+    if host in ("youtube.com", "music.youtube.com"):
+        video_id = parse_qs(parts.query).get("v")
+        if video_id:
+            return f"youtube:{video_id[0]}"
+        segments = parts.path.strip("/").split("/")
+        if len(segments) == 2 and segments[0] in ("shorts", "embed", "live"):
+            return f"youtube:{segments[1]}"
+    return parts._replace(fragment="").geturl()
+
+
+def _check_connectivity():
+    """Error message if the download host is unreachable, else None."""
+    import requests
+
+    try:
+        socket.gethostbyname(urlsplit(DOWNLOAD_CONNECTIVITY_URL).hostname)
+        # HEAD is enough to prove HTTPS works; the page body isn't needed
+        requests.head(DOWNLOAD_CONNECTIVITY_URL, timeout=10)
+    except socket.gaierror as e:
+        return (
+            f"DNS Resolution Error: Cannot resolve domain names. This usually means:\n"
+            f"1. Docker container has no internet access\n"
+            f"2. DNS servers are not configured\n"
+            f"3. Firewall is blocking connections\n\n"
+            f"Fix: Run 'docker run --dns 8.8.8.8 --dns 8.8.4.4 ...' or check your network settings.\n"
+            f"Technical details: {str(e)}"
+        )
+    except Exception as e:
+        return f"Network Error: Cannot connect to the internet. Details: {str(e)}"
+    return None
+
+
+async def _refresh_connectivity():
+    # Straight to the thread pool: the "downloads" slots may all be busy with long downloads
+    loop = asyncio.get_running_loop()
+    error = await loop.run_in_executor(get_thread_pool(), _check_connectivity)
+    _connectivity.update(error=error, checked_at=time.time())
+    if error:
+        print(f"Download connectivity check failed: {error.splitlines()[0]}")
+
+
+def _start_connectivity_check():
+    global _connectivity_check
+    if _connectivity_check is None or _connectivity_check.done():
+        _connectivity_check = asyncio.ensure_future(_refresh_connectivity())
+    return _connectivity_check
+
+
+async def ensure_online():
+    """Raise HTTP 500 if the download host is unreachable, using the cached check where possible."""
+    checked_at = _connectivity["checked_at"]
+    if checked_at is None or _connectivity["error"]:
+        # Nothing trustworthy cached yet: wait for a check (shared with concurrent requests)
+        await asyncio.shield(_start_connectivity_check())
+    elif time.time() - checked_at > DOWNLOAD_CONNECTIVITY_TTL_SECONDS:
+        _start_connectivity_check()
+    if _connectivity["error"]:
+        raise HTTPException(status_code=500, detail=_connectivity["error"])
+
+
+def _ydl_options(fmt, download_dir):
+    if fmt == "mp4":
+        selector = "bestvideo+bestaudio/best"
+        postprocessors = [{"key": "FFmpegVideoConvertor", "preferedformat": fmt}]
+    else:
+        selector = "bestaudio/best"
+        postprocessors = [{"key": "FFmpegExtractAudio", "preferredcodec": fmt}]
+    return {
+        "format": selector,
+        "outtmpl": os.path.join(download_dir, "%(title)s.%(ext)s"),
+        "postprocessors": postprocessors,
+        "quiet": True,
+        "no_warnings": True,
+        "noprogress": True,
+        "force_ipv4": True,
+        "socket_timeout": 30,
+        "retries": 3,
+        "fragment_retries": 3,
+        "concurrent_fragment_downloads": DOWNLOAD_CONCURRENT_FRAGMENTS,
+        # Keep the file's mtime as the download time rather than the server's Last-Modified
+        "updatetime": False,
+    }
+
+
+def _ydl_download(url, fmt, download_dir):
+    """Download ``url`` into ``download_dir`` and return the final (post-processed) file path."""
+    import yt_dlp
+
+    with yt_dlp.YoutubeDL(_ydl_options(fmt, download_dir)) as ydl:
+        info = ydl.extract_info(url, download=True)
+        # yt-dlp records where each download ended up after post-processing
+        for download in info.get("requested_downloads") or []:
+            if download.get("filepath") and os.path.exists(download["filepath"]):
+                return download["filepath"]
+        # Older releases: the post-processor only swaps the extension
+        base, _ = os.path.splitext(ydl.prepare_filename(info))
+        for candidate in (f"{base}.{fmt}", ydl.prepare_filename(info)):
+            if os.path.exists(candidate):
+                return candidate
+    raise RuntimeError("Downloaded file not found")
+
+
+class _Download:
+    """One yt-dlp run shared by every request for the same video and format."""
+
+    def __init__(self):
+        self.users = 0
+        self.task = None
+
+    def _cleanup(self):
+        # Failed downloads clean up after themselves in _download
+        if self.users == 0 and self.task.done() and not self.task.cancelled() and not self.task.exception():
+            storage.remove(os.path.dirname(self.task.result()))
+
+    def release(self):
+        self.users -= 1
+        self._cleanup()
+
+    def finished(self, shared_key):
+        _inflight.pop(shared_key, None)
+        # Every requester may have gone away while it ran
+        self._cleanup()
+
+
+async def _download(url, fmt, media_type, cache_key, meta_key):
+    download_dir = storage.output_path(storage.new_file_id())
+    os.makedirs(download_dir, exist_ok=True)
+    try:
+        path = await run_io("downloads", _ydl_download, url, fmt, download_dir)
+        await cache.store_file(cache_key, path, media_type)
+        await cache.store_json(meta_key, {"filename": os.path.basename(path)})
+        return path
+    except BaseException:
+        storage.remove(download_dir)
+        raise
+
+
+def cache_keys(url, fmt):
+    key = video_key(url)
+    return cache.make_key("media.download", [key], format=fmt), cache.make_key("media.download.meta", [key], format=fmt)
+
+
+async def cached(url, fmt, headers=None):
+    """A response for a download of ``url`` cached within the TTL, or None."""
+    cache_key, meta_key = cache_keys(url, fmt)
+    meta = await cache.cached_json(meta_key, max_age=DOWNLOAD_CACHE_TTL_SECONDS)
+    if meta is None:
+        return None
+    return await cache.cached_response(
+        cache_key, filename=meta["filename"], headers=headers, max_age=DOWNLOAD_CACHE_TTL_SECONDS
+    )
+
+
+async def download(url, fmt, media_type):
+    """
+    Download ``url`` as ``fmt``, joining an identical download already in progress. Returns the
+    file path and a background task that cleans it up once the response has been sent.
+    """
+    cache_key, meta_key = cache_keys(url, fmt)
+    shared_key = (video_key(url), fmt)
+    entry = _inflight.get(shared_key)
+    if entry is None:
+        entry = _inflight[shared_key] = _Download()
+        entry.task = asyncio.ensure_future(_download(url, fmt, media_type, cache_key, meta_key))
+        entry.task.add_done_callback(lambda _: entry.finished(shared_key))
+    entry.users += 1
+    try:
+        # Shielded so one client going away doesn't cancel the download for the others
+        path = await asyncio.shield(entry.task)
+    except BaseException:
+        entry.release()
+        raise
+    return path, BackgroundTask(entry.release)
@@ -0,0 +1,108 @@
+"""
+Shared execution layer for blocking conversion work.
+
+Handlers are ``async def`` and run on the event loop, so anything that blocks
+(FFmpeg, PyMuPDF, Pillow, pdf2docx, rembg...) has to be dispatched here:
+
+- ``run_cpu`` sends a picklable, module-level function to a process pool
+- ``run_io`` sends a function to a thread pool (file I/O, subprocess waits)
+
+Every call is tagged with a tool name and gated by that tool's semaphore from
+``TOOL_CONCURRENCY`` so one slow tool cannot take every worker slot.
+"""
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ..config import CPU_WORKERS, IO_WORKERS, WORKER_START_METHOD, TOOL_CONCURRENCY
+
+_process_pool = None
+_thread_pool = None
+_dedicated_pools = []
+_semaphores = {}
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=CPU_WORKERS,
+            mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+        )
+    return _process_pool
+
+
+def new_process_pool(max_workers, initializer=None, initargs=()):
+    """A separate process pool for tools that keep expensive per-process state, such as loaded models."""
+    pool = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+        initializer=initializer,
+        initargs=initargs,
+    )
+    _dedicated_pools.append(pool)
+    return pool
+
+
+def get_thread_pool():
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io-worker")
+    return _thread_pool
+
+
+def _get_semaphore(tool):
+    # Created lazily so the semaphore binds to the running event loop
+    semaphore = _semaphores.get(tool)
+    if semaphore is None:
+        limit = TOOL_CONCURRENCY.get(tool, TOOL_CONCURRENCY["default"])
+        semaphore = asyncio.Semaphore(limit)
+        _semaphores[tool] = semaphore
+    return semaphore
+
+
+def limiter(tool):
+    """``tool``'s semaphore, for work that runs outside the pools (e.g. asyncio subprocesses)."""
+    return _get_semaphore(tool)
+
+
+async def run_cpu(tool, fn, *args, **kwargs):
+    """Run ``fn(*args, **kwargs)`` in the process pool under ``tool``'s limit."""
+    global _process_pool
+    async with _get_semaphore(tool):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(get_process_pool(), functools.partial(fn, *args, **kwargs))
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed); drop the pool so the next call gets a fresh one
+            _process_pool = None
+            raise
+
+
+async def run_in_pool(tool, pool, fn, *args, **kwargs):
+    """Run ``fn(*args, **kwargs)`` in a pool from ``new_process_pool`` under ``tool``'s limit."""
+    async with _get_semaphore(tool):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+
+
+async def run_io(tool, fn, *args, **kwargs):
+    """Run ``fn(*args, **kwargs)`` in the thread pool under ``tool``'s limit."""
+    async with _get_semaphore(tool):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_thread_pool(), functools.partial(fn, *args, **kwargs))
+
+
+def shutdown():
+    global _process_pool, _thread_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    for pool in _dedicated_pools:
+        pool.shutdown(wait=False, cancel_futures=True)
+    _dedicated_pools.clear()
@@ -0,0 +1,380 @@
+"""
+Asynchronous FFmpeg runs with live progress and cancellation.
+
+``run`` starts FFmpeg as an asyncio subprocess with ``-progress pipe:1`` and
+parses the key=value blocks it prints (frame, out_time, speed...) into a
+``Progress`` record registered under a task id. Clients pick the task id
+(e.g. a UUID sent as the ``task_id`` form field), then follow it through
+``/media/progress/{task_id}`` (SSE) or its WebSocket twin, and can cancel
+it, which kills the FFmpeg process and frees its slot.
+
+Only the tail of stderr is kept, for error messages, instead of buffering
+all of it until FFmpeg exits.
+"""
+import asyncio
+import collections
+import contextlib
+import functools
+import re
+import subprocess
+import threading
+import time
+import uuid
+
+import ffmpeg
+from fastapi import HTTPException
+
+from ..config import FFMPEG_PROGRESS_RETENTION_SECONDS, FFMPEG_STREAM_BUFFER_MB, FFMPEG_STREAM_SEND_TIMEOUT_SECONDS
+from . import jobs
+from .executor import limiter, get_thread_pool
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+_STDERR_TAIL_LINES = 50
+_STREAM_CHUNK_SIZE = 64 * 1024
+# A "key=value" line of -progress output, as opposed to an FFmpeg log message
+_PROGRESS_LINE = re.compile(rb"^[\w.]+=\S*\s*$")
+
+_tasks = {}
+
+
+class Progress:
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.state = PENDING
+        self.duration = None
+        self.stats = {}
+        # FFmpeg processes currently running for this task (several for segmented work)
+        self.processes = set()
+        self.cancelled = False
+        self.reported_percent = -1.0
+        self.updated_at = time.time()
+        self._changed = asyncio.Event()
+
+    def snapshot(self):
+        return {"task_id": self.task_id, "state": self.state, "duration": self.duration, **self.stats}
+
+    def notify(self):
+        self.updated_at = time.time()
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self, timeout):
+        """Wait for the next update; returns False on timeout."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def new_task_id():
+    return str(uuid.uuid4())
+
+
+def get(task_id):
+    return _tasks.get(task_id)
+
+
+def get_or_create(task_id):
+    progress = _tasks.get(task_id)
+    if progress is None:
+        progress = _tasks[task_id] = Progress(task_id)
+    return progress
+
+
+def _forget_later(task_id):
+    asyncio.get_running_loop().call_later(FFMPEG_PROGRESS_RETENTION_SECONDS, _tasks.pop, task_id, None)
+
+
+def forget_if_pending(task_id):
+    """Drop a record a subscriber created for a task that never started."""
+    progress = _tasks.get(task_id)
+    if progress is not None and progress.state == PENDING:
+        _tasks.pop(task_id, None)
+
+
+def cancel(task_id):
+    """Cancel a running or not-yet-started task. Returns False if it is unknown or already finished."""
+    progress = _tasks.get(task_id)
+    if progress is None or progress.state in FINISHED:
+        return False
+    progress.cancelled = True
+    for process in list(progress.processes):
+        _kill(process)
+    return True
+
+
+def _kill(process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            # Exited between the check and the kill
+            pass
+
+
+def _parse_seconds(stats):
+    # out_time_us is microseconds; older builds misreport out_time_ms as microseconds too
+    for key in ("out_time_us", "out_time_ms"):
+        value = stats.get(key, "")
+        if value.isdigit():
+            return int(value) / 1_000_000
+    return None
+
+
+def _parse_speed(value):
+    try:
+        return float(value.rstrip("x"))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _publish(progress, seconds, speed, offset, span, **extra):
+    stats = {"time": seconds, "speed": speed, "percent": None, "eta": None, **extra}
+    if seconds is not None and progress.duration:
+        # A run may cover only part of the task (e.g. the second of two passes)
+        fraction = min(1.0, seconds / progress.duration)
+        stats["percent"] = round(100 * (offset + span * fraction), 1)
+        if speed:
+            stats["eta"] = round((progress.duration - seconds) / speed, 1)
+    progress.stats = stats
+    progress.notify()
+    percent = stats["percent"]
+    if percent is not None and percent - progress.reported_percent >= 1:
+        jobs.report_progress(percent / 100)
+        progress.reported_percent = percent
+
+
+def _update(progress, raw, offset, span):
+    _publish(
+        progress, _parse_seconds(raw), _parse_speed(raw.get("speed")), offset, span,
+        frame=int(raw["frame"]) if raw.get("frame", "").isdigit() else None,
+        fps=_parse_speed(raw.get("fps")),
+    )
+
+
+class _ProgressReader:
+    """Collects ``-progress`` output lines into blocks and hands each finished block to ``on_block``."""
+
+    def __init__(self, on_block):
+        self.on_block = on_block
+        self.raw = {}
+
+    def feed(self, line):
+        key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+        if key != "progress":
+            self.raw[key] = value
+            return
+        self.on_block(self.raw)
+        self.raw = {}
+
+
+async def _read_lines(stream, callback):
+    async for line in stream:
+        callback(line)
+
+
+def _wait_blocking(process, reader, tail, loop):
+    stderr_thread = threading.Thread(target=tail.extend, args=(process.stderr,), daemon=True)
+    stderr_thread.start()
+    for line in process.stdout:
+        loop.call_soon_threadsafe(reader.feed, line)
+    stderr_thread.join()
+    return process.wait()
+
+
+@contextlib.asynccontextmanager
+async def task(task_id=None, duration=None):
+    """
+    Track one conversion, made of one or more ``run`` calls, under ``task_id``. Yields its
+    ``Progress``; the task ends done, failed or cancelled depending on how the block exits.
+    """
+    task_id = task_id or jobs.current_job_id() or new_task_id()
+    progress = get_or_create(task_id)
+    if progress.state in FINISHED:
+        # A client reusing an old task id starts a fresh record
+        progress = _tasks[task_id] = Progress(task_id)
+    if duration:
+        progress.duration = duration
+    try:
+        yield progress
+    except BaseException:
+        progress.state = CANCELLED if progress.cancelled else FAILED
+        raise
+    else:
+        progress.state = DONE
+        progress.stats.update(percent=100.0, eta=0)
+    finally:
+        progress.processes.clear()
+        progress.notify()
+        _forget_later(task_id)
+
+
+def _check_cancelled(progress):
+    if progress.cancelled:
+        raise HTTPException(status_code=409, detail="Conversion was cancelled")
+
+
+async def run(stream, progress, tool="media", offset=0.0, span=1.0, on_block=None):
+    """
+    Run a compiled ffmpeg-python ``stream`` under ``tool``'s concurrency limit, reporting into
+    ``progress`` (from ``task``). Raises ``ffmpeg.Error`` on failure and HTTP 409 when cancelled.
+
+    ``offset``/``span`` map this run onto a slice of the task's progress, e.g. 0.5/0.5 for the
+    second of two passes. ``on_block`` replaces the default handling of each progress block.
+    """
+    args = ffmpeg.compile(stream, overwrite_output=True)
+    args = [args[0], "-hide_banner", "-nostats", "-progress", "pipe:1", *args[1:]]
+    tail = collections.deque(maxlen=_STDERR_TAIL_LINES)
+
+    reader = _ProgressReader(on_block or (lambda raw: _update(progress, raw, offset, span)))
+    loop = asyncio.get_running_loop()
+
+    async with limiter(tool):
+        _check_cancelled(progress)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+        except NotImplementedError:
+            # Selector event loops on Windows (e.g. uvicorn --reload) can't spawn asyncio subprocesses
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        progress.processes.add(process)
+        progress.state = RUNNING
+        progress.notify()
+        try:
+            if isinstance(process, subprocess.Popen):
+                # Straight to the thread pool: run_io would wait on the "media" slot this call already holds
+                returncode = await loop.run_in_executor(get_thread_pool(), _wait_blocking, process, reader, tail, loop)
+            else:
+                await asyncio.gather(_read_lines(process.stdout, reader.feed), _read_lines(process.stderr, tail.append))
+                returncode = await process.wait()
+        finally:
+            # Also reached when the request itself is cancelled; don't leave FFmpeg running
+            _kill(process)
+            progress.processes.discard(process)
+
+    _check_cancelled(progress)
+    if returncode != 0:
+        raise ffmpeg.Error("ffmpeg", b"", b"".join(tail))
+
+
+async def run_parallel(runs, progress, tool="media", offset=0.0, span=1.0):
+    """
+    Run several ``(stream, duration)`` pairs at once, reporting their combined progress as one
+    slice of the task. If one fails the others are killed.
+    """
+    total = sum(duration or 0 for _, duration in runs)
+    done = [0.0] * len(runs)
+    speeds = [0.0] * len(runs)
+
+    def on_block(index, raw):
+        seconds = _parse_seconds(raw)
+        if seconds is not None:
+            done[index] = seconds
+        speeds[index] = _parse_speed(raw.get("speed")) or 0.0
+        # Express the combined position on the task's own timeline so percent and ETA stay meaningful
+        scale = (progress.duration or total) / total if total else 0
+        combined_speed = sum(speeds) * scale or None
+        _publish(progress, sum(done) * scale if total else None, combined_speed, offset, span, segments=len(runs))
+
+    tasks = [
+        asyncio.ensure_future(run(stream, progress, tool, on_block=functools.partial(on_block, index)))
+        for index, (stream, _) in enumerate(runs)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for pending in tasks:
+            pending.cancel()
+        raise
+
+
+async def _drain(stream):
+    while await stream.read(_STREAM_CHUNK_SIZE):
+        pass
+
+
+async def _pump_output(args, progress, tool, buffer, on_stderr):
+    """Run FFmpeg for ``stream_output``, feeding its stdout into ``buffer``; raises like ``run``."""
+    async with limiter(tool):
+        _check_cancelled(progress)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+        except NotImplementedError:
+            raise HTTPException(status_code=501, detail="Streaming output is not available on this server's event loop.")
+        progress.processes.add(process)
+        progress.state = RUNNING
+        progress.notify()
+        stderr_task = asyncio.ensure_future(_read_lines(process.stderr, on_stderr))
+        try:
+            while True:
+                chunk = await process.stdout.read(_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                try:
+                    await asyncio.wait_for(buffer.put(chunk), FFMPEG_STREAM_SEND_TIMEOUT_SECONDS)
+                except asyncio.TimeoutError:
+                    # The encode slot is shared with every other conversion; don't let a stalled client keep it
+                    raise TimeoutError(f"Client took no data for {FFMPEG_STREAM_SEND_TIMEOUT_SECONDS}s")
+            await stderr_task
+            returncode = await process.wait()
+        finally:
+            # Also reached when the client goes away mid-stream. FFmpeg is reaped before the slot is
+            # given back; wait() only returns once its pipes have been read to the end.
+            stderr_task.cancel()
+            _kill(process)
+            await asyncio.gather(_drain(process.stdout), _drain(process.stderr))
+            await process.wait()
+            progress.processes.discard(process)
+
+    _check_cancelled(progress)
+    return returncode
+
+
+async def stream_output(stream, progress, tool="media"):
+    """
+    Run a ``stream`` whose output is ``pipe:1`` and yield FFmpeg's stdout as it is produced, so a
+    response can start before the encode finishes. Progress moves to stderr for these runs.
+    Raises like ``run`` once the output ends, and ``TimeoutError`` if the consumer stops taking
+    data: FFmpeg runs ahead into a bounded buffer and is stopped rather than wait on a stalled client.
+    """
+    args = ffmpeg.compile(stream, overwrite_output=True)
+    args = [args[0], "-hide_banner", "-nostats", "-loglevel", "error", "-progress", "pipe:2", *args[1:]]
+    tail = collections.deque(maxlen=_STDERR_TAIL_LINES)
+    reader = _ProgressReader(lambda raw: _update(progress, raw, 0.0, 1.0))
+
+    def on_stderr(line):
+        if _PROGRESS_LINE.match(line):
+            reader.feed(line)
+        else:
+            tail.append(line)
+
+    buffer = asyncio.Queue(maxsize=max(1, FFMPEG_STREAM_BUFFER_MB * 1024 * 1024 // _STREAM_CHUNK_SIZE))
+    pump = asyncio.ensure_future(_pump_output(args, progress, tool, buffer, on_stderr))
+    try:
+        while True:
+            getter = asyncio.ensure_future(buffer.get())
+            await asyncio.wait({getter, pump}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                break
+            yield getter.result()
+        if pump.exception() is None:
+            # FFmpeg is done; hand over the rest of what it wrote
+            while not buffer.empty():
+                yield buffer.get_nowait()
+        returncode = pump.result()
+    finally:
+        pump.cancel()
+
+    if returncode != 0:
+        raise ffmpeg.Error("ffmpeg", b"", b"".join(tail))
@@ -0,0 +1,346 @@
+"""
+Persistent job queue for long-running conversions.
+
+Jobs are stored in a local SQLite database so queued work survives a restart.
+A job body is an existing router handler: submitted form fields are bound to
+its parameters, uploads are replayed from disk as ``UploadFile`` objects, and
+the ``FileResponse``/``Response`` it returns becomes the job's artifact.
+"""
+import asyncio
+import contextvars
+import inspect
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.datastructures import UploadFile as StarletteUploadFile
+
+from ..config import JOBS_DB, JOB_WORKERS, JOB_POLL_SECONDS, JOB_UPLOAD_DIR, OUTPUT_TTL_SECONDS
+from . import cache, storage
+from .executor import get_thread_pool, run_io
+from .uploads import save_upload, tool_for_path
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_REQUIRED = object()
+
+_tools = {}
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class JobStore:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    tool TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    params TEXT NOT NULL,
+                    files TEXT NOT NULL,
+                    result_path TEXT,
+                    result_filename TEXT,
+                    media_type TEXT,
+                    error TEXT,
+                    status_code INTEGER,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+
+    def create(self, job_id, tool, params, files):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, tool, state, params, files, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, tool, QUEUED, json.dumps(params), json.dumps(files), now, now),
+            )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def claim(self):
+        """Atomically move the oldest queued job to running and return it."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE state = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET state = ?, progress = 0, updated_at = ? WHERE id = ?",
+                        (RUNNING, time.time(), row["id"]),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return dict(row) if row else None
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def set_progress(self, job_id, progress):
+        # Only while running: a report that lands late must not undo the final state
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ? AND state = ?",
+                (progress, time.time(), job_id, RUNNING),
+            )
+
+    def purge(self, older_than):
+        """Drop finished jobs last touched before ``older_than``; their artifacts have expired by then."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?", (DONE, FAILED, older_than)
+            )
+
+    def result_paths(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT result_path FROM jobs WHERE state = ? AND result_path IS NOT NULL", (DONE,)).fetchall()
+        return [row["result_path"] for row in rows]
+
+    def requeue_interrupted(self):
+        # Anything still "running" at startup was cut off by a restart; its input is still on disk
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, progress = 0, updated_at = ? WHERE state = ?",
+                (QUEUED, time.time(), RUNNING),
+            )
+
+
+store = None
+_wakeup = None
+_workers = []
+
+# job id -> latest progress not yet written; an entry also means a write is under way
+_progress = {}
+_progress_lock = threading.Lock()
+
+
+def register(tool, handler):
+    _tools[tool] = handler
+
+
+def tools():
+    return sorted(_tools)
+
+
+def current_job_id():
+    """Id of the job the caller is running under, or None for a plain request."""
+    return _current_job.get()
+
+
+def _save_progress(job_id):
+    while True:
+        with _progress_lock:
+            fraction = _progress[job_id]
+        store.set_progress(job_id, fraction)
+        with _progress_lock:
+            # Reports that came in meanwhile were folded into one; write the newest of them
+            if _progress[job_id] == fraction:
+                del _progress[job_id]
+                return
+
+
+def report_progress(fraction):
+    """
+    Let a job body report progress (0.0 - 1.0) for the job it is running under. The SQLite write
+    happens in the thread pool, one at a time per job, so the caller never waits on the database.
+    """
+    job_id = _current_job.get()
+    if job_id is None or store is None:
+        return
+    with _progress_lock:
+        idle = job_id not in _progress
+        _progress[job_id] = max(0.0, min(1.0, float(fraction)))
+    if idle:
+        get_thread_pool().submit(_save_progress, job_id)
+
+
+def _default_of(param):
+    default = param.default
+    # Unwrap Form(...)/File(...) markers to the plain default value
+    if hasattr(default, "default"):
+        default = default.default
+    if default is inspect.Parameter.empty or default is Ellipsis or type(default).__name__ == "PydanticUndefinedType":
+        return _REQUIRED
+    return default
+
+
+def _coerce(value, annotation):
+    if annotation is bool:
+        return value.lower() in ("1", "true", "yes", "on")
+    if annotation in (int, float):
+        return annotation(value)
+    return value
+
+
+def bind_params(tool, form):
+    """Split a submitted form into plain parameters and uploads for ``tool``'s handler."""
+    handler = _tools[tool]
+    params, uploads = {}, {}
+    for name, param in inspect.signature(handler).parameters.items():
+        value = form.get(name)
+        if param.annotation is UploadFile:
+            if not isinstance(value, StarletteUploadFile):
+                raise ValueError(f"Missing file field: {name}")
+            uploads[name] = value
+            continue
+        if value is None:
+            default = _default_of(param)
+            if default is _REQUIRED:
+                raise ValueError(f"Missing form field: {name}")
+            params[name] = default
+            continue
+        try:
+            params[name] = _coerce(value, param.annotation)
+        except ValueError:
+            raise ValueError(f"Invalid value for {name}: {value}")
+    return params, uploads
+
+
+async def submit(tool, params, uploads):
+    job_id = storage.new_file_id()
+    files = {}
+    for name, upload in uploads.items():
+        path = storage.upload_path(job_id, upload.filename, root=JOB_UPLOAD_DIR)
+        await save_upload(upload, tool_for_path(f"/jobs/{tool}"), path)
+        files[name] = {"path": path, "filename": upload.filename}
+    await run_io("default", store.create, job_id, tool, params, files)
+    _wakeup.set()
+    return job_id
+
+
+def _disposition_filename(response):
+    match = re.search(r'filename="?([^";]+)"?', response.headers.get("content-disposition", ""))
+    return match.group(1) if match else None
+
+
+def _store_artifact(job_id, response):
+    # response.background (e.g. storage.remove_after) is tied to sending the response, which a job
+    # never does, so the artifact stays in OUTPUT_DIR until the janitor expires it
+    if isinstance(response, FileResponse):
+        filename = response.filename or os.path.basename(response.path)
+        if not cache.contains(response.path):
+            return response.path, filename, response.media_type
+        # A cache hit: the entry can be evicted at any time, so the job keeps its own copy. Not a
+        # hard link, which would carry the entry's old mtime to the janitor and reset its ctime.
+        path = storage.output_path(job_id, "result")
+        shutil.copyfile(response.path, path)
+        return path, filename, response.media_type
+    path = storage.output_path(job_id, "result")
+    with open(path, "wb") as f:
+        f.write(response.body)
+    return path, _disposition_filename(response) or job_id, response.media_type
+
+
+async def _collect_stream(job_id, response):
+    """Drain a streaming response into the job's artifact file."""
+    path = storage.output_path(job_id, "result")
+    with open(path, "wb") as f:
+        async for chunk in response.body_iterator:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            await run_io("default", f.write, chunk)
+    return FileResponse(path, filename=_disposition_filename(response) or job_id, media_type=response.media_type)
+
+
+async def _execute(job):
+    job_id = job["id"]
+    handler = _tools.get(job["tool"])
+    if handler is None:
+        await run_io("default", store.update, job_id, state=FAILED, error=f"Unknown tool: {job['tool']}", status_code=400)
+        return
+
+    kwargs = json.loads(job["params"])
+    files = json.loads(job["files"])
+    opened = []
+    token = _current_job.set(job_id)
+    try:
+        for name, spec in files.items():
+            f = open(spec["path"], "rb")
+            opened.append(f)
+            kwargs[name] = UploadFile(file=f, filename=spec["filename"])
+
+        response = await handler(**kwargs)
+        if isinstance(response, StreamingResponse):
+            response = await _collect_stream(job_id, response)
+        result_path, result_filename, media_type = await run_io("default", _store_artifact, job_id, response)
+        await run_io(
+            "default", store.update, job_id, state=DONE, progress=1.0,
+            result_path=result_path, result_filename=result_filename, media_type=media_type,
+        )
+    except HTTPException as e:
+        await run_io("default", store.update, job_id, state=FAILED, error=str(e.detail), status_code=e.status_code)
+    except Exception as e:
+        await run_io("default", store.update, job_id, state=FAILED, error=str(e), status_code=500)
+    finally:
+        _current_job.reset(token)
+        for f in opened:
+            f.close()
+        storage.remove(*[spec["path"] for spec in files.values()])
+
+
+async def _worker():
+    while True:
+        # Clear before claiming so a submit that lands in between still wakes us
+        _wakeup.clear()
+        # SQLite waits on its lock and the disk, so keep it off the event loop
+        job = await run_io("default", store.claim)
+        if job is None:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await _execute(job)
+
+
+def _purge_expired(now):
+    store.purge(now - OUTPUT_TTL_SECONDS)
+
+
+def _finished_results():
+    # Results stay until their TTL; evicting one for the quota would turn its download into a 410
+    return store.result_paths()
+
+
+def start():
+    global store, _wakeup
+    store = JobStore(JOBS_DB)
+    store.requeue_interrupted()
+    storage.register_sweeper(_purge_expired)
+    storage.register_protected(_finished_results)
+    _wakeup = asyncio.Event()
+    for _ in range(JOB_WORKERS):
+        _workers.append(asyncio.ensure_future(_worker()))
+
+
+def stop():
+    for task in _workers:
+        task.cancel()
+    _workers.clear()
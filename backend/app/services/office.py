@@ -0,0 +1,269 @@
+"""
+Word/ODT -> PDF through a pool of long-lived headless LibreOffice instances.
+
+Starting soffice costs seconds per document, so ``OFFICE_POOL_SIZE``
+instances are started once, each wrapped by ``unoserver`` with its own
+profile directory and ports, and conversions are dispatched to an idle
+one over unoserver's local XML-RPC socket.
+
+Instances are health-checked in the background and before use. An instance
+is recycled (killed and restarted) when it dies, when a conversion exceeds
+``OFFICE_CONVERSION_TIMEOUT``, or after ``OFFICE_MAX_CONVERSIONS`` documents
+to keep LibreOffice's memory growth in check. One that fails to start is
+left out of the pool and retried by the health check.
+
+Without unoserver, or while no instance is up, ``soffice --convert-to`` is
+run once per document.
+"""
+import asyncio
+import os
+import shutil
+import subprocess
+import time
+import xmlrpc.client
+
+from ..config import (
+    UNOSERVER_PATH, SOFFICE_PATH, OFFICE_POOL_SIZE, OFFICE_BASE_PORT, OFFICE_PROFILE_DIR,
+    OFFICE_STARTUP_TIMEOUT, OFFICE_CONVERSION_TIMEOUT, OFFICE_MAX_CONVERSIONS, OFFICE_HEALTH_INTERVAL_SECONDS,
+)
+from .executor import run_io
+
+_instances = []
+_idle = None
+_health_task = None
+
+
+class _TimeoutTransport(xmlrpc.client.Transport):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class OfficeInstance:
+    def __init__(self, index):
+        self.index = index
+        self.port = OFFICE_BASE_PORT + 2 * index
+        self.uno_port = self.port + 1
+        self.profile_dir = os.path.abspath(os.path.join(OFFICE_PROFILE_DIR, str(index)))
+        self.process = None
+        self.conversions = 0
+        # Up and in the pool; False while starting, and after a failed start until a retry succeeds
+        self.ready = False
+        self.starting = False
+
+    def _proxy(self, timeout):
+        return xmlrpc.client.ServerProxy(
+            f"http://127.0.0.1:{self.port}", allow_none=True, transport=_TimeoutTransport(timeout)
+        )
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.process = subprocess.Popen(
+            [
+                UNOSERVER_PATH,
+                "--interface", "127.0.0.1",
+                "--port", str(self.port),
+                "--uno-port", str(self.uno_port),
+                "--executable", SOFFICE_PATH,
+                "--user-installation", f"file://{self.profile_dir}",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.conversions = 0
+        deadline = time.time() + OFFICE_STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if self.healthy():
+                print(f"LibreOffice instance {self.index} ready on port {self.port}")
+                self.ready = True
+                return
+            time.sleep(0.5)
+        self.stop()
+        raise RuntimeError(f"LibreOffice instance {self.index} did not start within {OFFICE_STARTUP_TIMEOUT}s")
+
+    def stop(self):
+        self.ready = False
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def restart(self):
+        print(f"Recycling LibreOffice instance {self.index}")
+        self.stop()
+        self.start()
+
+    def healthy(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self._proxy(5).info()
+        except xmlrpc.client.Fault:
+            # Older unoserver releases have no info(); answering at all means it is up
+            pass
+        except (OSError, xmlrpc.client.ProtocolError):
+            return False
+        return True
+
+    def convert(self, input_path, output_path):
+        self._proxy(OFFICE_CONVERSION_TIMEOUT).convert(
+            os.path.abspath(input_path), None, os.path.abspath(output_path), "pdf"
+        )
+        self.conversions += 1
+
+
+def pool_available():
+    return shutil.which(UNOSERVER_PATH) is not None and shutil.which(SOFFICE_PATH) is not None
+
+
+def cli_available():
+    return shutil.which(SOFFICE_PATH) is not None
+
+
+def convert_with_cli(input_path, output_path):
+    """One-shot ``soffice --convert-to pdf``; pays the full LibreOffice start-up cost."""
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    # A private profile per call lets several of these run side by side
+    profile_dir = f"{os.path.abspath(output_path)}.profile"
+    try:
+        subprocess.run(
+            [
+                SOFFICE_PATH, "--headless", "--norestore", "--nologo",
+                f"-env:UserInstallation=file://{profile_dir}",
+                "--convert-to", "pdf", "--outdir", output_dir, os.path.abspath(input_path),
+            ],
+            check=True,
+            capture_output=True,
+            timeout=OFFICE_CONVERSION_TIMEOUT,
+        )
+    finally:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+    converted = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(input_path))[0]}.pdf")
+    if converted != os.path.abspath(output_path):
+        os.replace(converted, output_path)
+
+
+async def _start_instance(instance):
+    instance.starting = True
+    try:
+        await run_io("office", instance.start)
+        _idle.put_nowait(instance)
+    except Exception as e:
+        # Stays out of the pool; the health loop tries again
+        print(f"Could not start LibreOffice instance {instance.index}: {e}")
+    finally:
+        instance.starting = False
+
+
+async def _health_loop():
+    while True:
+        await asyncio.sleep(OFFICE_HEALTH_INTERVAL_SECONDS)
+        # Idle instances are checked; busy ones are covered by the conversion timeout
+        for _ in range(_idle.qsize()):
+            instance = _idle.get_nowait()
+            if not instance.ready:
+                # Taken out of service since it was queued; it is retried below
+                continue
+            if not await run_io("office", instance.healthy) and not await _recycle(instance):
+                continue
+            _idle.put_nowait(instance)
+        # Instances that never came up, or failed a restart
+        for instance in _instances:
+            if not instance.ready and not instance.starting:
+                asyncio.ensure_future(_start_instance(instance))
+
+
+def start():
+    """Start the instance pool in the background, if unoserver and soffice are installed."""
+    global _idle, _health_task
+    if not pool_available() or OFFICE_POOL_SIZE <= 0:
+        print("unoserver/soffice not found, Word to PDF falls back to one-shot conversions")
+        return
+    _idle = asyncio.Queue()
+    for index in range(OFFICE_POOL_SIZE):
+        instance = OfficeInstance(index)
+        _instances.append(instance)
+        asyncio.ensure_future(_start_instance(instance))
+    _health_task = asyncio.ensure_future(_health_loop())
+
+
+def stop():
+    global _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        _health_task = None
+    for instance in _instances:
+        instance.stop()
+    _instances.clear()
+
+
+def running():
+    """True while at least one pool instance is up."""
+    return any(instance.ready for instance in _instances)
+
+
+async def _acquire():
+    """An idle, ready instance, or None once no instance is up (or none frees up in time)."""
+    deadline = time.time() + OFFICE_CONVERSION_TIMEOUT
+    while running() and time.time() < deadline:
+        try:
+            # Short waits, so a pool that goes down while we queue is noticed
+            instance = await asyncio.wait_for(_idle.get(), timeout=1)
+        except asyncio.TimeoutError:
+            continue
+        if instance.ready:
+            return instance
+    return None
+
+
+async def _convert_with_cli(input_path, output_path):
+    if not cli_available():
+        raise RuntimeError("No LibreOffice instance is available")
+    await run_io("office", convert_with_cli, input_path, output_path)
+
+
+async def _recycle(instance):
+    """Restart ``instance``; on failure it stays out of the pool until the health loop gets it back up."""
+    try:
+        await run_io("office", instance.restart)
+        return True
+    except Exception as e:
+        print(f"LibreOffice instance {instance.index} failed to restart: {e}")
+        return False
+
+
+async def convert_to_pdf(input_path, output_path):
+    """Convert a Word/ODT/RTF document to PDF on the instance pool, or with a one-shot soffice run."""
+    instance = await _acquire() if running() else None
+    if instance is None:
+        await _convert_with_cli(input_path, output_path)
+        return
+
+    try:
+        if not await run_io("office", instance.healthy) and not await _recycle(instance):
+            # This document goes the slow way
+            await _convert_with_cli(input_path, output_path)
+            return
+        try:
+            await run_io("office", instance.convert, input_path, output_path)
+        except (OSError, xmlrpc.client.ProtocolError):
+            # Timed out or lost the connection: the instance is stuck or gone
+            await _recycle(instance)
+            raise RuntimeError("LibreOffice did not finish the conversion in time")
+        except xmlrpc.client.Fault as e:
+            raise ValueError(f"LibreOffice could not convert the document: {e.faultString}")
+        if instance.conversions >= OFFICE_MAX_CONVERSIONS:
+            await _recycle(instance)
+    finally:
+        if instance.ready:
+            _idle.put_nowait(instance)
@@ -0,0 +1,728 @@
+"""
+PDF operations on PyMuPDF.
+
+Every PDF route goes through this module, so a worker process loads one PDF
+library (PyMuPDF, which pdf2docx needs anyway) instead of PyMuPDF, pypdf and
+PyPDF2 side by side. The operations are module-level functions meant for
+``run_cpu``: they open the input by path and write ``output_path``, so a
+large PDF never travels back through the pool or sits in a response.
+
+Client errors (bad page ranges, wrong passwords) are raised as ValueError;
+HTTPException doesn't survive the trip back from a worker.
+"""
+import io
+import math
+import os
+import re
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from ..config import PDF_RENDER_MAX_MEGAPIXELS
+
+# Output options for documents this module rebuilds: drop unused objects, deflate uncompressed streams
+_REBUILD_OPTIONS = {"garbage": 3, "deflate": True}
+
+
+def open_pdf(path, password=None):
+    """Open ``path`` as a PDF, authenticating with ``password`` if it is encrypted."""
+    doc = fitz.open(path, filetype="pdf")
+    if doc.needs_pass and not doc.authenticate(password or ""):
+        doc.close()
+        raise ValueError("Incorrect password." if password else "The PDF is password protected.")
+    return doc
+
+
+def save(doc, output_path, **options):
+    """Write ``doc`` to ``output_path`` and close it."""
+    try:
+        doc.save(output_path, **options)
+    finally:
+        doc.close()
+
+
+def parse_pages(spec, page_count, strict=False):
+    """
+    0-based page indices for a "1-3,5,7-9" style ``spec``. Pages outside the document are skipped,
+    or with ``strict`` rejected.
+    """
+    indices = []
+    try:
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if "-" in part:
+                start, end = map(int, part.split("-"))
+                indices.extend(range(start - 1, end))
+            else:
+                indices.append(int(part) - 1)
+    except ValueError:
+        raise ValueError(f"Invalid page range {spec!r}. Use a format like 1-3,5,7-9.")
+    if strict:
+        outside = sorted({index + 1 for index in indices if not 0 <= index < page_count})
+        if outside:
+            pages = ", ".join(map(str, outside[:5])) + (", ..." if len(outside) > 5 else "")
+            raise ValueError(f"Page {pages} out of range. The document has {page_count} pages.")
+    return [index for index in indices if 0 <= index < page_count]
+
+
+def page_count(input_path):
+    with open_pdf(input_path) as doc:
+        return len(doc)
+
+
+def page_shards(page_count, shards):
+    """Split pages ``0..page_count-1`` into up to ``shards`` contiguous lists."""
+    size = max(1, math.ceil(page_count / max(shards, 1)))
+    return [list(range(start, min(start + size, page_count))) for start in range(0, page_count, size)]
+
+
+def merge(input_paths, output_path):
+    """Concatenate the PDFs at ``input_paths`` in order."""
+    merged = fitz.open()
+    try:
+        for path in input_paths:
+            with open_pdf(path) as src:
+                merged.insert_pdf(src)
+    except BaseException:
+        merged.close()
+        raise
+    return save(merged, output_path, **_REBUILD_OPTIONS)
+
+
+def select_pages(input_path, pages, output_path):
+    """A new PDF made of the ``pages`` ("1-3,5") of ``input_path``; pages outside the document are an error."""
+    doc = open_pdf(input_path)
+    try:
+        indices = parse_pages(pages, len(doc), strict=True)
+    except ValueError:
+        doc.close()
+        raise
+    if not indices:
+        doc.close()
+        raise ValueError(f"No pages selected. The document has {len(doc)} pages.")
+    doc.select(indices)
+    return save(doc, output_path, **_REBUILD_OPTIONS)
+
+
+def rotate(input_path, angle, output_path):
+    """Rotate every page by ``angle`` degrees (a multiple of 90) on top of its current rotation."""
+    doc = open_pdf(input_path)
+    for page in doc:
+        page.set_rotation((page.rotation + angle) % 360)
+    # Rotation adds no objects, so there is nothing for garbage collection to drop
+    return save(doc, output_path)
+
+
+def info(input_path):
+    with fitz.open(input_path, filetype="pdf") as doc:
+        metadata = doc.metadata or {}
+        return {
+            "pages": len(doc),
+            "title": metadata.get("title") or "N/A",
+            "author": metadata.get("author") or "N/A",
+            "subject": metadata.get("subject") or "N/A",
+            "creator": metadata.get("creator") or "N/A",
+            "producer": metadata.get("producer") or "N/A",
+            "creation_date": metadata.get("creationDate") or "N/A",
+            "isEncrypted": doc.is_encrypted,
+        }
+
+
+def protect(input_path, password, output_path):
+    """Encrypt with AES-256; ``password`` is both the user and the owner password."""
+    doc = open_pdf(input_path)
+    return save(
+        doc, output_path, encryption=fitz.PDF_ENCRYPT_AES_256, user_pw=password, owner_pw=password,
+        **_REBUILD_OPTIONS,
+    )
+
+
+def unlock(input_path, password, output_path):
+    """Decrypt with ``password`` and save without encryption."""
+    doc = open_pdf(input_path, password)
+    return save(doc, output_path, encryption=fitz.PDF_ENCRYPT_NONE, **_REBUILD_OPTIONS)
+
+
+# Lossy presets, after Ghostscript's: images shown above ``threshold`` DPI are downsampled to
+# ``dpi`` and every raster is re-encoded at ``quality`` (JPEG) or ``jpx_rate`` (JPEG 2000 ratio)
+COMPRESSION_PRESETS = {
+    "screen": {"dpi": 72, "threshold": 96, "quality": 50, "jpx_rate": 40},
+    "ebook": {"dpi": 150, "threshold": 200, "quality": 70, "jpx_rate": 20},
+    "print": {"dpi": 300, "threshold": 400, "quality": 85, "jpx_rate": 10},
+}
+# A re-encoded image replaces the original only if it saves at least this fraction
+_MIN_IMAGE_SAVING = 0.1
+# garbage=4 also merges byte-identical streams (images, fonts embedded once per page, ...)
+_COMPRESS_OPTIONS = {"garbage": 4, "deflate": True, "deflate_images": True, "deflate_fonts": True, "clean": True}
+
+
+def image_usage(input_path, page_indices):
+    """
+    ``{xref: (width_inches, height_inches)}``: the largest size each image is drawn at on ``page_indices``.
+    One shard of a parallel compression.
+    """
+    usage = {}
+    with open_pdf(input_path) as doc:
+        for index in page_indices:
+            for image in doc[index].get_image_info(xrefs=True):
+                xref = image.get("xref")
+                if not xref:
+                    # Inline images live in the content stream and can't be swapped out
+                    continue
+                x0, y0, x1, y1 = image["bbox"]
+                width, height = abs(x1 - x0) / 72, abs(y1 - y0) / 72
+                known = usage.get(xref, (0, 0))
+                usage[xref] = (max(known[0], width), max(known[1], height))
+    return usage
+
+
+def _recompressible(doc, xref):
+    if doc.xref_get_key(xref, "ImageMask")[1] == "true":
+        return False
+    # Colour-key masks match exact sample values, which lossy coding doesn't preserve
+    return doc.xref_get_key(xref, "Mask")[0] != "array"
+
+
+def recompress_images(input_path, targets, preset, image_format, work_dir):
+    """
+    Downsample and re-encode the images ``[(xref, width_inches, height_inches)]`` following ``preset``.
+    Each smaller result is written to ``work_dir``; returns ``[(xref, width, height, colorspace, filter, path)]``.
+    One shard of a parallel compression.
+    """
+    settings = COMPRESSION_PRESETS[preset]
+    results = []
+    with open_pdf(input_path) as doc:
+        for xref, width_inches, height_inches in targets:
+            if not _recompressible(doc, xref):
+                continue
+            try:
+                pixmap = fitz.Pixmap(doc, xref)
+            except RuntimeError:
+                # Unsupported encodings (e.g. JBIG2 without decoder support) are left as they are
+                continue
+            if pixmap.alpha:
+                # Transparency sits in a separate /SMask image, which is kept
+                pixmap = fitz.Pixmap(pixmap, 0)
+            if pixmap.n not in (1, 3):
+                pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+            mode = "L" if pixmap.n == 1 else "RGB"
+            image = Image.frombytes(mode, (pixmap.width, pixmap.height), pixmap.samples)
+
+            dpi = min(pixmap.width / max(width_inches, 1e-3), pixmap.height / max(height_inches, 1e-3))
+            if dpi > settings["threshold"]:
+                scale = settings["dpi"] / dpi
+                image = image.resize(
+                    (max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS
+                )
+
+            buffer = io.BytesIO()
+            if image_format == "jpeg2000":
+                image.save(buffer, "JPEG2000", quality_mode="rates", quality_layers=[settings["jpx_rate"]])
+                pdf_filter = "/JPXDecode"
+            else:
+                image.save(buffer, "JPEG", quality=settings["quality"], optimize=True)
+                pdf_filter = "/DCTDecode"
+            data = buffer.getvalue()
+            if len(data) > len(doc.xref_stream_raw(xref)) * (1 - _MIN_IMAGE_SAVING):
+                continue
+
+            path = os.path.join(work_dir, f"{xref}.img")
+            with open(path, "wb") as f:
+                f.write(data)
+            colorspace = "/DeviceGray" if mode == "L" else "/DeviceRGB"
+            results.append((xref, image.width, image.height, colorspace, pdf_filter, path))
+    return results
+
+
+def apply_compression(input_path, replacements, output_path, subset_fonts=True):
+    """Swap in the images from ``recompress_images``, subset fonts and write a garbage-collected copy."""
+    doc = open_pdf(input_path)
+    try:
+        for xref, width, height, colorspace, pdf_filter, path in replacements:
+            with open(path, "rb") as f:
+                doc.update_stream(xref, f.read(), compress=False)
+            doc.xref_set_key(xref, "Filter", pdf_filter)
+            doc.xref_set_key(xref, "Width", str(width))
+            doc.xref_set_key(xref, "Height", str(height))
+            doc.xref_set_key(xref, "ColorSpace", colorspace)
+            doc.xref_set_key(xref, "BitsPerComponent", "8")
+            # The samples were decoded when the image was read; old decode settings no longer apply
+            for key in ("DecodeParms", "Decode"):
+                doc.xref_set_key(xref, key, "null")
+        if subset_fonts:
+            try:
+                doc.subset_fonts()
+            except Exception as e:
+                # Needs fontTools; a document that can't be subset is still worth compressing
+                print(f"Font subsetting skipped: {e}")
+    except BaseException:
+        doc.close()
+        raise
+    return save(doc, output_path, **_COMPRESS_OPTIONS)
+
+
+# Text replacement
+# Matches are found per text line from the character boxes of "rawdict" extraction, so a term can
+# span several font runs. Each page then gets all its redactions applied in one content-stream
+# rewrite, and the replacements are drawn with the size and style of the text they replace.
+
+# Base-14 fonts by (family, bold, italic), standing in for the original embedded fonts
+_BASE14 = {
+    ("sans", False, False): "helv", ("sans", False, True): "heit", ("sans", True, False): "hebo", ("sans", True, True): "hebi",
+    ("serif", False, False): "tiro", ("serif", False, True): "tiit", ("serif", True, False): "tibo", ("serif", True, True): "tibi",
+    ("mono", False, False): "cour", ("mono", False, True): "coit", ("mono", True, False): "cobo", ("mono", True, True): "cobi",
+}
+# A longer replacement is shrunk to the width of the text it replaces, down to this fraction of its size
+_MIN_FIT_SCALE = 0.6
+
+
+def compile_replacements(pairs):
+    """``[(pattern, replacement)]`` from dicts with find, replace and optional regex / match_case."""
+    compiled = []
+    for pair in pairs:
+        find = pair.get("find") or ""
+        if not find:
+            raise ValueError("Every replacement needs a non-empty 'find'.")
+        flags = 0 if pair.get("match_case", False) else re.IGNORECASE
+        try:
+            pattern = re.compile(find if pair.get("regex") else re.escape(find), flags)
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression {find!r}: {e}")
+        compiled.append((pattern, pair.get("replace") or "", bool(pair.get("regex"))))
+    return compiled
+
+
+def _font_for(flags):
+    # Span flags: 2 italic, 4 serif, 8 monospaced, 16 bold
+    family = "mono" if flags & 8 else "serif" if flags & 4 else "sans"
+    return _BASE14[(family, bool(flags & 16), bool(flags & 2))]
+
+
+def _rgb(color):
+    return ((color >> 16) & 255) / 255, ((color >> 8) & 255) / 255, (color & 255) / 255
+
+
+def _line_matches(chars, compiled):
+    text = "".join(char["c"] for char, _ in chars)
+    found = []
+    for pattern, replacement, is_regex in compiled:
+        for match in pattern.finditer(text):
+            if match.end() > match.start():
+                found.append((match.start(), match.end(), match.expand(replacement) if is_regex else replacement))
+    # Earlier pairs win where matches overlap
+    taken, kept = set(), []
+    for start, end, replacement in found:
+        if taken.isdisjoint(range(start, end)):
+            taken.update(range(start, end))
+            kept.append((start, end, replacement))
+    return kept
+
+
+def find_text_matches(doc, page_indices, compiled):
+    """
+    ``{page_index: [(rect, origin, text, fontsize, fontname, color)]}`` for every match of ``compiled``
+    on ``page_indices``; plain tuples, so shards can send them back from the process pool.
+    """
+    flags = fitz.TEXTFLAGS_RAWDICT & ~fitz.TEXT_PRESERVE_IMAGES
+    matches = {}
+    for index in page_indices:
+        page_matches = []
+        for block in doc[index].get_text("rawdict", flags=flags)["blocks"]:
+            for line in block.get("lines", []):
+                chars = [(char, span) for span in line["spans"] for char in span["chars"]]
+                for start, end, replacement in _line_matches(chars, compiled):
+                    rect = fitz.Rect()
+                    for char, _ in chars[start:end]:
+                        rect |= fitz.Rect(char["bbox"])
+                    first_char, span = chars[start]
+                    page_matches.append((
+                        tuple(rect), tuple(first_char["origin"]), replacement,
+                        span["size"], _font_for(span["flags"]), _rgb(span["color"]),
+                    ))
+        if page_matches:
+            matches[index] = page_matches
+    return matches
+
+
+def find_text_matches_in(input_path, page_indices, pairs):
+    """``find_text_matches`` for a file; one shard of a parallel find-and-replace."""
+    with open_pdf(input_path) as doc:
+        return find_text_matches(doc, page_indices, compile_replacements(pairs))
+
+
+def apply_text_matches(doc, matches):
+    """Redact every match and draw its replacement, rewriting each page's content once. Returns the count."""
+    count = 0
+    for index, page_matches in matches.items():
+        page = doc[index]
+        for rect, _, _, _, _, _ in page_matches:
+            rect = fitz.Rect(rect)
+            # Only the middle of the line box, so descenders/ascenders of neighbouring lines survive
+            inset = rect.height / 4
+            page.add_redact_annot(fitz.Rect(rect.x0, rect.y0 + inset, rect.x1, rect.y1 - inset), fill=False)
+        page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE)
+        for rect, origin, text, fontsize, fontname, color in page_matches:
+            count += 1
+            if not text:
+                continue
+            width = fitz.get_text_length(text, fontname=fontname, fontsize=fontsize)
+            available = fitz.Rect(rect).width
+            if width > available > 0:
+                fontsize *= max(_MIN_FIT_SCALE, available / width)
+            page.insert_text(origin, text, fontsize=fontsize, fontname=fontname, color=color)
+    return count
+
+
+def replace_text(input_path, pairs, output_path, matches=None):
+    """
+    Apply find/replace ``pairs`` to the PDF, write it to ``output_path`` and return the number of
+    replacements made. ``matches`` from parallel ``find_text_matches_in`` shards skips the search here.
+    """
+    doc = open_pdf(input_path)
+    try:
+        if matches is None:
+            matches = find_text_matches(doc, range(len(doc)), compile_replacements(pairs))
+        count = apply_text_matches(doc, matches)
+    except BaseException:
+        doc.close()
+        raise
+    save(doc, output_path)
+    return count
+
+
+# Rendering
+
+RASTER_FORMATS = {"png": ("png", "image/png"), "jpeg": ("jpg", "image/jpeg")}
+
+
+def page_geometry(input_path):
+    """Page count and the area of every page in square points, to size a rendering up front."""
+    with open_pdf(input_path) as doc:
+        return {"page_count": len(doc), "areas": [round(page.rect.width * page.rect.height, 1) for page in doc]}
+
+
+def check_render_size(area, zoom, page_label="A page"):
+    """Raise ValueError if a page of ``area`` square points would exceed PDF_RENDER_MAX_MEGAPIXELS at ``zoom``."""
+    megapixels = area * zoom * zoom / 1_000_000
+    if megapixels > PDF_RENDER_MAX_MEGAPIXELS:
+        raise ValueError(
+            f"{page_label} would be {megapixels:.0f} megapixels at this resolution; the limit is {PDF_RENDER_MAX_MEGAPIXELS}."
+        )
+
+
+def render_pages(input_path, page_indices, image_format, work_dir, dpi=72, width=None, quality=90):
+    """
+    Rasterize ``page_indices`` at ``dpi``, or scaled to ``width`` pixels wide, into ``work_dir``.
+    Returns ``{index: path}``. One shard of a parallel rendering.
+    """
+    extension, _ = RASTER_FORMATS[image_format]
+    rendered = {}
+    with open_pdf(input_path) as doc:
+        for index in page_indices:
+            page = doc[index]
+            zoom = width / page.rect.width if width else dpi / 72
+            check_render_size(page.rect.width * page.rect.height, zoom, f"Page {index + 1}")
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            path = os.path.join(work_dir, f"{index}.{extension}")
+            if image_format == "jpeg":
+                pixmap.save(path, output="jpeg", jpg_quality=quality)
+            else:
+                pixmap.save(path, output="png")
+            rendered[index] = path
+    return rendered
+
+
+# Splitting
+# A split is planned first (page ranges, from the outline or from estimated sizes) and the parts
+# are then written, possibly by several workers. Each worker opens the input by path, so MuPDF
+# reads only the objects the parts need instead of the whole file, and each part is one
+# insert_pdf call: objects shared by its pages (fonts, images) are copied into it once.
+
+SPLIT_MODES = ("every", "bookmarks", "size")
+# Trailer, xref table and page dictionary overhead per page, on top of the streams a page uses
+_PAGE_OVERHEAD_BYTES = 512
+
+
+def _range_label(first, last):
+    return f"{first + 1}" if first == last else f"{first + 1}-{last + 1}"
+
+
+def _safe_title(title):
+    return re.sub(r"[^\w\- ]+", "", title).strip().replace(" ", "_")[:60] or "section"
+
+
+def _stream_length(doc, xref, lengths):
+    if xref not in lengths:
+        kind, value = doc.xref_get_key(xref, "Length")
+        lengths[xref] = int(value) if kind == "int" else len(doc.xref_stream_raw(xref) or b"")
+    return lengths[xref]
+
+
+def _page_streams(doc, index):
+    """Xrefs of the streams page ``index`` draws with: contents, images, forms and embedded fonts."""
+    xrefs = set(doc[index].get_contents())
+    for image in doc.get_page_images(index):
+        xrefs.update(xref for xref in (image[0], image[1]) if xref)
+    xrefs.update(xobject[0] for xobject in doc.get_page_xobjects(index))
+    for font in doc.get_page_fonts(index):
+        fonts = [font[0]]
+        kind, value = doc.xref_get_key(font[0], "DescendantFonts")
+        if kind == "array":
+            fonts += [int(ref) for ref in re.findall(r"(\d+) 0 R", value)]
+        for font_xref in fonts:
+            kind, value = doc.xref_get_key(font_xref, "FontDescriptor")
+            if kind != "xref":
+                continue
+            descriptor = int(value.split()[0])
+            for key in ("FontFile", "FontFile2", "FontFile3"):
+                kind, value = doc.xref_get_key(descriptor, key)
+                if kind == "xref":
+                    xrefs.add(int(value.split()[0]))
+    return xrefs
+
+
+def _size_ranges(doc, max_bytes):
+    """Page ranges whose estimated size stays under ``max_bytes``; streams shared by pages count once per range."""
+    ranges, lengths = [], {}
+    first, used, size = 0, set(), 0
+    for index in range(len(doc)):
+        streams = _page_streams(doc, index)
+        added = _PAGE_OVERHEAD_BYTES + sum(_stream_length(doc, xref, lengths) for xref in streams - used)
+        if index > first and size + added > max_bytes:
+            ranges.append((first, index - 1))
+            first, used, size = index, set(), 0
+            added = _PAGE_OVERHEAD_BYTES + sum(_stream_length(doc, xref, lengths) for xref in streams)
+        used |= streams
+        size += added
+    ranges.append((first, len(doc) - 1))
+    return ranges
+
+
+def plan_split(input_path, mode, every=1, level=1, max_bytes=None):
+    """
+    Parts ``[(filename, first, last)]`` (0-based, inclusive) for a split ``mode``: every ``every``
+    pages, at the outline entries of ``level`` (pages before the first one become a part of their
+    own), or by estimated size under ``max_bytes``.
+    """
+    if mode not in SPLIT_MODES:
+        raise ValueError(f"mode must be one of {', '.join(SPLIT_MODES)}.")
+    with open_pdf(input_path) as doc:
+        page_count = len(doc)
+        if mode == "every":
+            if every < 1:
+                raise ValueError("every must be at least 1.")
+            ranges = [(None, first, min(first + every, page_count) - 1) for first in range(0, page_count, every)]
+        elif mode == "bookmarks":
+            starts = {}
+            for entry_level, title, page in doc.get_toc(simple=True):
+                # Entries of other levels, or pointing nowhere, don't start a part
+                if entry_level == level and 1 <= page <= page_count:
+                    starts.setdefault(page - 1, title)
+            if not starts:
+                raise ValueError(f"The PDF has no level {level} bookmarks to split at.")
+            if 0 not in starts:
+                starts[0] = None
+            firsts = sorted(starts)
+            ranges = [
+                (starts[first], first, (firsts[number + 1] if number + 1 < len(firsts) else page_count) - 1)
+                for number, first in enumerate(firsts)
+            ]
+        else:
+            if not max_bytes or max_bytes <= 0:
+                raise ValueError("max_size_mb must be positive.")
+            ranges = [(None, first, last) for first, last in _size_ranges(doc, max_bytes)]
+    digits = len(str(len(ranges)))
+    parts = []
+    for number, (title, first, last) in enumerate(ranges, start=1):
+        label = _safe_title(title) if title else "pages"
+        parts.append((f"{number:0{digits}}_{label}_{_range_label(first, last)}.pdf", first, last))
+    return parts
+
+
+def _write_part(src, first, last, path):
+    part = fitz.open()
+    part.insert_pdf(src, from_page=first, to_page=last)
+    save(part, path, **_REBUILD_OPTIONS)
+    return os.path.getsize(path)
+
+
+def write_parts(input_path, parts, work_dir, max_bytes=None):
+    """
+    Write the ``parts`` of ``plan_split`` into ``work_dir``; returns ``[(filename, path)]``. A part
+    over ``max_bytes`` (the size estimate was short) is split in half until it fits or is one page.
+    One shard of a parallel split.
+    """
+    written = []
+    with open_pdf(input_path) as src:
+        pending = list(reversed(parts))
+        while pending:
+            filename, first, last = pending.pop()
+            path = os.path.join(work_dir, filename)
+            size = _write_part(src, first, last, path)
+            if max_bytes and size > max_bytes and last > first:
+                os.remove(path)
+                middle = (first + last) // 2
+                stem = filename.rsplit("_", 1)[0]
+                pending.append((f"{stem}_{_range_label(middle + 1, last)}.pdf", middle + 1, last))
+                pending.append((f"{stem}_{_range_label(first, middle)}.pdf", first, middle))
+                continue
+            written.append((filename, path))
+    return written
+
+
+# Watermarks
+# The watermark is drawn once into a one-page "stamp" PDF. For each distinct page size a "sheet"
+# page lays the stamp out (positioned or tiled) and every page of that size shows the sheet, so
+# the document gains one shared Form XObject per page size plus a single reference on each page.
+
+WATERMARK_POSITIONS = ("center", "top-left", "top-right", "bottom-left", "bottom-right", "tile")
+
+
+def watermark_stamp(text=None, image_path=None, font_size=60, color=(0.5, 0.5, 0.5), opacity=0.3, image_width=200):
+    """A one-page PDF holding only the watermark: ``text`` in Helvetica, or the image at ``image_path``."""
+    if not text and not image_path:
+        raise ValueError("Send watermark text or an image.")
+    if not 0 < opacity <= 1:
+        raise ValueError("opacity must be greater than 0 and at most 1.")
+    stamp = fitz.open()
+    try:
+        if image_path:
+            try:
+                image = Image.open(image_path).convert("RGBA")
+            except Exception:
+                raise ValueError("The watermark image could not be read.")
+            # Image XObjects have no opacity of their own; it goes into the alpha channel
+            alpha = image.getchannel("A").point(lambda value: round(value * opacity))
+            image.putalpha(alpha)
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG")
+            height = image_width * image.height / image.width
+            page = stamp.new_page(width=image_width, height=height)
+            page.insert_image(page.rect, stream=buffer.getvalue())
+        else:
+            if font_size <= 0:
+                raise ValueError("font_size must be positive.")
+            font = fitz.Font("helv")
+            width = font.text_length(text, fontsize=font_size)
+            page = stamp.new_page(width=width, height=(font.ascender - font.descender) * font_size)
+            page.insert_text(
+                (0, font.ascender * font_size), text, fontsize=font_size, fontname="helv",
+                color=color, fill_opacity=opacity, stroke_opacity=opacity,
+            )
+    except BaseException:
+        stamp.close()
+        raise
+    return stamp
+
+
+def _rotated_size(width, height, rotation):
+    angle = math.radians(rotation)
+    cos, sin = abs(math.cos(angle)), abs(math.sin(angle))
+    return width * cos + height * sin, width * sin + height * cos
+
+
+def _layout(page_rect, size, position, margin, spacing):
+    """Rectangles to draw a watermark of ``size`` into on a page of ``page_rect``."""
+    width, height = size
+    if position == "tile":
+        # As many copies as fit inside the margins, the grid centred on the page
+        columns = max(1, int((page_rect.width - 2 * margin + spacing) // (width + spacing)))
+        rows = max(1, int((page_rect.height - 2 * margin + spacing) // (height + spacing)))
+        left = (page_rect.width - columns * width - (columns - 1) * spacing) / 2
+        top = (page_rect.height - rows * height - (rows - 1) * spacing) / 2
+        return [
+            fitz.Rect(x, y, x + width, y + height)
+            for y in (top + row * (height + spacing) for row in range(rows))
+            for x in (left + column * (width + spacing) for column in range(columns))
+        ]
+    # Shrink anything bigger than the page (less margins) so it stays fully visible
+    scale = min(1, (page_rect.width - 2 * margin) / width, (page_rect.height - 2 * margin) / height)
+    width, height = width * scale, height * scale
+    vertical, _, horizontal = position.partition("-")
+    if position == "center":
+        x, y = (page_rect.width - width) / 2, (page_rect.height - height) / 2
+    else:
+        x = margin if horizontal == "left" else page_rect.width - margin - width
+        y = margin if vertical == "top" else page_rect.height - margin - height
+    return [fitz.Rect(x, y, x + width, y + height)]
+
+
+def _add_xobject(doc, page_xref, name, xref, registered):
+    """
+    Register Form XObject ``xref`` as ``name`` in the page's resources; False if they are inherited.
+    ``registered`` remembers resource dictionaries already done, as pages often share one.
+    """
+    owner, path = page_xref, "Resources"
+    kind, value = doc.xref_get_key(owner, path)
+    if kind == "null":
+        return False
+    if kind == "xref":
+        owner, path = int(value.split()[0]), ""
+    xobjects = f"{path}/XObject" if path else "XObject"
+    kind, value = doc.xref_get_key(owner, xobjects)
+    if kind == "xref":
+        owner, xobjects = int(value.split()[0]), ""
+    if (owner, xobjects, name) not in registered:
+        doc.xref_set_key(owner, f"{xobjects}/{name}" if xobjects else name, f"{xref} 0 R")
+        if owner != page_xref:
+            registered.add((owner, xobjects, name))
+    return True
+
+
+def _new_stream(doc, data):
+    xref = doc.get_new_xref()
+    doc.update_object(xref, "<<>>")
+    doc.update_stream(xref, data)
+    return xref
+
+
+def apply_watermark(doc, stamp, page_indices, position="center", rotation=45, margin=36, spacing=72):
+    """Show ``stamp`` (from ``watermark_stamp``) on ``page_indices`` of ``doc``. Returns the pages watermarked."""
+    if position not in WATERMARK_POSITIONS:
+        raise ValueError(f"position must be one of {', '.join(WATERMARK_POSITIONS)}.")
+    size = _rotated_size(stamp[0].rect.width, stamp[0].rect.height, rotation)
+    pages = [doc[index] for index in dict.fromkeys(page_indices)]
+    sheets = fitz.open()
+    try:
+        # All sheets are laid out before any is shown: the source of show_pdf_page mustn't change afterwards
+        layouts = {}
+        page_layouts = []
+        for page in pages:
+            # Pages with the same boxes and rotation can share one placement of the sheet
+            key = (page.rotation, tuple(page.mediabox), tuple(page.cropbox))
+            if key not in layouts:
+                # page.rect is the page as displayed, so the watermark comes out upright on rotated pages
+                sheet = sheets.new_page(width=page.rect.width, height=page.rect.height)
+                for target in _layout(sheet.rect, size, position, margin, spacing):
+                    sheet.show_pdf_page(target, stamp, 0, rotate=rotation)
+                layouts[key] = {"sheet": sheet.number, "name": None, "xobject": None}
+            page_layouts.append(layouts[key])
+
+        # The first page of each layout gets the sheet through show_pdf_page, which wraps it in a
+        # placement XObject. Every other page references that XObject and two content streams
+        # shared by all pages ("q" before the page's own content, "Q" and the drawing after it).
+        head = _new_stream(doc, b"q\n")
+        tails = {}
+        registered = set()
+        for page, layout in zip(pages, page_layouts):
+            page_xref = page.xref
+            if layout["xobject"] is None or not _add_xobject(doc, page_xref, layout["name"], layout["xobject"], registered):
+                known = {item[0] for item in doc.get_page_xobjects(page.number)}
+                # The sheet is laid out as the page is displayed; turn it back into the unrotated page space
+                page.show_pdf_page(page.rect * page.derotation_matrix, sheets, layout["sheet"], rotate=page.rotation)
+                if layout["xobject"] is None:
+                    layout["xobject"] = next(
+                        item[0] for item in doc.get_page_xobjects(page.number) if item[0] not in known and item[2] == 0
+                    )
+                    # Named after its xref, which no earlier watermark's resource name can be using
+                    layout["name"] = f"fzWm{layout['xobject']}"
+                continue
+            if layout["name"] not in tails:
+                tails[layout["name"]] = _new_stream(doc, f"\nQ\nq /{layout['name']} Do Q\n".encode())
+            contents = [head] + page.get_contents() + [tails[layout["name"]]]
+            doc.xref_set_key(page_xref, "Contents", "[" + " ".join(f"{xref} 0 R" for xref in contents) + "]")
+    finally:
+        sheets.close()
+    return len(pages)
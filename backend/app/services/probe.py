@@ -0,0 +1,154 @@
+"""
+ffprobe helpers for deciding how much work a media conversion needs.
+
+Probe results are cached by the input's content hash (``cached_probe``), so
+/media/probe followed by a conversion of the same file, or repeated
+conversions, run ffprobe once.
+"""
+import ffmpeg
+
+from ..config import FFPROBE_PATH, MEDIA_PROBE_KEYFRAME_SECONDS
+from . import cache
+from .executor import run_io
+
+# Codecs each target container can hold as-is, so streams can be copied instead of re-encoded.
+# None means the container accepts any codec of that kind.
+CONTAINER_CODECS = {
+    "mp4": {"video": {"h264", "hevc", "mpeg4", "av1", "vp9"}, "audio": {"aac", "mp3", "alac", "opus", "ac3", "eac3"}},
+    "mov": {"video": {"h264", "hevc", "mpeg4", "prores", "mjpeg"}, "audio": {"aac", "mp3", "alac", "pcm_s16le", "pcm_s24le"}},
+    "mkv": {"video": None, "audio": None},
+    "avi": {"video": {"mpeg4", "h264", "mjpeg", "msmpeg4v3"}, "audio": {"mp3", "ac3", "pcm_s16le"}},
+    "mp3": {"audio": {"mp3"}},
+    "wav": {"audio": {"pcm_s16le", "pcm_s24le", "pcm_s32le", "pcm_f32le", "pcm_u8"}},
+    "flac": {"audio": {"flac"}},
+    "ogg": {"audio": {"vorbis", "opus", "flac"}},
+    "aac": {"audio": {"aac"}},
+}
+
+
+def probe(path):
+    """Run ffprobe on ``path`` and return its ``format`` and ``streams``."""
+    return ffmpeg.probe(path, cmd=FFPROBE_PATH)
+
+
+def keyframe_times(path):
+    """Keyframe timestamps of the first video stream within the first MEDIA_PROBE_KEYFRAME_SECONDS."""
+    # Packet flags come from the demuxer, so nothing is decoded
+    result = ffmpeg.probe(
+        path, cmd=FFPROBE_PATH, select_streams="v:0", show_packets=None,
+        show_entries="packet=pts_time,flags", read_intervals=f"%+{MEDIA_PROBE_KEYFRAME_SECONDS}",
+    )
+    times = []
+    for packet in result.get("packets", []):
+        if "K" in packet.get("flags", "") and packet.get("pts_time") not in (None, "N/A"):
+            times.append(float(packet["pts_time"]))
+    return times
+
+
+def _probe_all(path):
+    info = probe(path)
+    info["keyframes"] = keyframe_times(path) if streams(info, "video") else []
+    return info
+
+
+async def cached_probe(path, digest):
+    """``probe`` plus keyframe times, cached by content hash."""
+    key = cache.make_key("media.probe", [digest])
+    info = await cache.cached_json(key)
+    if info is None:
+        info = await run_io("media", _probe_all, path)
+        await cache.store_json(key, info)
+    return info
+
+
+def duration(info):
+    """Duration in seconds, or None when the container doesn't say."""
+    try:
+        return float(info.get("format", {}).get("duration")) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def streams(info, codec_type):
+    # Cover art is reported as a video stream; it is not something to transcode
+    return [
+        stream for stream in info.get("streams", [])
+        if stream.get("codec_type") == codec_type and not stream.get("disposition", {}).get("attached_pic")
+    ]
+
+
+def copyable(info, target_format, codec_type):
+    """True if every ``codec_type`` stream in ``info`` can be copied into ``target_format`` unchanged."""
+    allowed = CONTAINER_CODECS.get(target_format, {})
+    if codec_type not in allowed:
+        return False
+    if allowed[codec_type] is None:
+        return True
+    return all(stream.get("codec_name") in allowed[codec_type] for stream in streams(info, codec_type))
+
+
+def _number(value, kind=float):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _frame_rate(value):
+    numerator, _, denominator = (value or "").partition("/")
+    numerator, denominator = _number(numerator), _number(denominator or 1)
+    if not numerator or not denominator:
+        return None
+    return round(numerator / denominator, 3)
+
+
+def _keyframe_interval(times):
+    if len(times) < 2:
+        return None
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    return {
+        "average": round(sum(gaps) / len(gaps), 3),
+        "max": round(max(gaps), 3),
+        "sampled_seconds": MEDIA_PROBE_KEYFRAME_SECONDS,
+    }
+
+
+def summarize(info):
+    """The client-facing view of a probe: container, streams, duration, bitrate, keyframe interval."""
+    fmt = info.get("format", {})
+    summary_streams = []
+    for stream in info.get("streams", []):
+        entry = {
+            "index": stream.get("index"),
+            "type": stream.get("codec_type"),
+            "codec": stream.get("codec_name"),
+            "codec_long_name": stream.get("codec_long_name"),
+            "profile": stream.get("profile"),
+            "bit_rate": _number(stream.get("bit_rate"), int),
+            "language": stream.get("tags", {}).get("language"),
+        }
+        if stream.get("codec_type") == "video":
+            entry.update(
+                width=stream.get("width"),
+                height=stream.get("height"),
+                fps=_frame_rate(stream.get("avg_frame_rate") or stream.get("r_frame_rate")),
+                pix_fmt=stream.get("pix_fmt"),
+                cover_art=bool(stream.get("disposition", {}).get("attached_pic")),
+            )
+        elif stream.get("codec_type") == "audio":
+            entry.update(
+                sample_rate=_number(stream.get("sample_rate"), int),
+                channels=stream.get("channels"),
+                channel_layout=stream.get("channel_layout"),
+            )
+        summary_streams.append(entry)
+
+    return {
+        "format": fmt.get("format_name"),
+        "format_long_name": fmt.get("format_long_name"),
+        "duration": duration(info),
+        "bit_rate": _number(fmt.get("bit_rate"), int),
+        "size": _number(fmt.get("size"), int),
+        "streams": summary_streams,
+        "keyframe_interval": _keyframe_interval(info.get("keyframes", [])),
+    }
@@ -0,0 +1,224 @@
+"""
+File layout and lifecycle for ``UPLOAD_DIR`` and ``OUTPUT_DIR``.
+
+Every file lives under two levels of hashed shard directories
+(``uploads/3f/a2/{file_id}_{name}``) so no single directory grows past a few
+hundred entries. Handlers delete their inputs when they finish and attach
+``remove_after`` to responses for outputs; a background janitor catches
+everything else with per-directory TTLs and a global size quota, which is
+enforced by evicting the oldest outputs.
+
+Every path handed out by ``upload_path``/``output_path`` counts as in use
+until it is passed to ``remove``, so the janitor never deletes the input,
+work directory or output of a request that is still running, however long
+it takes. Paths registered with ``register_protected`` (finished job
+results) are only ever expired by their TTL, never evicted for the quota.
+"""
+import asyncio
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from starlette.background import BackgroundTask
+
+from ..config import (
+    UPLOAD_DIR, OUTPUT_DIR, UPLOAD_TTL_SECONDS, OUTPUT_TTL_SECONDS, STORAGE_QUOTA_MB,
+    JANITOR_INTERVAL_SECONDS, JANITOR_MIN_AGE_SECONDS,
+)
+from .executor import run_io
+
+# Directory levels below UPLOAD_DIR/OUTPUT_DIR that are shard directories
+SHARD_DEPTH = 2
+
+_sweepers = []
+_protectors = []
+_janitor = None
+
+# abspath -> time it was handed out, for paths whose request hasn't removed them yet
+_in_use = {}
+_in_use_lock = threading.Lock()
+
+
+def new_file_id():
+    return str(uuid.uuid4())
+
+
+def _shard(root, file_id):
+    digest = hashlib.sha1(file_id.encode("utf-8")).hexdigest()
+    directory = os.path.join(root, digest[0:2], digest[2:4])
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _path(root, file_id, filename):
+    if not filename:
+        return os.path.join(_shard(root, file_id), file_id)
+    return os.path.join(_shard(root, file_id), f"{file_id}_{os.path.basename(filename)}")
+
+
+def _hold(path):
+    with _in_use_lock:
+        _in_use[os.path.abspath(path)] = time.time()
+    return path
+
+
+def upload_path(file_id, filename, root=UPLOAD_DIR):
+    return _hold(_path(root, file_id, filename))
+
+
+def output_path(file_id, filename=None):
+    """Path for an output file, or for a per-request output directory when ``filename`` is omitted."""
+    return _hold(_path(OUTPUT_DIR, file_id, filename))
+
+
+def remove(*paths):
+    with _in_use_lock:
+        for path in paths:
+            _in_use.pop(os.path.abspath(path), None)
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"Could not remove {path}: {e}")
+
+
+def remove_after(*paths):
+    """Background task for a response: delete ``paths`` once the body has been sent."""
+    return BackgroundTask(remove, *paths)
+
+
+def _in_use_paths(now):
+    """Paths handed out and not removed yet. Ones that never got created, or are older than any
+    request could run (a response that was never sent), are forgotten."""
+    with _in_use_lock:
+        for path, since in list(_in_use.items()):
+            if now - since > OUTPUT_TTL_SECONDS or (now - since > JANITOR_MIN_AGE_SECONDS and not os.path.exists(path)):
+                del _in_use[path]
+        return set(_in_use)
+
+
+def _is_in_use(path, in_use):
+    path = os.path.abspath(path)
+    while True:
+        if path in in_use:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+
+def _scan(root, now, in_use, depth=0):
+    """
+    Yield (path, size, mtime) for every file under ``root`` that isn't in use, removing stale empty
+    directories.
+    """
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if _is_in_use(entry.path, in_use):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan(entry.path, now, in_use, depth + 1)
+                # Shard directories are reused, only clean up what lives below them (e.g. extracted
+                # trees); a directory just made for work that hasn't started writing is left alone
+                if (
+                    depth >= SHARD_DEPTH and not os.listdir(entry.path)
+                    and now - entry.stat(follow_symlinks=False).st_mtime >= JANITOR_MIN_AGE_SECONDS
+                ):
+                    os.rmdir(entry.path)
+            else:
+                stat = entry.stat(follow_symlinks=False)
+                yield entry.path, stat.st_size, stat.st_mtime
+        except OSError:
+            continue
+
+
+def sweep(now=None):
+    """Apply TTLs, then the quota. Returns (files removed, bytes freed)."""
+    now = now or time.time()
+    removed, freed = 0, 0
+    total = 0
+    evictable = []
+    in_use = _in_use_paths(now)
+    protected = set()
+    for protector in _protectors:
+        try:
+            protected.update(os.path.abspath(path) for path in protector())
+        except Exception as e:
+            print(f"Protector {protector.__name__} failed: {e}")
+
+    for root, ttl in ((UPLOAD_DIR, UPLOAD_TTL_SECONDS), (OUTPUT_DIR, OUTPUT_TTL_SECONDS)):
+        for path, size, mtime in _scan(root, now, in_use):
+            if now - mtime > ttl:
+                remove(path)
+                removed += 1
+                freed += size
+                continue
+            total += size
+            # Only outputs can be regenerated, and a finished job's result waits for its download
+            if root == OUTPUT_DIR and not _is_in_use(path, protected):
+                evictable.append((mtime, size, path))
+
+    quota = STORAGE_QUOTA_MB * 1024 * 1024
+    if total > quota:
+        # Oldest first
+        for mtime, size, path in sorted(evictable):
+            if total <= quota:
+                break
+            if now - mtime < JANITOR_MIN_AGE_SECONDS:
+                continue
+            remove(path)
+            removed += 1
+            freed += size
+            total -= size
+
+    for sweeper in _sweepers:
+        try:
+            sweeper(now)
+        except Exception as e:
+            print(f"Sweeper {sweeper.__name__} failed: {e}")
+
+    return removed, freed
+
+
+def register_sweeper(fn):
+    """Run ``fn(now)`` after each janitor pass (e.g. to drop records pointing at expired files)."""
+    _sweepers.append(fn)
+
+
+def register_protected(fn):
+    """``fn()`` returns paths the quota must not evict; their TTL still applies."""
+    _protectors.append(fn)
+
+
+async def _janitor_loop():
+    while True:
+        try:
+            removed, freed = await run_io("default", sweep)
+            if removed:
+                print(f"Janitor removed {removed} files ({freed / (1024 * 1024):.1f} MB)")
+        except Exception as e:
+            print(f"Janitor pass failed: {e}")
+        await asyncio.sleep(JANITOR_INTERVAL_SECONDS)
+
+
+def start_janitor():
+    global _janitor
+    _janitor = asyncio.ensure_future(_janitor_loop())
+
+
+def stop_janitor():
+    global _janitor
+    if _janitor is not None:
+        _janitor.cancel()
+        _janitor = None
@@ -0,0 +1,146 @@
+"""
+Streaming, size-capped upload ingestion.
+
+``UploadLimitMiddleware`` rejects oversized request bodies before they are
+parsed: on ``Content-Length`` up front, and by counting bytes as they arrive
+for chunked uploads. Handlers then use ``spooled_upload`` to copy the upload
+to a file in ``UPLOAD_DIR`` chunk by chunk and work from its path, so
+PyMuPDF/Pillow open the file lazily instead of a full copy in RAM.
+The SHA-256 of the content is computed on the way through, for the result cache.
+"""
+import contextlib
+import hashlib
+import os
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from ..config import MAX_UPLOAD_MB
+from . import storage
+from .executor import run_io
+
+CHUNK_SIZE = 1024 * 1024
+
+# Request path prefix -> tool whose upload limit applies (longest prefix wins)
+_ROUTE_TOOLS = {
+    "/convert/media": "media",
+    "/jobs/media": "media",
+    "/media/probe": "media",
+    "/convert/pdf-to-word": "documents",
+    "/jobs/pdf-to-word": "documents",
+    "/convert/word-to-pdf": "documents",
+    "/convert/csv-to-excel": "documents",
+    "/convert/markdown-to-html": "documents",
+    "/convert/pdf": "pdf",
+    "/pdf/": "pdf",
+    "/convert/image": "images",
+    "/convert/image/": "image_tools",
+    "/convert/image/remove-bg": "images",
+    "/convert/image/remove-bg/batch": "images_batch",
+    "/extract/colors": "image_tools",
+    "/convert/ocr": "ocr",
+    "/convert/archive": "archives",
+    "/utils/hash": "utils",
+}
+
+
+def max_upload_bytes(tool):
+    return MAX_UPLOAD_MB.get(tool, MAX_UPLOAD_MB["default"]) * 1024 * 1024
+
+
+def tool_for_path(path):
+    matches = [prefix for prefix in _ROUTE_TOOLS if path.startswith(prefix)]
+    return _ROUTE_TOOLS[max(matches, key=len)] if matches else "default"
+
+
+def _too_large(limit):
+    return HTTPException(status_code=413, detail=f"Upload too large. Maximum size is {limit // (1024 * 1024)} MB.")
+
+
+class UploadLimitMiddleware:
+    """Cut off request bodies that exceed the route's upload limit as early as possible."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            await self.app(scope, receive, send)
+            return
+
+        limit = max_upload_bytes(tool_for_path(scope["path"]))
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse(status_code=413, content={"detail": _too_large(limit).detail})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside body parsing, so FastAPI turns it into a 413 response
+                    raise _too_large(limit)
+            return message
+
+        async def tracked_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except HTTPException as e:
+            if e.status_code != 413 or response_started:
+                raise
+            response = JSONResponse(status_code=413, content={"detail": e.detail})
+            await response(scope, receive, send)
+
+
+def read_chunks(src, limit):
+    """Yield ``src`` in chunks, raising 413 once more than ``limit`` bytes have been read."""
+    size = 0
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        size += len(chunk)
+        if size > limit:
+            raise _too_large(limit)
+        yield chunk
+
+
+def _copy_limited(src, dst_path, limit):
+    hasher = hashlib.sha256()
+    try:
+        with open(dst_path, "wb") as dst:
+            for chunk in read_chunks(src, limit):
+                hasher.update(chunk)
+                dst.write(chunk)
+        return hasher.hexdigest()
+    except BaseException:
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        raise
+
+
+async def save_upload(file, tool, path):
+    """Stream ``file`` to ``path`` in chunks, enforcing ``tool``'s size limit. Returns the content's SHA-256."""
+    return await run_io("uploads", _copy_limited, file.file, path, max_upload_bytes(tool))
+
+
+@contextlib.asynccontextmanager
+async def spooled_upload(file, tool):
+    """Spool an upload to ``UPLOAD_DIR`` and yield ``(path, sha256)``; the file is removed afterwards."""
+    path = storage.upload_path(storage.new_file_id(), file.filename or "upload")
+    digest = await save_upload(file, tool, path)
+    try:
+        yield path, digest
+    finally:
+        storage.remove(path)
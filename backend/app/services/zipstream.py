@@ -0,0 +1,212 @@
+"""
+ZIP archives written straight into a streaming response.
+
+``zipfile`` can write to a non-seekable stream: it then emits a data
+descriptor after each entry instead of seeking back to patch the header.
+``ZipStream`` collects those bytes in a small buffer that the response
+generator drains after every entry, so the client starts receiving the
+archive as soon as the first member is written.
+
+Small members can also be compressed ahead of time (``compress_file``, e.g.
+in the process pool, several at once) and added with ``add_compressed``,
+which writes the compressed bytes in without touching them again. Large
+ones go through ``add_file_compressing``, which compresses chunk by chunk
+straight into the stream, so they are never held in memory.
+"""
+import os
+import struct
+import time
+import zipfile
+import zlib
+
+# Not in zipfile before Python 3.14; the method id is fixed by the ZIP spec
+ZIP_ZSTANDARD = getattr(zipfile, "ZIP_ZSTANDARD", 93)
+_ZSTANDARD_VERSION = 63
+# General purpose flag: CRC and sizes follow the data in a descriptor
+_DATA_DESCRIPTOR_FLAG = 0x08
+_DATA_DESCRIPTOR_SIGNATURE = 0x08074B50
+
+# Formats whose data is already compressed; deflating them again costs CPU and saves nothing
+COMPRESSED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp4", ".m4v", ".mov", ".mkv", ".webm", ".avi", ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub", ".jar", ".apk",
+}
+
+
+def already_compressed(name):
+    return os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def _compressor(compress_type, level):
+    if compress_type == ZIP_ZSTANDARD:
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    # Negative wbits: ZIP members hold a bare deflate stream without the zlib header
+    return zlib.compressobj(level, zlib.DEFLATED, -15)
+
+
+def compress_file(src_path, compress_type, level):
+    """
+    Compress ``src_path`` as raw ZIP member data (deflate or zstd). Returns ``(crc, file_size, data)``
+    for ``ZipStream.add_compressed``. Module-level so it can run in a process pool; the whole member
+    is held in memory, so it is meant for small files.
+    """
+    compressor = _compressor(compress_type, level)
+    crc, file_size = 0, 0
+    parts = []
+    with open(src_path, "rb") as src:
+        while True:
+            chunk = src.read(1024 * 1024)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            parts.append(compressor.compress(chunk))
+        parts.append(compressor.flush())
+    return crc, file_size, b"".join(parts)
+
+
+class _Buffer:
+    """Write-only sink that zipfile treats as an unseekable stream."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStream:
+    def __init__(self, compression=zipfile.ZIP_STORED, compresslevel=None):
+        self._buffer = _Buffer()
+        self._zip = zipfile.ZipFile(self._buffer, "w", compression=compression, compresslevel=compresslevel)
+        self._names = set()
+
+    def _unique(self, arcname):
+        # Two uploads may share a name; keep both instead of shadowing one
+        name, counter = arcname, 1
+        while name in self._names:
+            stem, dot, ext = arcname.rpartition(".")
+            name = f"{stem}_{counter}.{ext}" if dot else f"{arcname}_{counter}"
+            counter += 1
+        self._names.add(name)
+        return name
+
+    def add_bytes(self, arcname, data):
+        """Add an entry and return the archive bytes produced so far."""
+        info = zipfile.ZipInfo(self._unique(arcname), date_time=time.localtime()[:6])
+        info.compress_type = self._zip.compression
+        self._zip.writestr(info, data)
+        return self._buffer.drain()
+
+    def add_file(self, arcname, path, chunk_size=1024 * 1024, compress_type=None):
+        """Add ``path`` as an entry, yielding archive bytes as the file is read."""
+        with open(path, "rb") as src:
+            yield from self.add_fileobj(arcname, src, chunk_size, compress_type)
+
+    def add_fileobj(self, arcname, src, chunk_size=1024 * 1024, compress_type=None):
+        """Add the contents of the readable ``src`` as an entry, yielding archive bytes as it is read."""
+        info = zipfile.ZipInfo(self._unique(arcname), date_time=time.localtime()[:6])
+        info.compress_type = self._zip.compression if compress_type is None else compress_type
+        with self._zip.open(info, "w", force_zip64=True) as dst:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                data = self._buffer.drain()
+                if data:
+                    yield data
+        data = self._buffer.drain()
+        if data:
+            yield data
+
+    def _new_info(self, arcname, compress_type):
+        info = zipfile.ZipInfo(self._unique(arcname), date_time=time.localtime()[:6])
+        info.compress_type = compress_type
+        info.external_attr = 0o600 << 16
+        if compress_type == ZIP_ZSTANDARD:
+            info.create_version = info.extract_version = _ZSTANDARD_VERSION
+        return info
+
+    def _write_header(self, info, zip64=None):
+        # zipfile has no public API for data it doesn't compress itself; this mirrors what ZipFile.open("w") does
+        zf = self._zip
+        info.header_offset = zf.fp.tell()
+        zf._didModify = True
+        zf.fp.write(info.FileHeader(zip64))
+
+    def _finish_entry(self, info):
+        zf = self._zip
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(info)
+        zf.NameToInfo[info.filename] = info
+        return self._buffer.drain()
+
+    def add_file_compressing(self, arcname, path, compress_type, level, chunk_size=1024 * 1024):
+        """
+        Add ``path`` compressed with ``compress_type`` (deflate or zstd) at ``level``, yielding archive
+        bytes as each chunk is compressed. CRC and sizes follow the data in a descriptor.
+        """
+        info = self._new_info(arcname, compress_type)
+        info.flag_bits |= _DATA_DESCRIPTOR_FLAG
+        # Sizes are unknown until the end, so the header reserves ZIP64 fields like force_zip64 does
+        self._write_header(info, zip64=True)
+        fp = self._zip.fp
+        compressor = _compressor(compress_type, level)
+        crc, file_size, compress_size = 0, 0, 0
+        with open(path, "rb") as src:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                data = compressor.compress(chunk)
+                compress_size += len(data)
+                fp.write(data)
+                data = self._buffer.drain()
+                if data:
+                    yield data
+        data = compressor.flush()
+        compress_size += len(data)
+        fp.write(data)
+        info.CRC, info.file_size, info.compress_size = crc, file_size, compress_size
+        fp.write(struct.pack("<LLQQ", _DATA_DESCRIPTOR_SIGNATURE, crc, compress_size, file_size))
+        data = self._finish_entry(info)
+        if data:
+            yield data
+
+    def add_compressed(self, arcname, data, compress_type, crc, file_size, chunk_size=1024 * 1024):
+        """
+        Add an entry whose ``data`` was produced by ``compress_file``, yielding archive bytes.
+        CRC and sizes are known up front, so the header is final and no data descriptor follows.
+        """
+        info = self._new_info(arcname, compress_type)
+        info.CRC = crc
+        info.file_size = file_size
+        info.compress_size = len(data)
+        self._write_header(info)
+        view = memoryview(data)
+        for offset in range(0, len(view), chunk_size):
+            self._zip.fp.write(view[offset:offset + chunk_size])
+            yield self._buffer.drain()
+        data = self._finish_entry(info)
+        if data:
+            yield data
+
+    def close(self):
+        """Write the central directory and return the final archive bytes."""
+        self._zip.close()
+        return self._buffer.drain()
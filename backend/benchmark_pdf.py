@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+PDF Engine Benchmark
+Compares the PyMuPDF service (app/services/pdf.py) with the pypdf/PyPDF2 code
+paths it replaced, on generated documents.
+
+    python benchmark_pdf.py --pages 500 --files 4 --repeat 3
+
+pypdf and PyPDF2 are no longer dependencies of the app; install them to
+include the old paths (pip install pypdf PyPDF2), otherwise they are skipped.
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import fitz  # PyMuPDF
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app.services import pdf  # noqa: E402
+
+
+def make_document(path, pages, seed):
+    """A text-heavy PDF with a small image on every page, roughly like a scanned report."""
+    doc = fitz.open()
+    pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 64, 64), False)
+    pixmap.set_rect(pixmap.irect, (seed * 37 % 255, 120, 200))
+    image = pixmap.tobytes("png")
+    for number in range(pages):
+        page = doc.new_page()
+        text = f"Document {seed}, page {number + 1}. " * 40
+        page.insert_textbox(fitz.Rect(50, 50, 545, 700), text, fontsize=10)
+        page.insert_image(fitz.Rect(450, 720, 514, 784), stream=image)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+
+def compress_ebook(input_path, output_path, work_dir):
+    """The /convert/pdf/compress "ebook" pipeline, run serially instead of across the pool."""
+    usage = pdf.image_usage(input_path, range(pdf.page_count(input_path)))
+    targets = [(xref, width, height) for xref, (width, height) in sorted(usage.items())]
+    image_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        replacements = pdf.recompress_images(input_path, targets, "ebook", "jpeg", image_dir)
+        pdf.apply_compression(input_path, replacements, output_path)
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+
+# --- Old paths, as they were in routers/pdf_tools.py and routers/pdf_advanced.py ---
+
+def pypdf_merge(input_paths, output_path):
+    from pypdf import PdfWriter
+    merger = PdfWriter()
+    for path in input_paths:
+        merger.append(path)
+    merger.write(output_path)
+    merger.close()
+
+
+def pypdf2_merge(input_paths, output_path):
+    from PyPDF2 import PdfMerger
+    merger = PdfMerger()
+    for path in input_paths:
+        merger.append(path)
+    with open(output_path, "wb") as f:
+        merger.write(f)
+    merger.close()
+
+
+def pypdf2_split(input_path, pages, output_path):
+    from PyPDF2 import PdfReader, PdfWriter
+    reader = PdfReader(input_path)
+    writer = PdfWriter()
+    for page_num in pdf.parse_pages(pages, len(reader.pages)):
+        writer.add_page(reader.pages[page_num])
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+
+def pypdf2_rotate(input_path, angle, output_path):
+    from PyPDF2 import PdfReader, PdfWriter
+    reader = PdfReader(input_path)
+    writer = PdfWriter()
+    for page in reader.pages:
+        page.rotate(angle)
+        writer.add_page(page)
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+
+def pypdf_compress(input_path, output_path):
+    from pypdf import PdfReader, PdfWriter
+    reader = PdfReader(input_path)
+    writer = PdfWriter()
+    for page in reader.pages:
+        writer.add_page(page)
+        page.compress_content_streams()
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+
+def available(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+def timed(fn, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", type=int, default=500, help="pages per generated document")
+    parser.add_argument("--files", type=int, default=4, help="documents to merge")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case (the median is reported)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pdf-bench-")
+    try:
+        print("=" * 60)
+        print(f"Generating {args.files} documents of {args.pages} pages")
+        print("=" * 60)
+        inputs = []
+        for seed in range(args.files):
+            path = os.path.join(work_dir, f"input_{seed}.pdf")
+            make_document(path, args.pages, seed)
+            inputs.append(path)
+        output = os.path.join(work_dir, "output.pdf")
+        first = inputs[0]
+        half = f"1-{args.pages // 2}"
+
+        cases = [
+            ("merge", "PyMuPDF", True, lambda: pdf.merge(inputs, output)),
+            ("merge", "pypdf", available("pypdf"), lambda: pypdf_merge(inputs, output)),
+            ("merge", "PyPDF2", available("PyPDF2"), lambda: pypdf2_merge(inputs, output)),
+            ("split", "PyMuPDF", True, lambda: pdf.select_pages(first, half, output)),
+            ("split", "PyPDF2", available("PyPDF2"), lambda: pypdf2_split(first, half, output)),
+            ("rotate", "PyMuPDF", True, lambda: pdf.rotate(first, 90, output)),
+            ("rotate", "PyPDF2", available("PyPDF2"), lambda: pypdf2_rotate(first, 90, output)),
+            # The lossless preset, as the route runs it
+            ("compress", "PyMuPDF", True, lambda: pdf.apply_compression(first, [], output)),
+            ("compress", "pypdf", available("pypdf"), lambda: pypdf_compress(first, output)),
+            ("ebook", "PyMuPDF", True, lambda: compress_ebook(first, output, work_dir)),
+        ]
+
+        print(f"\n{'operation':10} {'engine':10} {'seconds':>10} {'output MB':>10}")
+        for operation, engine, enabled, run in cases:
+            if not enabled:
+                print(f"{operation:10} {engine:10} {'skipped (not installed)':>22}")
+                continue
+            seconds = timed(run, args.repeat)
+            size_mb = os.path.getsize(output) / (1024 * 1024)
+            print(f"{operation:10} {engine:10} {seconds:10.3f} {size_mb:10.2f}")
+            os.remove(output)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,5 @@
 from pdf2docx import Converter
-from docx2pdf import convert
-import pythoncom
+from app.services.office import convert_with_cli
 
 def convert_pdf_to_word(input_path, output_path):
     """Converts a PDF file to a Word document."""
@@ -10,9 +9,5 @@ def convert_pdf_to_word(input_path, output_path):
 
 def convert_word_to_pdf(input_path, output_path):
     """Converts a Word document to a PDF file."""
-    # Initialize COM library for Windows (needed for docx2pdf in a thread/async context)
-    try:
-        pythoncom.CoInitialize()
-        convert(input_path, output_path)
-    finally:
-        pythoncom.CoUninitialize()
+    # Headless LibreOffice works on any OS, unlike docx2pdf which needs Word over COM
+    convert_with_cli(input_path, output_path)
@@ -2,12 +2,21 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from app.routers import documents, images, media, archives, utils, pdf_tools, ocr, qr_barcode, pdf_advanced, image_tools, dev_tools, pdf_editor
-from app.config import UPLOAD_DIR, OUTPUT_DIR
+from app.routers import documents, images, media, archives, utils, pdf_tools, ocr, qr_barcode, pdf_advanced, image_tools, dev_tools, pdf_editor, jobs
+from app.services import executor, storage, cache, background_removal, office, jobs as job_queue
+from app.config import REMBG_PRELOAD
+from app.services.cache import CacheBypassMiddleware
+from app.services.uploads import UploadLimitMiddleware
+import asyncio
 import os
 
 app = FastAPI(title="All-in-One Converter API")
 
+# Reject oversized uploads before the body is parsed (added first so CORS headers still wrap the 413)
+app.add_middleware(UploadLimitMiddleware)
+
+app.add_middleware(CacheBypassMiddleware)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -27,6 +36,28 @@ def health_check():
     }
 
 
+@app.get("/cache/stats")
+def cache_stats():
+    return cache.summary()
+
+
+@app.on_event("startup")
+async def start_background_workers():
+    job_queue.start()
+    storage.start_janitor()
+    office.start()
+    if REMBG_PRELOAD:
+        asyncio.ensure_future(background_removal.preload())
+
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    storage.stop_janitor()
+    office.stop()
+    job_queue.stop()
+    executor.shutdown()
+
+
 # Include routers
 app.include_router(documents.router, tags=["Documents"])
 app.include_router(images.router, tags=["Images"])
@@ -40,6 +71,7 @@ app.include_router(pdf_advanced.router, tags=["PDF Advanced"])
 app.include_router(image_tools.router, tags=["Image Tools"])
 app.include_router(dev_tools.router, tags=["Developer Tools"])
 app.include_router(pdf_editor.router, tags=["PDF Editor"])
+app.include_router(jobs.router, tags=["Jobs"])
 
 # Serve Frontend Static Files (Production)
 # We assume the frontend build is copied to 'static' directory in Docker
@@ -0,0 +1,118 @@
+import asyncio
+import io
+import os
+import zipfile
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.routers import archives  # noqa: E402
+
+
+def _archive(monkeypatch, entries, lookahead, pooled=None):
+    async def inline(tool, fn, path, *args):
+        if pooled is not None:
+            pooled.append(os.path.basename(path))
+        return fn(path, *args)
+
+    monkeypatch.setattr(archives, "run_cpu", inline)
+    monkeypatch.setattr(archives, "_LOOKAHEAD_MEMBERS", lookahead)
+
+    async def collect():
+        return b"".join([chunk async for chunk in archives._stream_archive(entries, zipfile.ZIP_DEFLATED, 6)])
+
+    return zipfile.ZipFile(io.BytesIO(asyncio.new_event_loop().run_until_complete(collect())))
+
+
+def _entries(tmp_path, contents):
+    entries = []
+    for name, data in contents.items():
+        path = tmp_path / name
+        path.write_bytes(data)
+        entries.append((name, str(path)))
+    return entries
+
+
+def test_members_are_compressed_in_order(monkeypatch, tmp_path):
+    contents = {
+        "a.txt": b"hello " * 10000,
+        "b.bin": os.urandom(4096),
+        "c.png": b"not really a png " * 100,
+        "d.txt": b"world " * 5000,
+    }
+    entries = _entries(tmp_path, contents)
+
+    archive = _archive(monkeypatch, entries, lookahead=2)
+    assert archive.testzip() is None
+    assert [info.filename for info in archive.infolist()] == list(contents)
+    methods = {info.filename: info.compress_type for info in archive.infolist()}
+    # Random data doesn't shrink and PNGs are never recompressed
+    assert methods == {"a.txt": zipfile.ZIP_DEFLATED, "b.bin": zipfile.ZIP_STORED, "c.png": zipfile.ZIP_STORED, "d.txt": zipfile.ZIP_DEFLATED}
+    assert {name: archive.read(name) for name in contents} == contents
+    # Uploads are cleaned up once streamed
+    assert not any(os.path.exists(path) for _, path in entries)
+
+
+def test_large_members_are_compressed_into_the_stream(monkeypatch, tmp_path):
+    monkeypatch.setattr(archives, "_POOL_MAX_MEMBER_BYTES", 20000)
+    contents = {"small.txt": b"small " * 1000, "large.txt": b"large " * 50000, "tail.txt": b"tail " * 1000}
+    entries = _entries(tmp_path, contents)
+    pooled = []
+
+    archive = _archive(monkeypatch, entries, lookahead=4, pooled=pooled)
+    # The large member never went to the pool, which would hold it in memory whole
+    assert sorted(pooled) == ["small.txt", "tail.txt"]
+    assert archive.testzip() is None
+    large = archive.getinfo("large.txt")
+    assert large.compress_type == zipfile.ZIP_DEFLATED and large.compress_size < large.file_size
+    assert {name: archive.read(name) for name in contents} == contents
+
+
+def test_pool_lookahead_is_bounded_by_bytes(monkeypatch, tmp_path):
+    monkeypatch.setattr(archives, "_POOL_MAX_MEMBER_BYTES", 5000)
+    monkeypatch.setattr(archives, "_LOOKAHEAD_BYTES", 10000)
+    contents = {f"{index}.txt": bytes([65 + index]) * 4000 for index in range(5)}
+    entries = _entries(tmp_path, contents)
+    started, finished = [], []
+
+    async def tracked(tool, fn, path, *args):
+        started.append(path)
+        # Source bytes handed to the pool and not streamed yet
+        assert 4000 * (len(started) - len(finished)) <= 10000
+        await asyncio.sleep(0)
+        return fn(path, *args)
+
+    real_add_compressed = archives.zipstream.ZipStream.add_compressed
+
+    def add_compressed(self, *args, **kwargs):
+        finished.append(args[0])
+        return real_add_compressed(self, *args, **kwargs)
+
+    monkeypatch.setattr(archives.zipstream.ZipStream, "add_compressed", add_compressed)
+    monkeypatch.setattr(archives, "_LOOKAHEAD_MEMBERS", 10)
+
+    async def collect():
+        return b"".join([chunk async for chunk in archives._stream_archive(entries, zipfile.ZIP_DEFLATED, 6)])
+
+    monkeypatch.setattr(archives, "run_cpu", tracked)
+    archive = zipfile.ZipFile(io.BytesIO(asyncio.new_event_loop().run_until_complete(collect())))
+    assert len(started) == 5
+    assert {name: archive.read(name) for name in contents} == contents
+
+
+@pytest.mark.parametrize("compression, level, bounds", [("deflate", 10, "between 1 and 9"), ("zstd", 23, "between -131072 and 22")])
+def test_level_out_of_range_names_the_codec_bounds(compression, level, bounds):
+    app = FastAPI()
+    app.include_router(archives.router)
+    with TestClient(app) as client:
+        response = client.post(
+            "/convert/archive/create",
+            files={"files": ("a.txt", b"hello", "text/plain")},
+            data={"compression": compression, "level": str(level)},
+        )
+    assert response.status_code == 400
+    assert bounds in response.json()["detail"]
@@ -0,0 +1,67 @@
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from app.services import archive_reader
+
+
+def _zip(path, members):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("docs/", b"")
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return str(path)
+
+
+def _tar(path, members):
+    with tarfile.open(path, "w:gz") as tf:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+MEMBERS = {"docs/a.txt": b"alpha", "docs/b.md": b"bravo", "c.txt": b"charlie"}
+
+
+@pytest.mark.parametrize("make, fmt", [(_zip, "zip"), (_tar, "tar")])
+def test_list_select_and_read_members(tmp_path, make, fmt):
+    path = make(tmp_path / f"archive.{fmt}", MEMBERS)
+    assert archive_reader.detect(path) == fmt
+    entries = archive_reader.list_entries(path, fmt)
+    files = archive_reader.select(entries, [])
+    assert {entry["name"]: entry["size"] for entry in files} == {name: len(data) for name, data in MEMBERS.items()}
+
+    selected = [entry["name"] for entry in archive_reader.select(entries, ["*.txt"])]
+    assert sorted(selected) == ["c.txt", "docs/a.txt"]
+    read = {name: src.read() for name, src in archive_reader.open_members(path, fmt, selected, str(tmp_path))}
+    assert read == {name: MEMBERS[name] for name in selected}
+
+
+def test_unknown_content_is_rejected(tmp_path):
+    path = tmp_path / "notes.zip"
+    path.write_bytes(b"plain text, whatever the extension says")
+    with pytest.raises(ValueError):
+        archive_reader.detect(str(path))
+
+
+def test_declared_ratio_and_actual_bytes_are_both_capped():
+    bomb = {"name": "zeros", "size": 200 * 1024 * 1024, "compressed_size": 200 * 1024, "is_dir": False}
+    with pytest.raises(archive_reader.ArchiveLimitError):
+        archive_reader.check_limits([bomb])
+
+    budget = archive_reader.Budget(limit_bytes=10)
+    src = budget.wrap(io.BytesIO(b"x" * 16))
+    assert src.read(8) == b"x" * 8
+    with pytest.raises(archive_reader.ArchiveLimitError):
+        src.read(8)
+
+
+@pytest.mark.parametrize("name, safe", [
+    ("../../etc/passwd", "etc/passwd"), ("/abs/path.txt", "abs/path.txt"), ("a\\..\\b.txt", "a/b.txt"),
+])
+def test_safe_name_strips_escaping_components(name, safe):
+    assert archive_reader.safe_name(name) == safe
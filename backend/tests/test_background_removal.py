@@ -0,0 +1,25 @@
+import asyncio
+
+from app.services import background_removal
+
+
+def test_burst_is_split_across_workers(monkeypatch):
+    batches = []
+
+    async def run_in_pool(tool, pool, fn, items):
+        batches.append(list(items))
+        return [None] * len(items)
+
+    monkeypatch.setattr(background_removal.executor, "run_in_pool", run_in_pool)
+    monkeypatch.setattr(background_removal, "_get_pool", lambda: None)
+    monkeypatch.setattr(background_removal, "REMBG_WORKERS", 3)
+    monkeypatch.setattr(background_removal, "REMBG_BATCH_SIZE", 8)
+
+    async def scenario():
+        await asyncio.gather(*[
+            background_removal.remove_background(f"in{i}.png", f"out{i}.png") for i in range(7)
+        ])
+
+    asyncio.new_event_loop().run_until_complete(scenario())
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [item for batch in batches for item in batch] == [(f"in{i}.png", f"out{i}.png") for i in range(7)]
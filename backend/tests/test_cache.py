@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.services import cache  # noqa: E402
+
+
+def test_key_depends_on_tool_inputs_and_params():
+    key = cache.make_key("pdf.rotate", ["abc"], angle=90, pages="1-3")
+    assert key == cache.make_key("pdf.rotate", ["abc"], pages="1-3", angle=90)
+    assert key != cache.make_key("pdf.rotate", ["abc"], angle=180, pages="1-3")
+    assert key != cache.make_key("pdf.rotate", ["abd"], angle=90, pages="1-3")
+    assert key != cache.make_key("pdf.split", ["abc"], angle=90, pages="1-3")
+    # Input order matters, e.g. for merge
+    assert cache.make_key("pdf.merge", ["a", "b"]) != cache.make_key("pdf.merge", ["b", "a"])
+
+
+def test_bypass_header_disables_the_cache_for_the_request():
+    app = FastAPI()
+    app.add_middleware(cache.CacheBypassMiddleware)
+
+    @app.get("/key")
+    async def key():
+        return {"key": cache.make_key("tool", ["digest"])}
+
+    client = TestClient(app)
+    assert client.get("/key").json()["key"] == cache.make_key("tool", ["digest"])
+    assert client.get("/key", headers={cache.CACHE_BYPASS_HEADER: "true"}).json()["key"] is None
+    assert client.get("/key", headers={cache.CACHE_BYPASS_HEADER: "0"}).json()["key"] is not None
+
+
+def test_entries_are_evicted_least_recently_used_first(tmp_path):
+    store = cache.ResultCache(str(tmp_path), 250)
+    store.put_bytes("a", b"a" * 100, "text/plain")
+    store.put_bytes("b", b"b" * 100, "text/plain")
+    assert store.read_bytes("a") == b"a" * 100
+    store.put_bytes("c", b"c" * 100, "text/plain")
+    assert store.get("b") is None
+    assert store.read_bytes("a") == b"a" * 100
+    assert store.read_bytes("c") == b"c" * 100
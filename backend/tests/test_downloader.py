@@ -0,0 +1,173 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import types
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("requests")
+
+from fastapi import HTTPException  # noqa: E402
+
+from app.services import cache, downloader, executor, storage  # noqa: E402
+
+VIDEO = b"\0fake video\0" * 1000
+
+
+class _Server:
+    """Stand-in for the download host: answers the HEAD pre-flight and serves one slow "video"."""
+
+    def __init__(self):
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                server.requests.append(("HEAD", self.path))
+                self.send_response(200)
+                self.end_headers()
+
+            def do_GET(self):
+                server.requests.append(("GET", self.path))
+                # Slow enough for concurrent requests to overlap
+                time.sleep(0.2)
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(VIDEO)))
+                self.end_headers()
+                self.wfile.write(VIDEO)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def count(self, method):
+        return sum(1 for seen, _ in self.requests if seen == method)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _YoutubeDL:
+    """Just enough of yt_dlp.YoutubeDL: fetch the URL and report where the file ended up."""
+
+    def __init__(self, options):
+        self.options = options
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=True):
+        fmt = self.options["postprocessors"][0].get("preferredcodec") or self.options["postprocessors"][0]["preferedformat"]
+        path = os.path.join(os.path.dirname(self.options["outtmpl"]), f"video.{fmt}")
+        with urllib.request.urlopen(url) as response, open(path, "wb") as f:
+            f.write(response.read())
+        return {"requested_downloads": [{"filepath": path}]}
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    server = _Server()
+    monkeypatch.setitem(sys.modules, "yt_dlp", types.SimpleNamespace(YoutubeDL=_YoutubeDL))
+    monkeypatch.setattr(downloader, "DOWNLOAD_CONNECTIVITY_URL", server.url + "/")
+    monkeypatch.setattr(downloader, "_connectivity", {"error": None, "checked_at": None})
+    monkeypatch.setattr(downloader, "_connectivity_check", None)
+    monkeypatch.setattr(downloader, "_inflight", {})
+    monkeypatch.setattr(storage, "OUTPUT_DIR", str(tmp_path / "outputs"))
+    monkeypatch.setattr(cache, "_cache", cache.ResultCache(str(tmp_path / "cache"), 1024 * 1024 * 1024))
+    # Semaphores bind to the loop they are first used on
+    monkeypatch.setattr(executor, "_semaphores", {})
+    yield server
+    server.close()
+
+
+def _run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+def test_preflight_is_cached_and_refreshed_by_a_request(server, monkeypatch):
+    async def scenario():
+        await downloader.ensure_online()
+        await downloader.ensure_online()
+        assert server.count("HEAD") == 1
+
+        # Gone stale: nothing is checked until a request comes in
+        downloader._connectivity["checked_at"] -= downloader.DOWNLOAD_CONNECTIVITY_TTL_SECONDS + 1
+        await asyncio.sleep(0.1)
+        assert server.count("HEAD") == 1
+        # That request is answered from the stale result and starts the refresh in the background
+        await downloader.ensure_online()
+        await downloader._connectivity_check
+        assert server.count("HEAD") == 2
+        assert time.time() - downloader._connectivity["checked_at"] < 5
+
+    _run(scenario())
+
+
+def test_failed_preflight_is_not_cached(server, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(downloader, "DOWNLOAD_CONNECTIVITY_URL", "http://127.0.0.1:1/")
+        with pytest.raises(HTTPException) as e:
+            await downloader.ensure_online()
+        assert e.value.status_code == 500
+        # The next request checks again instead of reusing the failure
+        monkeypatch.setattr(downloader, "DOWNLOAD_CONNECTIVITY_URL", server.url + "/")
+        await downloader.ensure_online()
+        assert server.count("HEAD") == 1
+
+    _run(scenario())
+
+
+def test_concurrent_requests_share_one_download(server):
+    url = server.url + "/video"
+
+    async def scenario():
+        results = await asyncio.gather(*[downloader.download(url, "mp3", "audio/mpeg") for _ in range(3)])
+        assert server.count("GET") == 1
+        paths = {path for path, _ in results}
+        assert len(paths) == 1
+        path = paths.pop()
+        with open(path, "rb") as f:
+            assert f.read() == VIDEO
+        # The shared file outlives every response but the last
+        for _, cleanup in results[:-1]:
+            await cleanup()
+            assert os.path.exists(path)
+        await results[-1][1]()
+        assert not os.path.exists(path)
+        assert downloader._inflight == {}
+
+    _run(scenario())
+
+
+def test_download_is_served_from_cache_within_ttl(server, monkeypatch):
+    url = server.url + "/video"
+
+    async def scenario():
+        _, cleanup = await downloader.download(url, "mp3", "audio/mpeg")
+        await cleanup()
+
+        # Same video (the fragment doesn't change it), no second fetch
+        hit = await downloader.cached(url + "#t=10", "mp3")
+        assert hit is not None and hit.headers["X-Cache"] == "HIT"
+        with open(hit.path, "rb") as f:
+            assert f.read() == VIDEO
+        assert await downloader.cached(url, "mp4") is None
+
+        monkeypatch.setattr(downloader, "DOWNLOAD_CACHE_TTL_SECONDS", 0)
+        time.sleep(0.01)
+        assert await downloader.cached(url, "mp3") is None
+        assert server.count("GET") == 1
+
+    _run(scenario())
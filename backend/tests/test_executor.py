@@ -0,0 +1,53 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from app.services import executor
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(executor, "_semaphores", {})
+    monkeypatch.setattr(executor, "TOOL_CONCURRENCY", {"default": 4, "narrow": 1})
+
+
+def test_each_tool_is_held_to_its_own_limit(limits):
+    running = {"narrow": 0, "other": 0}
+    peak = {"narrow": 0, "other": 0}
+    lock = threading.Lock()
+
+    def work(tool):
+        with lock:
+            running[tool] += 1
+            peak[tool] = max(peak[tool], running[tool])
+        time.sleep(0.05)
+        with lock:
+            running[tool] -= 1
+
+    async def scenario():
+        # Tools without their own entry share the default limit
+        await asyncio.gather(*[executor.run_io(tool, work, tool) for tool in ["narrow", "other"] * 4])
+
+    asyncio.run(scenario())
+    assert peak == {"narrow": 1, "other": 4}
+
+
+def test_a_dead_worker_gets_a_fresh_process_pool(limits, monkeypatch):
+    monkeypatch.setattr(executor, "_process_pool", None)
+    monkeypatch.setattr(executor, "CPU_WORKERS", 1)
+
+    async def scenario():
+        with pytest.raises(BrokenProcessPool):
+            await executor.run_cpu("narrow", os._exit, 1)
+        assert executor._process_pool is None
+        return await executor.run_cpu("narrow", math.factorial, 10)
+
+    try:
+        assert asyncio.run(scenario()) == 3628800
+    finally:
+        executor._process_pool.shutdown()
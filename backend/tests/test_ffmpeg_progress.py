@@ -0,0 +1,65 @@
+import asyncio
+import stat
+import sys
+
+import pytest
+
+pytest.importorskip("ffmpeg")
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException  # noqa: E402
+
+from app.services import executor, ffmpeg_runner  # noqa: E402
+
+# Stands in for FFmpeg: prints one -progress block at 5 s and 2x speed, then sleeps SLEEP seconds
+_FAKE_FFMPEG = f"""#!{sys.executable}
+import sys, time
+sys.stdout.write("frame=120\\nfps=48.0\\nout_time_us=5000000\\nspeed=2.0x\\nprogress=continue\\n")
+sys.stdout.flush()
+time.sleep(float(sys.argv[-1]))
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(monkeypatch, tmp_path):
+    path = tmp_path / "ffmpeg"
+    path.write_text(_FAKE_FFMPEG)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    # The "stream" is the number of seconds the fake sleeps
+    monkeypatch.setattr(ffmpeg_runner.ffmpeg, "compile", lambda stream, overwrite_output=True: [str(path), str(stream)])
+    monkeypatch.setattr(executor, "_semaphores", {})
+    monkeypatch.setattr(ffmpeg_runner, "FFMPEG_PROGRESS_RETENTION_SECONDS", 0)
+
+
+def test_progress_blocks_become_percent_and_eta(fake_ffmpeg):
+    async def scenario():
+        async with ffmpeg_runner.task("t1", duration=20) as progress:
+            # The second of two passes: 5 of 20 s lands at 50% + 25% of the remaining half
+            await ffmpeg_runner.run(0, progress, offset=0.5, span=0.5)
+            during = dict(progress.stats)
+        return during, progress
+
+    during, progress = asyncio.run(scenario())
+    assert during == {"time": 5.0, "speed": 2.0, "percent": 62.5, "eta": 7.5, "frame": 120, "fps": 48.0}
+    assert progress.state == ffmpeg_runner.DONE
+    assert progress.stats["percent"] == 100.0
+
+
+def test_cancel_kills_the_running_process(fake_ffmpeg):
+    async def scenario():
+        async def cancel_when_running():
+            while getattr(ffmpeg_runner.get("t2"), "state", None) != ffmpeg_runner.RUNNING:
+                await asyncio.sleep(0.01)
+            assert ffmpeg_runner.cancel("t2")
+
+        canceller = asyncio.ensure_future(cancel_when_running())
+        with pytest.raises(HTTPException) as info:
+            async with ffmpeg_runner.task("t2", duration=20) as progress:
+                await ffmpeg_runner.run(30, progress)
+        await canceller
+        return info.value, progress
+
+    error, progress = asyncio.run(asyncio.wait_for(scenario(), 10))
+    assert error.status_code == 409
+    assert progress.state == ffmpeg_runner.CANCELLED
+    assert not ffmpeg_runner.cancel("t2")
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import stat
+import sys
+
+import pytest
+
+ffmpeg = pytest.importorskip("ffmpeg")
+pytest.importorskip("fastapi")
+
+from app.routers import media  # noqa: E402
+from app.services import executor, ffmpeg_runner, storage  # noqa: E402
+
+# Stands in for FFmpeg: writes CHUNKS chunks of 64 KiB to stdout, then exits with EXIT
+_FAKE_FFMPEG = f"""#!{sys.executable}
+import os, sys
+for _ in range(int(os.environ.get("CHUNKS", "4"))):
+    sys.stdout.buffer.write(b"x" * 65536)
+    sys.stdout.buffer.flush()
+sys.stderr.write("boom\\\\n")
+sys.exit(int(os.environ.get("EXIT", "0")))
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(monkeypatch, tmp_path):
+    path = tmp_path / "ffmpeg"
+    path.write_text(_FAKE_FFMPEG)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(ffmpeg_runner.ffmpeg, "compile", lambda stream, overwrite_output=True: [str(path)])
+    monkeypatch.setattr(executor, "_semaphores", {})
+    return monkeypatch
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_output_is_streamed_in_full(fake_ffmpeg):
+    fake_ffmpeg.setenv("CHUNKS", "20")
+
+    async def scenario():
+        progress = ffmpeg_runner.Progress("stream")
+        return b"".join([chunk async for chunk in ffmpeg_runner.stream_output(None, progress, "media")])
+
+    assert len(_run(scenario())) == 20 * 65536
+
+
+def test_stalled_client_releases_the_encode_slot(fake_ffmpeg):
+    fake_ffmpeg.setenv("CHUNKS", "64")
+    fake_ffmpeg.setattr(ffmpeg_runner, "FFMPEG_STREAM_BUFFER_MB", 1)
+    fake_ffmpeg.setattr(ffmpeg_runner, "FFMPEG_STREAM_SEND_TIMEOUT_SECONDS", 0.2)
+
+    async def scenario():
+        progress = ffmpeg_runner.Progress("stalled")
+        chunks = ffmpeg_runner.stream_output(None, progress, "media")
+        await chunks.__anext__()
+        # The client stops reading: the buffer fills, then the slot is given back
+        await asyncio.sleep(1)
+        semaphore = executor.limiter("media")
+        assert not semaphore.locked()
+        assert semaphore._value == executor.TOOL_CONCURRENCY["media"]
+        with pytest.raises(TimeoutError):
+            async for _ in chunks:
+                pass
+
+    _run(scenario())
+
+
+def test_failure_after_output_started_raises(fake_ffmpeg):
+    fake_ffmpeg.setenv("EXIT", "1")
+
+    async def scenario():
+        progress = ffmpeg_runner.Progress("failing")
+        received = []
+        with pytest.raises(ffmpeg.Error) as e:
+            async for chunk in ffmpeg_runner.stream_output(None, progress, "media"):
+                received.append(chunk)
+        assert received and b"boom" in e.value.stderr
+
+    _run(scenario())
+
+
+def test_mid_stream_failure_aborts_the_response(tmp_path):
+    input_path = tmp_path / "input.mkv"
+    input_path.write_bytes(b"input")
+
+    async def chunks():
+        yield b"more"
+        raise ffmpeg.Error("ffmpeg", b"", b"Conversion failed")
+
+    async def scenario():
+        body = media._continue_stream(b"first", chunks(), str(input_path), "input.mkv")
+        received = []
+        # Re-raised so the server resets the connection instead of ending the body cleanly
+        with pytest.raises(ffmpeg.Error):
+            async for chunk in body:
+                received.append(chunk)
+        assert received == [b"first", b"more"]
+
+    _run(scenario())
+    assert not os.path.exists(input_path)
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException  # noqa: E402
+from fastapi.responses import FileResponse, Response  # noqa: E402
+
+from app.services import cache, executor, jobs, storage  # noqa: E402
+
+
+@pytest.fixture
+def job_store(monkeypatch, tmp_path):
+    store = jobs.JobStore(str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(jobs, "store", store)
+    monkeypatch.setattr(storage, "OUTPUT_DIR", str(tmp_path / "outputs"))
+    monkeypatch.setattr(cache, "_cache", cache.ResultCache(str(tmp_path / "cache"), 1024 * 1024))
+    store.create("job", "tool", {}, {})
+    store.claim()
+    return store
+
+
+def _wait_for_progress_writes():
+    deadline = time.time() + 5
+    while jobs._progress and time.time() < deadline:
+        time.sleep(0.01)
+    assert not jobs._progress
+
+
+def test_progress_is_written_off_the_caller(job_store):
+    token = jobs._current_job.set("job")
+    try:
+        for step in range(1, 101):
+            jobs.report_progress(step / 100)
+    finally:
+        jobs._current_job.reset(token)
+    _wait_for_progress_writes()
+    assert job_store.get("job")["progress"] == 1.0
+
+
+def test_late_progress_does_not_undo_a_finished_job(job_store):
+    job_store.update("job", state=jobs.DONE, progress=1.0)
+    job_store.set_progress("job", 0.5)
+    assert job_store.get("job")["progress"] == 1.0
+
+
+def test_cache_hit_artifact_survives_eviction(job_store, tmp_path):
+    output = tmp_path / "output.pdf"
+    output.write_bytes(b"%PDF result")
+    cache.get_cache().put_file("key", str(output), "application/pdf")
+    cached_path = cache.get_cache().get("key")["path"]
+
+    path, filename, media_type = jobs._store_artifact("job", FileResponse(cached_path, filename="result.pdf", media_type="application/pdf"))
+    assert (filename, media_type) == ("result.pdf", "application/pdf")
+    assert not cache.contains(path)
+    # Filling the cache evicts the entry the job was served from
+    cache.get_cache().put_bytes("other", b"\0" * (1024 * 1024), "application/octet-stream")
+    assert not os.path.exists(cached_path)
+    with open(path, "rb") as f:
+        assert f.read() == b"%PDF result"
+
+
+def test_own_outputs_are_kept_in_place(job_store):
+    path = storage.output_path("job", "out.pdf")
+    with open(path, "wb") as f:
+        f.write(b"%PDF")
+    assert jobs._store_artifact("job", FileResponse(path, filename="out.pdf"))[0] == path
+
+
+def test_execute_records_the_outcome(job_store, monkeypatch):
+    monkeypatch.setattr(executor, "_semaphores", {})
+
+    async def ok():
+        return Response(b"done", media_type="text/plain", headers={"content-disposition": 'attachment; filename="out.txt"'})
+
+    async def bad():
+        raise HTTPException(status_code=400, detail="Bad input")
+
+    monkeypatch.setattr(jobs, "_tools", {"ok": ok, "bad": bad})
+    job_store.create("failing", "bad", {}, {})
+    asyncio.run(jobs._execute({**job_store.get("job"), "tool": "ok"}))
+    asyncio.run(jobs._execute(job_store.get("failing")))
+
+    done = job_store.get("job")
+    assert (done["state"], done["result_filename"], done["media_type"]) == (jobs.DONE, "out.txt", "text/plain")
+    failed = job_store.get("failing")
+    assert (failed["state"], failed["status_code"], failed["error"]) == (jobs.FAILED, 400, "Bad input")
@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("ffmpeg")
+
+from app.routers import media  # noqa: E402
+
+
+def test_segment_list_gives_paths_in_the_work_dir_and_durations(tmp_path):
+    list_path = tmp_path / "segments.csv"
+    list_path.write_text(
+        "part00000.mkv,0.000000,10.010000\n"
+        "/elsewhere/part00001.mkv,10.010000,20.020000\n"
+        "part00002.mkv,20.020000,24.500000\n"
+        "\n"
+    )
+    segments = media._read_segment_list(str(list_path), str(tmp_path))
+    assert [path for path, _ in segments] == [str(tmp_path / f"part0000{i}.mkv") for i in range(3)]
+    assert [duration for _, duration in segments] == pytest.approx([10.01, 10.01, 4.48])
+
+
+def test_empty_segment_list_means_no_segments(tmp_path):
+    list_path = tmp_path / "segments.csv"
+    list_path.write_text("")
+    assert media._read_segment_list(str(list_path), str(tmp_path)) == []
+
+
+def _info(duration="600", audio=True):
+    streams = [{"codec_type": "video"}] + ([{"codec_type": "audio"}] if audio else [])
+    return {"format": {"duration": duration}, "streams": streams}
+
+
+def test_target_size_is_spread_over_the_duration():
+    # 100 MB over 10 minutes, less 2% overhead: 1370 kbps, of which audio takes its 128 kbps cap
+    assert media._target_bitrates(_info(), 100, 0) == (1242, 128)
+
+
+def test_target_bitrate_wins_over_the_duration():
+    assert media._target_bitrates(_info(duration=None, audio=False), 0, 1000) == (1000, 0)
+    # Audio gets a tenth of a small budget, but never less than 32 kbps
+    assert media._target_bitrates(_info(), 0, 200) == (168, 32)
+
+
+def test_targets_that_cannot_be_met_are_rejected():
+    with pytest.raises(media.HTTPException) as info:
+        media._target_bitrates(_info(), 0, 60)
+    assert info.value.status_code == 400
+    with pytest.raises(media.HTTPException) as info:
+        media._target_bitrates(_info(duration=None), 50, 0)
+    assert "duration" in info.value.detail
@@ -0,0 +1,77 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("ffmpeg")
+pytest.importorskip("httpx")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.routers import media  # noqa: E402
+from app.services import cache, executor, storage  # noqa: E402
+
+
+def _info(video=None, audio=None, format_name="mov,mp4,m4a,3gp,3g2,mj2"):
+    streams = []
+    if video:
+        streams.append({"codec_type": "video", "codec_name": video})
+    if audio:
+        streams.append({"codec_type": "audio", "codec_name": audio})
+    return {"format": {"format_name": format_name}, "streams": streams}
+
+
+@pytest.mark.parametrize("info, target_format, mode", [
+    (_info("h264", "aac"), "mkv", "copy"),
+    (_info("h264", "pcm_s16le"), "mp4", "audio"),
+    (_info("vp8", "vorbis"), "mp4", "encode"),
+    (_info("h264", "mp3"), "mp3", "copy"),
+    (_info("h264", "aac"), "mp3", "encode"),
+    (_info(audio="flac"), "ogg", "copy"),
+])
+def test_choose_mode_does_the_least_work(info, target_format, mode):
+    assert media._choose_mode(info, target_format) == mode
+
+
+def test_cover_art_does_not_count_as_video():
+    info = _info(audio="mp3", format_name="mp3")
+    info["streams"].append({"codec_type": "video", "codec_name": "mjpeg", "disposition": {"attached_pic": 1}})
+    assert media._choose_mode(info, "mp3") == "copy"
+    assert media._already_target(info, "song.MP3", "mp3")
+
+
+def test_already_target_needs_the_extension_container_and_codecs():
+    info = _info("h264", "aac")
+    assert media._already_target(info, "clip.mp4", "mp4")
+    assert not media._already_target(info, "clip.mov", "mp4")
+    assert not media._already_target(_info("h264", "aac", format_name="matroska,webm"), "clip.mp4", "mp4")
+    assert not media._already_target(_info("h264", "pcm_s16le"), "clip.mp4", "mp4")
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    upload_path = storage.upload_path
+    monkeypatch.setattr(storage, "upload_path", lambda file_id, name: upload_path(file_id, name, root=str(tmp_path / "uploads")))
+    monkeypatch.setattr(storage, "OUTPUT_DIR", str(tmp_path / "outputs"))
+    monkeypatch.setattr(cache, "_cache", cache.ResultCache(str(tmp_path / "cache"), 1024 * 1024))
+    monkeypatch.setattr(executor, "_semaphores", {})
+    app = FastAPI()
+    app.include_router(media.router)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("filename, media_type", [
+    ("clip.mkv", "video/x-matroska"), ("clip.MOV", "video/quicktime"), ("clip.avi", "video/x-msvideo"),
+])
+def test_skipped_compression_keeps_the_container(client, monkeypatch, filename, media_type):
+    async def cached_probe(path, digest):
+        return {"format": {"duration": "10", "format_name": "matroska,webm"}, "streams": [{"codec_type": "video"}]}
+
+    monkeypatch.setattr(media.probe, "cached_probe", cached_probe)
+    response = client.post(
+        "/convert/media/compress", files={"file": (filename, b"small video")}, data={"target_size_mb": "5"},
+    )
+    assert response.status_code == 200
+    assert response.headers["x-compression"] == "skipped"
+    assert response.headers["content-type"] == media_type
+    assert f'filename="compressed_{filename}"' in response.headers["content-disposition"]
+    assert response.content == b"small video"
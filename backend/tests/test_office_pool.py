@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from app.services import office
+
+
+def _run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+def _fake_pool(monkeypatch, start_ok):
+    calls = []
+
+    def start(self):
+        if not start_ok:
+            raise RuntimeError("soffice would not start")
+        self.ready = True
+
+    monkeypatch.setattr(office.OfficeInstance, "start", start)
+    monkeypatch.setattr(office.OfficeInstance, "stop", lambda self: setattr(self, "ready", False))
+    monkeypatch.setattr(office.OfficeInstance, "healthy", lambda self: self.ready)
+    monkeypatch.setattr(office.OfficeInstance, "convert", lambda self, src, dst: calls.append(("pool", self.index)))
+    monkeypatch.setattr(office, "convert_with_cli", lambda src, dst: calls.append(("cli", None)))
+    monkeypatch.setattr(office, "pool_available", lambda: True)
+    monkeypatch.setattr(office, "cli_available", lambda: True)
+    monkeypatch.setattr(office, "OFFICE_POOL_SIZE", 2)
+    monkeypatch.setattr(office, "OFFICE_HEALTH_INTERVAL_SECONDS", 0.05)
+    return calls
+
+
+def test_failed_start_falls_back_to_cli(monkeypatch):
+    calls = _fake_pool(monkeypatch, start_ok=False)
+
+    async def scenario():
+        office.start()
+        await asyncio.sleep(0.01)
+        try:
+            assert not office.running()
+            started = time.time()
+            await office.convert_to_pdf("in.docx", "out.pdf")
+            assert time.time() - started < 1
+        finally:
+            office.stop()
+
+    _run(scenario())
+    assert calls == [("cli", None)]
+
+
+def test_instance_is_retried_until_it_starts(monkeypatch):
+    calls = _fake_pool(monkeypatch, start_ok=False)
+
+    async def scenario():
+        office.start()
+        try:
+            await asyncio.sleep(0.01)
+            assert not office.running()
+            # soffice comes back: the health loop starts the instances it had left out
+            monkeypatch.setattr(office.OfficeInstance, "start", lambda self: setattr(self, "ready", True))
+            await asyncio.sleep(0.2)
+            assert office.running()
+            await office.convert_to_pdf("in.docx", "out.pdf")
+        finally:
+            office.stop()
+
+    _run(scenario())
+    assert calls and calls[0][0] == "pool"
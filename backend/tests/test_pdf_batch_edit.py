@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+pytest.importorskip("fastapi")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.routers import pdf_editor  # noqa: E402
+from app.services import storage  # noqa: E402
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    doc = fitz.open()
+    for number in range(3):
+        doc.new_page().insert_text((72, 72), f"Hello page {number + 1}")
+    path = tmp_path / "input.pdf"
+    doc.save(str(path))
+    return str(path)
+
+
+def _words(path):
+    with fitz.open(path) as doc:
+        return [[word[4] for word in page.get_text("words")] for page in doc]
+
+
+@pytest.fixture
+def output_path(tmp_path):
+    return str(tmp_path / "output.pdf")
+
+
+def test_batch_applies_every_step(pdf_path, output_path):
+    operations = [
+        {"op": "add_text", "text": "Draft", "page_num": 1},
+        {"op": "find_replace", "find_text": "Hello", "replace_text": "Bye"},
+        {"op": "highlight", "x0": 70, "y0": 60, "x1": 200, "y1": 80},
+    ]
+    pdf_editor._run_batch(pdf_path, output_path, operations, [], False, 0)
+    words = _words(output_path)
+    assert all("Bye" in page and "Hello" not in page for page in words)
+    assert "Draft" in words[1]
+
+
+def test_batch_keeps_every_watermark(pdf_path, output_path):
+    operations = [
+        {"op": "add_watermark", "watermark_text": "FIRST"},
+        {"op": "add_watermark", "watermark_text": "SECOND", "position": "bottom-left", "pages": "2-3"},
+    ]
+    pdf_editor._run_batch(pdf_path, output_path, operations, [], False, 0)
+    words = _words(output_path)
+    assert [page.count("FIRST") for page in words] == [1, 1, 1]
+    assert [page.count("SECOND") for page in words] == [0, 1, 1]
+
+
+def test_batch_incremental_save_appends_to_the_input(pdf_path, output_path):
+    with open(pdf_path, "rb") as f:
+        original = f.read()
+    pdf_editor._run_batch(pdf_path, output_path, [{"op": "add_text", "text": "Draft"}], [], True, 0)
+    with open(output_path, "rb") as f:
+        assert f.read().startswith(original)
+    assert "Draft" in _words(output_path)[0]
+
+
+def test_batch_reports_the_failing_step(pdf_path, output_path):
+    with pytest.raises(ValueError, match=r"Operation 2 \(add_text\): missing field 'text'"):
+        pdf_editor._run_batch(pdf_path, output_path, [{"op": "add_watermark", "watermark_text": "A"}, {"op": "add_text"}], [], False, 0)
+
+
+def test_batch_endpoint_sends_the_output_file_and_removes_it(pdf_path, monkeypatch, tmp_path):
+    async def inline(tool, fn, *args):
+        return fn(*args)
+
+    outputs = tmp_path / "outputs"
+    monkeypatch.setattr(pdf_editor, "run_cpu", inline)
+    monkeypatch.setattr(storage, "OUTPUT_DIR", str(outputs))
+    app = FastAPI()
+    app.include_router(pdf_editor.router)
+    with open(pdf_path, "rb") as f, TestClient(app) as client:
+        response = client.post(
+            "/pdf/edit/batch",
+            files={"file": ("input.pdf", f, "application/pdf")},
+            data={"operations": '[{"op": "add_text", "text": "Draft"}]'},
+        )
+    assert response.status_code == 200
+    assert response.headers["X-Operations-Applied"] == "1"
+    assert 'filename="edited.pdf"' in response.headers["content-disposition"]
+    assert "Draft" in [word[4] for word in fitz.open("pdf", response.content)[0].get_text("words")]
+    # The result was written to OUTPUT_DIR and deleted once sent
+    assert not [name for _, _, names in os.walk(outputs) for name in names]
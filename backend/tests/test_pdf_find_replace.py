@@ -0,0 +1,38 @@
+import pytest
+
+fitz = pytest.importorskip("fitz")
+pytest.importorskip("fastapi")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.routers import pdf_editor  # noqa: E402
+from app.services import pdf  # noqa: E402
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "Hello hello HELLO")
+    path = tmp_path / "input.pdf"
+    doc.save(str(path))
+    return str(path)
+
+
+def test_matching_ignores_case_by_default(pdf_path, tmp_path):
+    count = pdf.replace_text(pdf_path, [{"find": "hello", "replace": "bye"}], str(tmp_path / "out.pdf"))
+    assert count == 3
+
+
+def test_match_case(pdf_path, tmp_path):
+    count = pdf.replace_text(pdf_path, [{"find": "hello", "replace": "bye", "match_case": True}], str(tmp_path / "out.pdf"))
+    assert count == 1
+
+
+@pytest.mark.parametrize("data", [{}, {"find_text": ""}, {"replacements": "[]"}])
+def test_nothing_to_replace_is_rejected(pdf_path, data):
+    app = FastAPI()
+    app.include_router(pdf_editor.router)
+    with open(pdf_path, "rb") as f, TestClient(app) as client:
+        response = client.post("/pdf/edit/find-replace", files={"file": ("input.pdf", f, "application/pdf")}, data=data)
+    assert response.status_code == 400
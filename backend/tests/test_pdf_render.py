@@ -0,0 +1,49 @@
+import pytest
+
+fitz = pytest.importorskip("fitz")
+pytest.importorskip("fastapi")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.routers import pdf_advanced  # noqa: E402
+from app.services import cache, executor, storage  # noqa: E402
+
+
+async def _inline(tool, fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(pdf_advanced, "run_cpu", _inline)
+    monkeypatch.setattr(storage, "OUTPUT_DIR", str(tmp_path / "outputs"))
+    monkeypatch.setattr(cache, "_cache", cache.ResultCache(str(tmp_path / "cache"), 1024 * 1024 * 1024))
+    monkeypatch.setattr(executor, "_semaphores", {})
+    app = FastAPI()
+    app.include_router(pdf_advanced.router)
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def pdf_bytes():
+    doc = fitz.open()
+    doc.new_page(width=200, height=200)
+    # A poster page: far over the megapixel limit at 300 DPI
+    doc.new_page(width=14400, height=14400)
+    return doc.tobytes()
+
+
+@pytest.mark.parametrize("pages, status", [("1", 200), ("2", 400), ("", 400)])
+def test_megapixel_limit_only_counts_selected_pages(client, pdf_bytes, pages, status):
+    response = client.post(
+        "/convert/pdf/to-images",
+        files={"file": ("poster.pdf", pdf_bytes, "application/pdf")},
+        data={"dpi": "300", "pages": pages, "format": "png"},
+    )
+    assert response.status_code == status, response.text
+    if status == 400:
+        assert response.json()["detail"].startswith("Page 2 would be")
+    else:
+        assert response.headers["content-type"] == "image/png"
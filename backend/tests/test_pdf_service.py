@@ -0,0 +1,62 @@
+import pytest
+
+fitz = pytest.importorskip("fitz")
+pytest.importorskip("PIL")
+
+from app.services import pdf  # noqa: E402
+
+
+def _document(path, texts, rotation=0):
+    doc = fitz.open()
+    for text in texts:
+        page = doc.new_page()
+        page.insert_text((72, 72), text)
+        page.set_rotation(rotation)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def _texts(path, password=None):
+    with pdf.open_pdf(path, password) as doc:
+        return [page.get_text().strip() for page in doc]
+
+
+def test_merge_keeps_documents_and_pages_in_order(tmp_path):
+    first = _document(tmp_path / "a.pdf", ["a1", "a2"])
+    second = _document(tmp_path / "b.pdf", ["b1"])
+    output = str(tmp_path / "out.pdf")
+    pdf.merge([second, first, second], output)
+    assert _texts(output) == ["b1", "a1", "a2", "b1"]
+
+
+def test_rotate_adds_to_the_current_rotation(tmp_path):
+    path = _document(tmp_path / "in.pdf", ["one", "two"], rotation=270)
+    output = str(tmp_path / "out.pdf")
+    pdf.rotate(path, 180, output)
+    with fitz.open(output) as doc:
+        assert [page.rotation for page in doc] == [90, 90]
+
+
+def test_select_pages_follows_the_spec(tmp_path):
+    path = _document(tmp_path / "in.pdf", ["p1", "p2", "p3", "p4"])
+    output = str(tmp_path / "out.pdf")
+    pdf.select_pages(path, "3-4,1", output)
+    assert _texts(output) == ["p3", "p4", "p1"]
+    with pytest.raises(ValueError, match="out of range"):
+        pdf.select_pages(path, "2-6", output)
+    with pytest.raises(ValueError, match="Invalid page range"):
+        pdf.select_pages(path, "first", output)
+
+
+def test_protect_then_unlock(tmp_path):
+    path = _document(tmp_path / "in.pdf", ["secret"])
+    locked = str(tmp_path / "locked.pdf")
+    pdf.protect(path, "pw", locked)
+    with pytest.raises(ValueError, match="password protected"):
+        pdf.open_pdf(locked)
+    with pytest.raises(ValueError, match="Incorrect password"):
+        pdf.unlock(locked, "wrong", str(tmp_path / "nope.pdf"))
+    unlocked = str(tmp_path / "unlocked.pdf")
+    pdf.unlock(locked, "pw", unlocked)
+    assert _texts(unlocked) == ["secret"]
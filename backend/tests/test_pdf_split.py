@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+pytest.importorskip("PIL")
+
+from app.services import pdf  # noqa: E402
+
+
+def _document(path, pages, toc=None, image_pages=()):
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page {number + 1}")
+        if number in image_pages:
+            # A distinct, incompressible image per page so each one adds its own ~200 KB stream
+            pixmap = fitz.Pixmap(fitz.csRGB, 256, 256, os.urandom(256 * 256 * 3), False)
+            page.insert_image(fitz.Rect(72, 100, 328, 356), pixmap=pixmap)
+    if toc:
+        doc.set_toc(toc)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def test_every_n_pages_keeps_the_remainder(tmp_path):
+    path = _document(tmp_path / "in.pdf", 7)
+    assert pdf.plan_split(path, "every", every=3) == [
+        ("1_pages_1-3.pdf", 0, 2), ("2_pages_4-6.pdf", 3, 5), ("3_pages_7.pdf", 6, 6),
+    ]
+
+
+def test_bookmarks_start_parts_and_leading_pages_get_their_own(tmp_path):
+    toc = [[1, "Intro: part/1", 3], [2, "Detail", 4], [1, "Appendix", 6]]
+    path = _document(tmp_path / "in.pdf", 8, toc=toc)
+    assert pdf.plan_split(path, "bookmarks", level=1) == [
+        ("1_pages_1-2.pdf", 0, 1), ("2_Intro_part1_3-5.pdf", 2, 4), ("3_Appendix_6-8.pdf", 5, 7),
+    ]
+    with pytest.raises(ValueError):
+        pdf.plan_split(path, "bookmarks", level=3)
+
+
+def test_size_parts_stay_under_the_limit(tmp_path):
+    path = _document(tmp_path / "in.pdf", 6, image_pages=range(6))
+    max_bytes = 450 * 1024
+    parts = pdf.plan_split(path, "size", max_bytes=max_bytes)
+    assert len(parts) > 1
+    assert [first for _, first, _ in parts] == [0] + [last + 1 for _, _, last in parts[:-1]]
+    assert parts[-1][2] == 5
+    work_dir = tmp_path / "parts"
+    work_dir.mkdir()
+    for _, part_path in pdf.write_parts(path, parts, str(work_dir), max_bytes):
+        assert os.path.getsize(part_path) <= max_bytes
+
+
+@pytest.mark.parametrize("mode, options", [("pages", {}), ("every", {"every": 0}), ("size", {"max_bytes": 0})])
+def test_invalid_plans_are_rejected(tmp_path, mode, options):
+    path = _document(tmp_path / "in.pdf", 2)
+    with pytest.raises(ValueError):
+        pdf.plan_split(path, mode, **options)
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("pdf2docx")
+pytest.importorskip("pandas")
+pytest.importorskip("markdown")
+pytest.importorskip("pdfkit")
+
+from app.routers import documents  # noqa: E402
+from app.services import jobs  # noqa: E402
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    calls = []
+
+    async def run_cpu(tool, fn, *args):
+        calls.append((fn.__name__, args))
+
+    async def run_io(tool, fn, *args):
+        return 12
+
+    reported = []
+    monkeypatch.setattr(documents, "run_cpu", run_cpu)
+    monkeypatch.setattr(documents, "run_io", run_io)
+    monkeypatch.setattr(documents, "PDF2DOCX_SHARD_PAGES", 5)
+    monkeypatch.setattr(documents.jobs, "report_progress", reported.append)
+    return calls, reported
+
+
+def _convert(workers, job_id):
+    token = jobs._current_job.set(job_id)
+    try:
+        asyncio.run(documents._convert_pdf_to_docx("in.pdf", "out.docx", 0, 0, workers))
+    finally:
+        jobs._current_job.reset(token)
+
+
+def test_serial_job_reports_progress_per_shard(fake_pool):
+    calls, reported = fake_pool
+    _convert(1, "job")
+    assert [name for name, _ in calls] == ["_parse_pdf_pages"] * 3 + ["_assemble_docx"]
+    assert [args[1] for _, args in calls[:3]] == [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9], [10, 11]]
+    assert reported == pytest.approx([0.9 * 5 / 12, 0.9 * 10 / 12, 0.9])
+
+
+def test_plain_short_request_converts_in_one_pass(fake_pool):
+    calls, reported = fake_pool
+    _convert(1, None)
+    assert calls == [("_pdf_to_docx", ("in.pdf", "out.docx", 0, 12))]
+    assert reported == []
@@ -0,0 +1,46 @@
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+from app.services import pdf  # noqa: E402
+
+
+def _document(pages=3):
+    doc = fitz.open()
+    for number in range(pages):
+        doc.new_page().insert_text((72, 72), f"page {number + 1}")
+    return doc
+
+
+def _watermark(doc, text, pages=None, position="center"):
+    stamp = pdf.watermark_stamp(text)
+    try:
+        return pdf.apply_watermark(doc, stamp, range(len(doc)) if pages is None else pages, position)
+    finally:
+        stamp.close()
+
+
+def _words(doc):
+    reopened = fitz.open("pdf", doc.tobytes())
+    return [[word[4] for word in page.get_text("words")] for page in reopened]
+
+
+def test_watermark_on_every_page():
+    doc = _document()
+    assert _watermark(doc, "DRAFT") == 3
+    assert all(words.count("DRAFT") == 1 for words in _words(doc))
+
+
+def test_second_watermark_keeps_the_first():
+    doc = _document()
+    _watermark(doc, "DRAFT")
+    _watermark(doc, "SECOND", position="top-left")
+    for words in _words(doc):
+        assert words.count("DRAFT") == 1
+        assert words.count("SECOND") == 1
+
+
+def test_watermark_page_range():
+    doc = _document()
+    _watermark(doc, "DRAFT", pages=[1])
+    assert [words.count("DRAFT") for words in _words(doc)] == [0, 1, 0]
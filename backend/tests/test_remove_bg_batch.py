@@ -0,0 +1,38 @@
+import asyncio
+import io
+import zipfile
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("PIL")
+
+from app.routers import images  # noqa: E402
+from app.services import cache, executor, storage  # noqa: E402
+
+
+def test_evicted_cache_hit_is_recomputed(monkeypatch, tmp_path):
+    monkeypatch.setattr(executor, "_semaphores", {})
+    monkeypatch.setattr(storage, "OUTPUT_DIR", str(tmp_path / "outputs"))
+    monkeypatch.setattr(cache, "_cache", cache.ResultCache(str(tmp_path / "cache"), 1024 * 1024))
+    removed = []
+
+    async def cached_path(key):
+        # The entry looks present, but is evicted before the batch reads it
+        return str(tmp_path / "evicted.png")
+
+    async def remove_background(input_path, output_path):
+        removed.append(input_path)
+        with open(output_path, "wb") as f:
+            f.write(b"png of " + input_path.encode())
+
+    monkeypatch.setattr(images.cache, "cached_path", cached_path)
+    monkeypatch.setattr(images.background_removal, "remove_background", remove_background)
+
+    async def collect():
+        return b"".join([chunk async for chunk in images._stream_removed([("cat.jpg", "cat-input", "digest")])])
+
+    with zipfile.ZipFile(io.BytesIO(asyncio.run(collect()))) as zf:
+        assert zf.namelist() == ["cat_no_bg.png"]
+        assert zf.read("cat_no_bg.png") == b"png of cat-input"
+    assert removed == ["cat-input"]
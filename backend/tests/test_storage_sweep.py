@@ -0,0 +1,113 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("starlette")
+
+from app.services import storage  # noqa: E402
+
+
+def _write(root, name, size, mtime):
+    path = os.path.join(root, "ab", "cd", name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+@pytest.fixture
+def dirs(monkeypatch, tmp_path):
+    uploads, outputs = str(tmp_path / "uploads"), str(tmp_path / "outputs")
+    monkeypatch.setattr(storage, "UPLOAD_DIR", uploads)
+    monkeypatch.setattr(storage, "OUTPUT_DIR", outputs)
+    monkeypatch.setattr(storage, "_sweepers", [])
+    monkeypatch.setattr(storage, "_protectors", [])
+    monkeypatch.setattr(storage, "_in_use", {})
+    return uploads, outputs
+
+
+def _age(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+def test_quota_evicts_only_old_outputs(monkeypatch, dirs):
+    uploads, outputs = dirs
+    monkeypatch.setattr(storage, "STORAGE_QUOTA_MB", 1)
+    now = 1_000_000.0
+    mb = 1024 * 1024
+
+    # The oldest file is an input still being worked on; it must survive the quota pass
+    upload = _write(uploads, "input.bin", mb, now - 1800)
+    old_output = _write(outputs, "old.bin", mb // 2, now - 1200)
+    fresh_output = _write(outputs, "fresh.bin", mb // 2, now - 10)
+
+    removed, freed = storage.sweep(now)
+    assert (removed, freed) == (1, mb // 2)
+    assert os.path.exists(upload) and os.path.exists(fresh_output)
+    assert not os.path.exists(old_output)
+
+
+def test_ttl_still_expires_uploads(dirs):
+    uploads, _ = dirs
+    now = 1_000_000.0
+
+    upload = _write(uploads, "input.bin", 10, now - storage.UPLOAD_TTL_SECONDS - 1)
+    assert storage.sweep(now) == (1, 10)
+    assert not os.path.exists(upload)
+
+
+def test_paths_in_use_are_kept_until_removed(monkeypatch, dirs):
+    uploads, _ = dirs
+    monkeypatch.setattr(storage, "STORAGE_QUOTA_MB", 0)
+    now = time.time()
+    # A long conversion: its input is older than the upload TTL, its work files older than the grace
+    input_path = storage.upload_path(storage.new_file_id(), "input.mkv", root=uploads)
+    work_dir = storage.output_path(storage.new_file_id())
+    os.makedirs(work_dir)
+    segment = os.path.join(work_dir, "part00000.mkv")
+    for path in (input_path, segment):
+        with open(path, "wb") as f:
+            f.write(b"\0" * 1024)
+        _age(path, now - storage.UPLOAD_TTL_SECONDS - 60)
+
+    # The same age outside any request's paths is expired
+    leftover = _write(uploads, "leftover.mkv", 1024, now - storage.UPLOAD_TTL_SECONDS - 60)
+
+    assert storage.sweep(now) == (1, 1024)
+    assert os.path.exists(input_path) and os.path.exists(segment)
+    assert not os.path.exists(leftover)
+
+
+def test_fresh_empty_work_dir_is_not_removed(dirs):
+    _, outputs = dirs
+    now = time.time()
+    fresh = os.path.join(outputs, "ab", "cd", "fresh")
+    stale = os.path.join(outputs, "ab", "cd", "stale")
+    os.makedirs(fresh)
+    os.makedirs(stale)
+    _age(stale, now - storage.JANITOR_MIN_AGE_SECONDS - 1)
+
+    storage.sweep(now)
+    assert os.path.isdir(fresh)
+    assert not os.path.exists(stale)
+
+
+def test_protected_results_are_not_evicted(monkeypatch, dirs):
+    _, outputs = dirs
+    monkeypatch.setattr(storage, "STORAGE_QUOTA_MB", 0)
+    now = 1_000_000.0
+    result = _write(outputs, "result", 100, now - 3600)
+    other = _write(outputs, "other", 100, now - 3600)
+    storage.register_protected(lambda: [result])
+
+    assert storage.sweep(now) == (1, 100)
+    assert os.path.exists(result) and not os.path.exists(other)
+
+
+def test_paths_that_were_never_created_are_forgotten(dirs):
+    path = storage.output_path(storage.new_file_id(), "never_written.pdf")
+    assert os.path.abspath(path) in storage._in_use
+    storage.sweep(time.time() + storage.JANITOR_MIN_AGE_SECONDS + 1)
+    assert os.path.abspath(path) not in storage._in_use
@@ -0,0 +1,75 @@
+import asyncio
+import hashlib
+import io
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from fastapi import FastAPI, File, HTTPException, UploadFile  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.services import executor, uploads  # noqa: E402
+
+
+@pytest.fixture
+def one_mb_limit(monkeypatch):
+    monkeypatch.setattr(executor, "_semaphores", {})
+    monkeypatch.setattr(uploads, "MAX_UPLOAD_MB", {"default": 1})
+
+
+@pytest.fixture
+def client(one_mb_limit):
+    app = FastAPI()
+    app.add_middleware(uploads.UploadLimitMiddleware)
+
+    @app.post("/pdf/size")
+    async def size(file: UploadFile = File(...)):
+        # Reads without a limit of its own, so only the middleware can reject the upload
+        return {"size": len(await file.read())}
+
+    return TestClient(app)
+
+
+def test_declared_length_over_the_limit_is_rejected(client):
+    response = client.post("/pdf/size", files={"file": ("big.pdf", b"\0" * (2 * 1024 * 1024))})
+    assert response.status_code == 413
+    assert response.json()["detail"] == "Upload too large. Maximum size is 1 MB."
+
+
+def test_chunked_body_is_cut_off_once_it_passes_the_limit(client):
+    def body():
+        # No Content-Length: only counting the bytes as they arrive can catch this one
+        yield b'--b\r\nContent-Disposition: form-data; name="file"; filename="big.pdf"\r\n\r\n'
+        for _ in range(3):
+            yield b"\0" * (512 * 1024)
+        yield b"\r\n--b--\r\n"
+
+    response = client.post("/pdf/size", content=body(), headers={"content-type": "multipart/form-data; boundary=b"})
+    assert response.status_code == 413
+
+
+def test_upload_within_the_limit_is_stored(client):
+    data = b"%PDF-1.7 small"
+    response = client.post("/pdf/size", files={"file": ("small.pdf", data)})
+    assert response.status_code == 200
+    assert response.json() == {"size": len(data)}
+
+
+def test_save_upload_digests_and_copies_every_chunk(one_mb_limit, tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "CHUNK_SIZE", 1000)
+    data = bytes(range(256)) * 4000
+    path = tmp_path / "upload"
+    digest = asyncio.run(uploads.save_upload(UploadFile(file=io.BytesIO(data), filename="a.bin"), "pdf", str(path)))
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert path.read_bytes() == data
+
+
+def test_save_upload_over_the_limit_leaves_no_file(one_mb_limit, tmp_path):
+    path = tmp_path / "upload"
+    upload = UploadFile(file=io.BytesIO(b"\0" * (1024 * 1024 + 1)), filename="a.bin")
+    with pytest.raises(HTTPException) as info:
+        asyncio.run(uploads.save_upload(upload, "pdf", str(path)))
+    assert info.value.status_code == 413
+    assert not path.exists()